@@ -0,0 +1,243 @@
+import os
+import errno
+import fcntl
+import hashlib
+import logging
+import time
+import uuid
+
+from contextlib import contextmanager
+
+logger = logging.getLogger('worker.'+__name__)
+
+
+@contextmanager
+def flocked(path, mode=fcntl.LOCK_EX):
+	''' hold a flock on the given file (created if missing) '''
+	f = open(path, 'a')
+	try:
+		fcntl.flock(f.fileno(), mode)
+		yield f
+	finally:
+		fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+		f.close()
+
+
+class AppArchiveCache(object):
+	''' Host-wide, content-addressed cache of app archives (ipa files).
+
+		Layout:
+			objects/<sha1>.ipa        archive content, mtime is used as LRU timestamp
+			refs/<appId>-<version>    contains the sha1 of the archive
+			locks/                    flock files serializing downloads per ref
+
+		Multiple DeviceLoop processes may use the cache concurrently. Archives in
+		use (see `using()`) hold a shared lock, taken before their path is handed
+		out, and are never evicted.
+		The cache may temporarily exceed `maxSize` if all archives are in use.
+	'''
+
+	CACHE_PATH = '/tmp/apparchive-cache/'
+	MAX_SIZE = 10*1024**3
+	# archives used within this period (seconds) are never evicted,
+	# this covers the gap between fetch() and using()
+	EVICTION_GRACE_TIME = 60
+
+	def __init__(self, path=None, maxSize=None):
+		self.path = path or self.CACHE_PATH
+		self.maxSize = maxSize or self.MAX_SIZE
+		self.hits = 0
+		self.misses = 0
+		for d in ('objects', 'refs', 'locks'):
+			try:
+				os.makedirs(os.path.join(self.path, d))
+			except OSError as e:
+				if e.errno != errno.EEXIST:
+					raise
+
+	def __str__(self):
+		return "<AppArchiveCache: %s (hits: %d, misses: %d)>" % (self.path, self.hits, self.misses)
+
+	def _ref_path(self, appId, version):
+		ref = '%s-%s' % (appId, version or 'latest')
+		return os.path.join(self.path, 'refs', ref.replace('/', '_'))
+
+	def _object_path(self, digest):
+		return os.path.join(self.path, 'objects', '%s.ipa' % digest)
+
+	@staticmethod
+	def _digest(path, chunkSize=1024*1024):
+		sha1 = hashlib.sha1()
+		f = open(path, 'rb')
+		try:
+			for chunk in iter(lambda: f.read(chunkSize), ''):
+				sha1.update(chunk)
+		finally:
+			f.close()
+		return sha1.hexdigest()
+
+	def hit_rate(self):
+		total = self.hits + self.misses
+		if total == 0:
+			return 0.0
+		return float(self.hits) / total
+
+
+	def get(self, appId, version=None):
+		''' returns the path of the cached archive or None '''
+		refPath = self._ref_path(appId, version)
+		try:
+			f = open(refPath, 'r')
+			digest = f.read().strip()
+			f.close()
+		except IOError:
+			return None
+		objPath = self._object_path(digest)
+		try:
+			# mark as recently used
+			os.utime(objPath, None)
+		except OSError:
+			logger.debug('dropping dangling cache ref %s' % refPath)
+			try:
+				os.remove(refPath)
+			except OSError:
+				pass
+			return None
+		return objPath
+
+	def add(self, appId, version, archivePath):
+		''' move the given archive into the cache.
+			returns the path of the cached archive
+		'''
+		digest = self._digest(archivePath)
+		objPath = self._object_path(digest)
+		if os.path.exists(objPath):
+			os.remove(archivePath)
+			os.utime(objPath, None)
+		else:
+			os.rename(archivePath, objPath)
+
+		refPath = self._ref_path(appId, version)
+		tmpPath = '%s.%s' % (refPath, uuid.uuid4().hex)
+		f = open(tmpPath, 'w')
+		f.write(digest)
+		f.close()
+		os.rename(tmpPath, refPath)
+
+		self.evict()
+		return objPath
+
+	@staticmethod
+	def _lock_shared(objPath):
+		''' open an archive and hold a shared lock on it.
+			returns the file or None if the archive does not exist (anymore)
+		'''
+		try:
+			# never recreate an evicted archive
+			f = open(objPath, 'rb')
+		except IOError as e:
+			if e.errno == errno.ENOENT:
+				return None
+			raise
+		fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+		if os.fstat(f.fileno()).st_nlink == 0:
+			# evicted while waiting for the lock
+			f.close()
+			return None
+		return f
+
+	def _fetch_locked(self, appId, version, download):
+		''' returns (path, file holding a shared lock) of the cached or downloaded archive
+			or (None, None) if the download failed
+		'''
+		lockPath = os.path.join(self.path, 'locks', os.path.basename(self._ref_path(appId, version)))
+		with flocked(lockPath):
+			objPath = self.get(appId, version)
+			f = objPath and self._lock_shared(objPath)
+			if f:
+				self.hits += 1
+				logger.info('app archive cache hit for %s (%s, hit rate: %.2f)' % (appId, version, self.hit_rate()))
+				return objPath, f
+
+			self.misses += 1
+			logger.info('app archive cache miss for %s (%s, hit rate: %.2f)' % (appId, version, self.hit_rate()))
+			tmpPath = os.path.join(self.path, 'objects', '%s.download' % uuid.uuid4().hex)
+			try:
+				if not download(tmpPath):
+					return None, None
+				objPath = self.add(appId, version, tmpPath)
+				# just added, thus within the eviction grace time
+				f = self._lock_shared(objPath)
+				if not f:
+					return None, None
+				return objPath, f
+			finally:
+				# the downloader may leave a partial file (see Backend.get_app_archive)
+				for path in (tmpPath, tmpPath + '.part'):
+					if os.path.exists(path):
+						os.remove(path)
+
+	@contextmanager
+	def using(self, appId, version, download):
+		''' get an archive like `fetch()` and protect it from eviction while in use.
+			yields the path of the cached archive or None if the download failed
+		'''
+		objPath, f = self._fetch_locked(appId, version, download)
+		try:
+			yield objPath
+		finally:
+			if f:
+				fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+				f.close()
+
+	def fetch(self, appId, version, download):
+		''' get an archive from the cache or download it via `download(path)`.
+			Concurrent fetches of the same archive are serialized, thus it is downloaded only once.
+			returns the path of the cached archive or None if the download failed
+		'''
+		with self.using(appId, version, download) as objPath:
+			return objPath
+
+
+	def evict(self):
+		''' remove least recently used archives until the cache fits into `maxSize` '''
+		with flocked(os.path.join(self.path, 'evict.lock')):
+			objDir = os.path.join(self.path, 'objects')
+			objects = []
+			totalSize = 0
+			for name in os.listdir(objDir):
+				if not name.endswith('.ipa'):
+					continue
+				objPath = os.path.join(objDir, name)
+				try:
+					st = os.stat(objPath)
+				except OSError:
+					continue
+				objects.append((st.st_mtime, st.st_size, objPath))
+				totalSize += st.st_size
+
+			objects.sort()
+			graceTime = time.time() - self.EVICTION_GRACE_TIME
+			for mtime, size, objPath in objects:
+				if totalSize <= self.maxSize or mtime > graceTime:
+					break
+				try:
+					f = open(objPath, 'rb')
+				except IOError as e:
+					if e.errno != errno.ENOENT:
+						raise
+					# removed meanwhile
+					totalSize -= size
+					continue
+				try:
+					fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+				except IOError:
+					logger.debug('not evicting %s (in use)' % objPath)
+					f.close()
+					continue
+				try:
+					os.remove(objPath)
+					totalSize -= size
+					logger.debug('evicted %s (last used: %s)' % (objPath, time.ctime(mtime)))
+				finally:
+					f.close()
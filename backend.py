@@ -3,6 +3,11 @@ import json
 import logging
 import shutil
 import base64
+import os
+import time
+import hashlib
+import uuid
+import copy
 
 from enum import Enum
 #from job import Job
@@ -22,19 +27,185 @@ def jd(obj):
 	data = json.dumps(obj, default=json_serialize_ignore_type_errors)
 	return data
 
+def file_md5(path, chunkSize=1024*1024):
+	md5 = hashlib.md5()
+	f = open(path, 'rb')
+	try:
+		for chunk in iter(lambda: f.read(chunkSize), ''):
+			md5.update(chunk)
+	finally:
+		f.close()
+	return md5.hexdigest()
+
 
 class BackendError(Exception):
 	pass
 
 
+class RequestRejected(BackendError):
+	''' the backend permanently rejected a request (4xx), sending it again will not help '''
+
+	def __init__(self, statusCode, message):
+		super(RequestRejected, self).__init__('%d: %s' % (statusCode, message))
+		self.statusCode = statusCode
+
+
+class FileUploadStream(object):
+	''' file-like request body streaming a file from disk in chunks.
+		If `fieldName` is given the file is wrapped as a single multipart/form-data field.
+		The total length is known upfront, thus no chunked transfer encoding is needed.
+	'''
+
+	CHUNK_SIZE = 256*1024
+
+	def __init__(self, path, fieldName=None, fileName=None):
+		self.path = path
+		self.fileSize = os.path.getsize(path)
+		self.contentType = 'application/octet-stream'
+		self._prefix = ''
+		self._suffix = ''
+		if fieldName:
+			boundary = uuid.uuid4().hex
+			self.contentType = 'multipart/form-data; boundary=%s' % boundary
+			self._prefix = ('--%s\r\n'
+				'Content-Disposition: form-data; name="%s"; filename="%s"\r\n'
+				'Content-Type: application/octet-stream\r\n\r\n') % (boundary, fieldName, fileName or os.path.basename(path))
+			self._suffix = '\r\n--%s--\r\n' % boundary
+		self._length = len(self._prefix) + self.fileSize + len(self._suffix)
+		self._file = None
+
+	def __len__(self):
+		return self._length
+
+	def __iter__(self):
+		while True:
+			chunk = self.read(self.CHUNK_SIZE)
+			if not chunk:
+				break
+			yield chunk
+
+	def read(self, size=-1):
+		if size is None or size < 0:
+			size = len(self)
+		data = ''
+		if self._prefix:
+			data, self._prefix = self._prefix[:size], self._prefix[size:]
+		if len(data) < size:
+			if self._file is None:
+				self._file = open(self.path, 'rb')
+			if not self._file.closed:
+				chunk = self._file.read(size - len(data))
+				if chunk:
+					data += chunk
+				else:
+					self._file.close()
+		if len(data) < size and self._file is not None and self._file.closed:
+			rest = size - len(data)
+			data, self._suffix = data + self._suffix[:rest], self._suffix[rest:]
+		return data
+
+	def headers(self):
+		return {
+			'content-type': self.contentType,
+			'content-length': str(len(self))
+		}
+
+	def close(self):
+		if self._file is not None:
+			self._file.close()
+
+
 class Backend(object):
 
 	HEADERS = {'content-type': 'application/json'}
 	RUN_STATE = Enum(['pending', 'running', 'finished', 'failed'])
 
-	def  __init__(self, baseUrl):
+	POOL_SIZE = 4
+	# (connect, read) timeout in seconds
+	TIMEOUT = (10, 120)
+
+	DOWNLOAD_CHUNK_SIZE = 256*1024
+	DOWNLOAD_RETRIES = 5
+
+	def  __init__(self, baseUrl, poolSize=None, timeout=None, longPoll=True):
 		self.baseUrl = baseUrl.strip('/')
 		self.workerId = None
+		self.poolSize = poolSize or self.POOL_SIZE
+		self.timeout = timeout or self.TIMEOUT
+		# will be disabled automatically if the backend answers long-poll requests immediately
+		self.longPoll = longPoll
+		# will be disabled automatically if the backend has no batch claim endpoint
+		self.batchClaim = True
+		# will be disabled automatically if the backend has no batch endpoint
+		self.batchWrite = True
+		# will be disabled automatically if the backend has no bulk job endpoint
+		self.bulkJobs = True
+		# will be disabled automatically if the backend can not be queried for recent jobs
+		self.recentJobs = True
+		# will be disabled automatically if the backend does not accept binary result uploads
+		self.resultArchives = True
+		# optional asynchronous writer for job, run and result updates (see statuswriter.py)
+		self.writer = None
+		self._session = None
+		self._sessionPid = None
+
+
+	@property
+	def session(self):
+		''' the keep-alive session of the current process.
+			A forked process must not reuse the parents pooled connections,
+			thus the session is recreated whenever the pid changes.
+		'''
+		if self._session is None or self._sessionPid != os.getpid():
+			self.reset_session()
+		return self._session
+
+	def reset_session(self):
+		''' drop all pooled connections and create a new session '''
+		if self._session is not None and self._sessionPid == os.getpid():
+			self._session.close()
+		session = requests.Session()
+		adapter = requests.adapters.HTTPAdapter(pool_connections=self.poolSize, pool_maxsize=self.poolSize)
+		session.mount('http://', adapter)
+		session.mount('https://', adapter)
+		self._session = session
+		self._sessionPid = os.getpid()
+
+	def copy(self):
+		''' a copy of this backend with its own session and without status writer,
+			e.g. for a device loop running in a thread of this process
+		'''
+		backend = copy.copy(self)
+		backend.writer = None
+		backend._session = None
+		backend._sessionPid = None
+		return backend
+
+	def _extended_timeout(self, seconds):
+		''' the default timeout with the read timeout extended by `seconds` '''
+		timeout = self.timeout
+		if not isinstance(timeout, tuple):
+			timeout = (timeout, timeout)
+		return (timeout[0], timeout[1] + seconds)
+
+	def _request(self, method, url, **kwargs):
+		kwargs.setdefault('timeout', self.timeout)
+		return self.session.request(method, url, **kwargs)
+
+	def _get(self, url, **kwargs):
+		return self._request('GET', url, **kwargs)
+
+	def _post(self, url, **kwargs):
+		return self._request('POST', url, **kwargs)
+
+	def _head(self, url, **kwargs):
+		return self._request('HEAD', url, **kwargs)
+
+	@staticmethod
+	def _check_rejected(r):
+		''' raises a RequestRejected error for client errors (4xx) '''
+		if 400 <= r.status_code < 500:
+			raise RequestRejected(r.status_code, r.text)
 
 
 	def register_device_accounts(self, device):
@@ -48,13 +219,17 @@ class Backend(object):
 	# get device data and check/register with backend
 	def register_device(self, device):
 		logger.debug("register_device: %s", device)
-		r = requests.get("%s/devices/%s" % (self.baseUrl, device.udid))
+		r = self._get("%s/devices/%s" % (self.baseUrl, device.udid))
 		if (r.status_code == 404):
 			self.register_device_accounts(device)
-			r2 = requests.post("%s/devices" % self.baseUrl, headers=self.HEADERS, data=jd({
+			accounts = list(str(acc['uniqueIdentifier']) for acc in device.accounts())
+			deviceInfo = device.device_info_dict()
+			r2 = self._post("%s/devices" % self.baseUrl, headers=self.HEADERS, data=jd({
 				'udid': device.udid,
-				'accounts': list(str(acc['uniqueIdentifier']) for acc in device.accounts()),
-				'deviceInfo': device.device_info_dict()
+				'accounts': accounts,
+				'deviceInfo': deviceInfo,
+				# all lockdown values queried so far (and their age)
+				'telemetry': device.telemetry.snapshot()
 			}))
 			if (r2.status_code != 200):
 				logger.error("Unable to register new device: %s" % str(device))
@@ -69,7 +244,7 @@ class Backend(object):
 	# raises a BackendError if the given name is not unique
 	def worker_for_name(self, name):
 		logger.debug("worker_for_name: %s", name)
-		r = requests.get("%s/workers?name=%s" % (self.baseUrl, name))
+		r = self._get("%s/workers?name=%s" % (self.baseUrl, name))
 		if r.status_code == 200:
 			workers = json.loads(r.text)
 			if len(workers) != 1:
@@ -80,7 +255,7 @@ class Backend(object):
 			return worker
 		elif r.status_code == 404:
 		# create a new worker
-			r2 = requests.post("%s/workers" % self.baseUrl, headers=self.HEADERS, data=jd({
+			r2 = self._post("%s/workers" % self.baseUrl, headers=self.HEADERS, data=jd({
 					'name': name
 				}))
 			if r2.status_code == 200:
@@ -93,7 +268,7 @@ class Backend(object):
 
 	def get_accounts(self):
 		logger.debug("get_accounts")
-		r = requests.get("%s/accounts" % self.baseUrl)
+		r = self._get("%s/accounts" % self.baseUrl)
 		if r.status_code == 200:
 			return json.loads(r.text)
 		else:
@@ -101,7 +276,7 @@ class Backend(object):
 
 	def post_account(self, account):
 		logger.debug("post_account")
-		r = requests.post("%s/accounts" % self.baseUrl, headers=self.HEADERS, data=jd(account))
+		r = self._post("%s/accounts" % self.baseUrl, headers=self.HEADERS, data=jd(account))
 		if (r.status_code != 200):
 			logger.error("Unable to add new account: %s" % str(account))
 			logger.debug("Response: %s" % r.text)
@@ -113,13 +288,25 @@ class Backend(object):
 #		200: Job object
 #		204: None
 #		else: False
-	def get_job_for_device(self, deviceUUID):
+	def get_job_for_device(self, deviceUUID, wait=None):
+		''' claim the next job for the given device.
+			If `wait` (seconds) is given and the backend supports long-polling,
+			the request is held by the backend until a job is available or `wait` expired.
+		'''
 		logger.debug("get_job_for_device: %s", deviceUUID)
-		r = requests.get("%s/jobs/getandsetworker/%s/device/%s" % (self.baseUrl, self.workerId, deviceUUID))
+		url = "%s/jobs/getandsetworker/%s/device/%s" % (self.baseUrl, self.workerId, deviceUUID)
+		if wait and self.longPoll:
+			r = self._get(url, params={'wait': wait}, timeout=self._extended_timeout(wait))
+		else:
+			wait = None
+			r = self._get(url)
 		if r.status_code == 200:
 			jobDict = json.loads(r.text)
 			return jobDict
 		elif r.status_code == 204:
+			if wait and r.elapsed.total_seconds() < wait / 2.0:
+				logger.info("backend does not hold job requests. Falling back to polling.")
+				self.longPoll = False
 			return None
 		else:
 			logger.error("ERROR: get_job failed with: %s" % str(r.status_code))
@@ -127,29 +314,125 @@ class Backend(object):
 			return False
 
 
+	def get_jobs_for_devices(self, deviceUUIDs, wait=None):
+		''' claim the next job for each of the given devices in a single request.
+			returns:
+				a dict mapping device udids to jobDicts (devices without a job are missing)
+				None if the request failed
+			`batchClaim` will be disabled if the backend does not support batch claiming.
+		'''
+		logger.debug("get_jobs_for_devices: %s", deviceUUIDs)
+		url = "%s/jobs/getandsetworker/%s" % (self.baseUrl, self.workerId)
+		data = jd({'devices': list(deviceUUIDs)})
+		if wait and self.longPoll:
+			r = self._post(url, headers=self.HEADERS, data=data, params={'wait': wait}, timeout=self._extended_timeout(wait))
+		else:
+			wait = None
+			r = self._post(url, headers=self.HEADERS, data=data)
+		if r.status_code == 200:
+			return json.loads(r.text)
+		elif r.status_code == 204:
+			if wait and r.elapsed.total_seconds() < wait / 2.0:
+				logger.info("backend does not hold job requests. Falling back to polling.")
+				self.longPoll = False
+			return {}
+		elif r.status_code in (404, 405):
+			logger.info("backend does not support batch job claiming")
+			self.batchClaim = False
+		else:
+			logger.error("ERROR: get_jobs failed with: %s" % str(r.status_code))
+			logger.debug(r.text)
+		return None
+
+
 	def get_job(self, jobId):
 		logger.debug("get_job: %s", jobId)
-		r = requests.get("%s/jobs/%s" % (self.baseUrl, jobId))
+		r = self._get("%s/jobs/%s" % (self.baseUrl, jobId))
 		if r.status_code == 200:
 			jobDict = json.loads(r.text)
 			return jobDict
 
 
-	def post_job(self, jobDict):
+	# returns jobId or None, raises a RequestRejected error for client errors if `raiseRejected` is set
+	def post_job(self, jobDict, raiseRejected=False):
 		logger.debug("post_job: %s", jobDict)
-		r = requests.post("%s/jobs" % self.baseUrl, data=jd(jobDict), headers=self.HEADERS)
+		r = self._post("%s/jobs" % self.baseUrl, data=jd(jobDict), headers=self.HEADERS)
 		if r.status_code == 200:
 			return json.loads(r.text)['jobId']
 		else:
 			logger.warning("Unable to post job: %s" % str(jobDict))
 			logger.debug("Response: %s" % r.text)
+			if raiseRejected:
+				self._check_rejected(r)
 			return None
 
 
+	def release_job(self, jobDict):
+		''' hand a claimed job that will not be executed back to the backend (as pending job).
+			returns True on success
+		'''
+		jobDict = dict(jobDict, state='pending')
+		try:
+			if self.post_job(jobDict):
+				logger.info('released job %s' % jobDict.get('_id'))
+				return True
+		except requests.RequestException as e:
+			logger.error('Releasing job %s failed: %s' % (jobDict.get('_id'), e))
+		logger.warning('Unable to release job %s, it stays claimed' % jobDict.get('_id'))
+		return False
+
+
+	def post_jobs(self, jobDicts):
+		''' post multiple new jobs in a single request.
+			Falls back to single requests if the backend does not support bulk posts.
+			returns a list with the jobId (or None on failure) of each job
+		'''
+		logger.debug("post_jobs: %d jobs", len(jobDicts))
+		if self.bulkJobs:
+			r = self._post("%s/jobs/bulk" % self.baseUrl, data=jd({'jobs': jobDicts}), headers=self.HEADERS)
+			if r.status_code == 200:
+				jobIds = json.loads(r.text)['jobIds']
+				if len(jobIds) == len(jobDicts):
+					return jobIds
+				logger.warning("Bulk post returned %d jobIds for %d jobs" % (len(jobIds), len(jobDicts)))
+				return [None] * len(jobDicts)
+			elif r.status_code in (404, 405):
+				logger.info("backend does not support bulk job posts")
+				self.bulkJobs = False
+			else:
+				logger.warning("Unable to post %d jobs" % len(jobDicts))
+				logger.debug("Response: %s" % r.text)
+				return [None] * len(jobDicts)
+		return list(self.post_job(jobDict) for jobDict in jobDicts)
+
+
+	def has_recent_job(self, bundleId, storeCountry=None, executionStrategy=None, since=None):
+		''' check if a job for the given app was added after `since` (timestamp)
+			returns True, False or None if the backend does not support the query (`recentJobs` will be disabled)
+		'''
+		logger.debug("has_recent_job: %s", bundleId)
+		params = {
+			'bundleId': bundleId,
+			'storeCountry': storeCountry,
+			'executionStrategy': executionStrategy,
+			'since': since
+		}
+		r = self._get("%s/jobs/recent" % self.baseUrl, params=params)
+		if r.status_code == 200:
+			return bool(json.loads(r.text).get('exists'))
+		elif r.status_code in (404, 405):
+			logger.info("backend does not support queries for recent jobs")
+			self.recentJobs = False
+		else:
+			logger.warning("Unable to query recent jobs for %s" % bundleId)
+			logger.debug("Response: %s" % r.text)
+		return None
+
+
 	# returns appId
 	def post_app(self, appData):
 		logger.debug("post_app: %s", appData)
-		r = requests.post("%s/apps" % self.baseUrl, data=jd(appData), headers=self.HEADERS)
+		r = self._post("%s/apps" % self.baseUrl, data=jd(appData), headers=self.HEADERS)
 		if r.status_code == 200:
 			return json.loads(r.text)['appId']
 		else:
@@ -166,7 +449,7 @@ class Backend(object):
 		url = "%s/apps/bundleid/%s" % (self.baseUrl, bundleId)
 		if version:
 			url += '?version=%s' % version
-		r = requests.get(url)
+		r = self._get(url)
 		if r.status_code == 200:
 			appsDict = json.loads(r.text)
 			if len(appsDict) == 1:
@@ -177,29 +460,90 @@ class Backend(object):
 		return None
 
 
-	def get_app_archive(self, appId, archivePath):
+	def get_app_archive(self, appId, archivePath, expectedSize=None, checksum=None):
 		'''	get the ipa file from backend
+			The archive is streamed to disk in chunks. A dropped connection is
+			resumed via a HTTP Range request.
+			`expectedSize` (bytes) and `checksum` (md5 hexdigest) are verified if given.
 			returns: True or False
 		'''
 		logger.debug("get_app_archive: %s", appId)
-		r = requests.get("%s/apps/%s/ipa" % (self.baseUrl, appId))
-		if r.status_code == 200:
-			f = open(archivePath, 'wb')
-			f.write(r.content)
-			#shutil.copyfileobj(r.raw, f)
+		url = "%s/apps/%s/ipa" % (self.baseUrl, appId)
+		partPath = archivePath + '.part'
+		received = 0
+		tries = self.DOWNLOAD_RETRIES
+		startTime = time.time()
+
+		f = open(partPath, 'wb')
+		completed = False
+		try:
+			while True:
+				headers = {}
+				if received > 0:
+					headers['Range'] = 'bytes=%d-' % received
+				r = None
+				try:
+					r = self._get(url, headers=headers, stream=True)
+					if r.status_code == 200 and received > 0:
+						# range not supported - start over
+						logger.debug("backend ignored range request. restarting download of %s" % appId)
+						f.seek(0)
+						f.truncate()
+						received = 0
+					elif r.status_code not in (200, 206):
+						logger.warning("Unable to get app archive for app %s" % appId)
+						logger.debug("Response: %s" % r.text)
+						return False
+					start = received
+					for chunk in r.iter_content(self.DOWNLOAD_CHUNK_SIZE):
+						if chunk:
+							f.write(chunk)
+							received += len(chunk)
+					# urllib3 does not complain about bodies shorter than announced
+					length = r.headers.get('Content-Length')
+					if length and received - start < int(length):
+						raise requests.ConnectionError('connection closed after %d of %s bytes' % (received - start, length))
+				except requests.RequestException as e:
+					# includes streams dropped mid-body (ChunkedEncodingError, ContentDecodingError)
+					tries -= 1
+					if tries <= 0:
+						logger.warning("Download of app archive %s failed: %s" % (appId, e))
+						return False
+					logger.info("Download of app archive %s interrupted at %d bytes. Resuming..." % (appId, received))
+					continue
+				finally:
+					if r is not None:
+						r.close()
+				if expectedSize and received < expectedSize and tries > 1:
+					tries -= 1
+					logger.info("Download of app archive %s incomplete (%d/%d bytes). Resuming..." % (appId, received, expectedSize))
+					continue
+				break
 			f.close()
 
+			duration = max(time.time() - startTime, 0.001)
+			logger.info("downloaded app archive %s: %d bytes in %.1fs (%.1f KB/s)" % (appId, received, duration, received / 1024.0 / duration))
+
+			if expectedSize and received != expectedSize:
+				logger.warning("Size mismatch for app archive %s: expected %d got %d bytes" % (appId, expectedSize, received))
+				return False
+			if checksum and file_md5(partPath) != checksum.lower():
+				logger.warning("Checksum mismatch for app archive %s" % appId)
+				return False
+
+			os.rename(partPath, archivePath)
+			completed = True
 			return True
-		else:
-			logger.warning("Unable to get app archive for app %s" % appId)
-			logger.debug("Response: %s" % r.text)
-			return False
+		finally:
+			f.close()
+			if not completed and os.path.exists(partPath):
+				os.remove(partPath)
 
 
 	def has_app_archive(self, appId):
 		logger.debug("has_app_archive: %s", appId)
 		logger.debug("%s/apps/%s/ipa" % (self.baseUrl, appId))
-		r = requests.head("%s/apps/%s/ipa" % (self.baseUrl, appId))
+		r = self._head("%s/apps/%s/ipa" % (self.baseUrl, appId))
 		if r.status_code == 200:
 			return True
 		return False
@@ -208,9 +552,11 @@ class Backend(object):
 	# returns appId
 	def post_app_archive(self, appId, archivePath):
 		logger.debug("post_app_archive: %s", appId)
-		r = requests.post("%s/apps/%s/ipa" % (self.baseUrl, appId), files={
-			'ipa': open(archivePath, 'rb')
-		})
+		body = FileUploadStream(archivePath, fieldName='ipa')
+		try:
+			r = self._post("%s/apps/%s/ipa" % (self.baseUrl, appId), headers=body.headers(), data=body)
+		finally:
+			body.close()
 		if r.status_code == 200:
 			return json.loads(r.text)['appId']
 		else:
@@ -219,9 +565,8 @@ class Backend(object):
 			return None
 
 
-	# returns runId
-	def post_run(self, appId, runState, runId=None, executionStrategy=None):
-		logger.debug("post_run: %s", appId)
+	@staticmethod
+	def run_data(appId, runState, runId=None, executionStrategy=None):
 		data={
 			'app': appId,
 			'state': runState
@@ -230,29 +575,133 @@ class Backend(object):
 			data['_id'] = runId
 		if executionStrategy:
 			data['executionStrategy'] = executionStrategy
-		r = requests.post("%s/runs" % self.baseUrl, data=jd(data), headers=self.HEADERS)
+		return data
+
+
+	# returns runId
+	def post_run(self, appId, runState, runId=None, executionStrategy=None, raiseRejected=False):
+		logger.debug("post_run: %s", appId)
+		data = self.run_data(appId, runState, runId=runId, executionStrategy=executionStrategy)
+		r = self._post("%s/runs" % self.baseUrl, data=jd(data), headers=self.HEADERS)
 		if r.status_code == 200:
 			return json.loads(r.text)['runId']
 		else:
 			logger.warning("Unable to post run: %s" % str(data))
 			logger.debug("Response: %s" % r.text)
+			if raiseRejected:
+				self._check_rejected(r)
 			return None
 
 
-	# returns resultId or None
-	def post_result(self, runId, resultType, resultData):
-		logger.debug("post_result: %s", runId)
-		data = {
+	@staticmethod
+	def result_data(runId, resultType, resultData):
+		return {
 			'run': runId,
 			'resultInfo': {
 				'type': resultType,
 				'data': resultData
 			}
 		}
-		r = requests.post("%s/results" % self.baseUrl, headers=self.HEADERS, data=jd(data))
+
+
+	# returns resultId or None, raises a RequestRejected error for client errors if `raiseRejected` is set
+	def post_result(self, runId, resultType, resultData, raiseRejected=False):
+		logger.debug("post_result: %s", runId)
+		data = self.result_data(runId, resultType, resultData)
+		r = self._post("%s/results" % self.baseUrl, headers=self.HEADERS, data=jd(data))
 		if r.status_code == 200:
 			return json.loads(r.text)['resultId']
 		else:
 			logger.warning("Unable to post result: %s" % str(data))
 			logger.debug("Response: %s" % r.text)
+			if raiseRejected:
+				self._check_rejected(r)
+			return None
+
+
+	def _post_result_archive_encoded(self, runId, resultType, archivePath):
+		# the whole archive is held in memory (twice)
+		logger.warning("Posting result archive %s base64 encoded (%d bytes)" % (archivePath, os.path.getsize(archivePath)))
+		f = open(archivePath, 'rb')
+		try:
+			data = base64.b64encode(f.read())
+		finally:
+			f.close()
+		return self.post_result(runId, resultType, data)
+
+
+	def post_batch(self, operations, raiseRejected=False):
+		''' post multiple json documents in a single request.
+			operations: list of (path, data) tuples, e.g. ('/jobs', jobDict)
+			returns:
+				True on success
+				False if the request failed
+				None if the backend does not support batch requests (`batchWrite` will be disabled)
+			raises a RequestRejected error for other client errors if `raiseRejected` is set
+		'''
+		logger.debug("post_batch: %d operations", len(operations))
+		data = {
+			'operations': list({'path': path, 'data': opData} for path, opData in operations)
+		}
+		r = self._post("%s/batch" % self.baseUrl, headers=self.HEADERS, data=jd(data))
+		if r.status_code == 200:
+			return True
+		elif r.status_code in (404, 405):
+			logger.info("backend does not support batch requests")
+			self.batchWrite = False
+			return None
+		else:
+			logger.warning("Unable to post batch of %d operations" % len(operations))
+			logger.debug("Response: %s" % r.text)
+			if raiseRejected:
+				self._check_rejected(r)
+			return False
+
+
+	def queue_job(self, jobDict):
+		''' post a job update via the status writer (if present) '''
+		if self.writer:
+			self.writer.put_job(jobDict)
+		else:
+			self.post_job(jobDict)
+
+	def queue_run(self, appId, runState, runId, executionStrategy=None):
+		''' post a run state update via the status writer (if present) '''
+		if self.writer:
+			self.writer.put_run(self.run_data(appId, runState, runId=runId, executionStrategy=executionStrategy))
+		else:
+			self.post_run(appId, runState, runId=runId, executionStrategy=executionStrategy)
+
+	def queue_result(self, runId, resultType, resultData):
+		''' post a result via the status writer (if present) '''
+		if self.writer:
+			self.writer.put_result(self.result_data(runId, resultType, resultData))
+		else:
+			self.post_result(runId, resultType, resultData)
+
+
+	# returns resultId or None
+	def post_result_archive(self, runId, resultType, archivePath):
+		''' upload a (large) binary result as raw request body.
+			The file is streamed from disk without base64/json encoding.
+			Falls back to a base64 encoded result (see post_result) if the backend
+			does not support binary uploads (`resultArchives` will be disabled).
+		'''
+		logger.debug("post_result_archive: %s", runId)
+		if not self.resultArchives:
+			return self._post_result_archive_encoded(runId, resultType, archivePath)
+		body = FileUploadStream(archivePath)
+		try:
+			r = self._post("%s/runs/%s/results/%s" % (self.baseUrl, runId, resultType), headers=body.headers(), data=body)
+		finally:
+			body.close()
+		if r.status_code == 200:
+			return json.loads(r.text)['resultId']
+		elif r.status_code in (404, 405):
+			logger.info("backend does not support binary result uploads")
+			self.resultArchives = False
+			return self._post_result_archive_encoded(runId, resultType, archivePath)
+		else:
+			logger.warning("Unable to post result archive for run %s: %s" % (runId, archivePath))
+			logger.debug("Response: %s" % r.text)
 			return None
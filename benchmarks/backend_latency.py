@@ -0,0 +1,55 @@
+#!/usr/bin/python
+''' Request latency of the Backend client against a local stand-in backend:
+	module-level requests calls (a new connection per request) vs. the pooled keep-alive session.
+'''
+import time
+import json
+import itertools
+import argparse
+
+import standin
+import requests
+
+from backend import Backend
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('-n', type=int, default=1000, help='requests per variant (defaults to 1000).')
+	parser.add_argument('--latency', type=float, default=0, help='simulated backend processing time (seconds).')
+	args = parser.parse_args()
+
+	ids = itertools.count()
+	server = standin.StandInServer([
+		('GET', r'^/jobs/getandsetworker/([^/]+)/device/([^/]+)$', lambda req, body, worker, udid: (204, None)),
+		('POST', r'^/jobs$', lambda req, body: (200, {'jobId': str(next(ids))})),
+	], latency=args.latency).start()
+
+	jobDict = {'type': 'run_app', 'state': 'pending', 'jobInfo': {'bundleId': 'com.example.app'}}
+	try:
+		variants = [
+			('requests.get/post (no pool)',
+				lambda: requests.get('%s/jobs/getandsetworker/w/device/d' % server.url),
+				lambda: requests.post('%s/jobs' % server.url, data=json.dumps(jobDict), headers=Backend.HEADERS)),
+		]
+		backend = Backend(server.url)
+		backend.workerId = 'w'
+		variants.append(('Backend session (pooled)',
+			lambda: backend.get_job_for_device('d'),
+			lambda: backend.post_job(jobDict)))
+
+		for name, get, post in variants:
+			connections = server.connections
+			durations = []
+			for i in xrange(args.n):
+				startTime = time.time()
+				get() if i % 2 else post()
+				durations.append(time.time() - startTime)
+			standin.report(name, durations)
+			print '%-28s %d connections' % ('', server.connections - connections)
+	finally:
+		server.stop()
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,53 @@
+#!/usr/bin/python
+''' Scheduling throughput of Scheduler.schedule_many() against a local stand-in backend:
+	one request per job (backends without /jobs/bulk) vs. bulk requests, posted sequentially and concurrently.
+'''
+import time
+import logging
+import itertools
+import argparse
+
+import standin
+
+from scheduler import Scheduler
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('-n', type=int, default=1000, help='jobs per variant (defaults to 1000).')
+	parser.add_argument('--batch-size', type=int, default=100, help='jobs per bulk request (defaults to 100).')
+	parser.add_argument('--concurrency', type=int, default=4, help='concurrent bulk requests (defaults to 4).')
+	parser.add_argument('--latency', type=float, default=0.02, help='simulated backend processing time per request (seconds, defaults to 0.02).')
+	args = parser.parse_args()
+	logging.getLogger('scheduler').setLevel(logging.WARNING)
+
+	ids = itertools.count()
+	bulkRoutes = [
+		('POST', r'^/jobs/bulk$', lambda req, body: (200, {'jobIds': list(str(next(ids)) for jobDict in body['jobs'])})),
+		('POST', r'^/jobs$', lambda req, body: (200, {'jobId': str(next(ids))})),
+	]
+	singleRoutes = bulkRoutes[1:]
+
+	variants = [
+		('single requests', singleRoutes, 1),
+		('bulk, sequential', bulkRoutes, 1),
+		('bulk, %d concurrent' % args.concurrency, bulkRoutes, args.concurrency),
+	]
+	for name, routes, concurrency in variants:
+		server = standin.StandInServer(routes, latency=args.latency).start()
+		scheduler = Scheduler(server.url, batchSize=args.batch_size, concurrency=concurrency)
+		try:
+			jobDicts = (scheduler._bundleId_job('com.example.app%d' % i, country='de') for i in xrange(args.n))
+			startTime = time.time()
+			stats = scheduler.schedule_many(jobDicts, skipScheduled=False)
+			duration = time.time() - startTime
+		finally:
+			# close the keep-alive connections before the server
+			scheduler.backend.reset_session()
+			server.stop()
+		print '%-28s %d jobs in %.2fs (%.0f jobs/s), %d requests, %d failed' % (name, stats['scheduled'],
+			duration, stats['scheduled'] / duration, server.requests, stats['failed'])
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,110 @@
+#!/usr/bin/python
+''' Discrete event simulation of the job dispatching of a worker: queueing time per priority class
+	with the FairShareQueue vs. first come first served.
+	Jobs of three classes arrive at random, one account submits half of them.
+	No backend or device is needed, the simulated time is passed to the queue.
+'''
+import heapq
+import random
+import argparse
+
+import standin
+
+from fairshare import FairShareQueue
+
+
+class FifoQueue(FairShareQueue):
+	''' first come first served, ignoring priorities and quotas (the dispatching without FairShareQueue) '''
+
+	def pop(self, udid=None, now=None):
+		if not self.jobs:
+			return None
+		claimed, device, jobDict = self.jobs.pop(0)
+		stats = self.latency[self.priority(jobDict)]
+		stats[0] += 1
+		stats[1] += now - claimed
+		return jobDict
+
+
+def jobs(args, rng):
+	''' yields (arrival time, jobDict) '''
+	rate = args.load * args.devices / args.duration
+	classes = [('high', 0.1), ('normal', 0.6), ('low', 0.3)]
+	now = 0.0
+	for i in xrange(args.jobs):
+		now += rng.expovariate(rate)
+		r = rng.random()
+		for priority, share in classes:
+			r -= share
+			if r < 0:
+				break
+		account = 'heavy' if rng.random() < 0.5 else 'account%d' % rng.randint(1, 20)
+		jobDict = {'_id': i, 'priority': priority, 'jobInfo': {'accountId': account, 'storeCountry': 'de'}}
+		if args.account_quota:
+			jobDict['quota'] = {'account': args.account_quota}
+		yield now, jobDict
+
+
+def simulate(queue, args):
+	''' returns the queueing times per priority class '''
+	# separate generators, thus every queue sees the same jobs
+	arrivals = jobs(args, random.Random(args.seed))
+	rng = random.Random(args.seed + 1)
+	# (time, event, udid or jobDict)
+	events = []
+	nextArrival = next(arrivals, None)
+	idle = list('device%d' % i for i in xrange(args.devices))
+	claimed = {}
+	waits = {}
+	now = 0.0
+	while nextArrival or events or len(queue):
+		if nextArrival and (not events or nextArrival[0] <= events[0][0]):
+			now, jobDict = nextArrival
+			claimed[jobDict['_id']] = now
+			queue.put(jobDict, now=now)
+			nextArrival = next(arrivals, None)
+		elif events:
+			now, udid = heapq.heappop(events)
+			queue.finished(udid)
+			idle.append(udid)
+		else:
+			# only deferred jobs are left, wait for their max. defer time
+			now += queue.MAX_DEFER_TIME
+		while idle:
+			# the simulated jobs are not bound to a device
+			jobDict = queue.pop(idle[-1], now=now)
+			if not jobDict:
+				break
+			udid = idle.pop()
+			queue.started(udid, jobDict)
+			waits.setdefault(jobDict['priority'], []).append(now - claimed.pop(jobDict['_id']))
+			heapq.heappush(events, (now + rng.expovariate(1.0 / args.duration), udid))
+	return waits
+
+
+def report(name, waits):
+	''' print mean and percentiles of the given queueing times (simulated seconds) '''
+	print '%-28s n=%-6d mean=%7.1fs  p50=%7.1fs  p95=%7.1fs  p99=%7.1fs' % (name, len(waits),
+		sum(waits) / max(len(waits), 1), standin.percentile(waits, 0.5),
+		standin.percentile(waits, 0.95), standin.percentile(waits, 0.99))
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('--jobs', type=int, default=20000, help='number of simulated jobs (defaults to 20000).')
+	parser.add_argument('--devices', type=int, default=10, help='number of devices (defaults to 10).')
+	parser.add_argument('--duration', type=float, default=120, help='mean job duration (seconds, defaults to 120).')
+	parser.add_argument('--load', type=float, default=0.95, help='arrival rate relative to the device capacity (defaults to 0.95).')
+	parser.add_argument('--account-quota', type=int, help='max. number of running jobs per account.')
+	parser.add_argument('--seed', type=int, default=1, help='random seed (defaults to 1).')
+	args = parser.parse_args()
+
+	for name, queueClass in [('first come first served', FifoQueue), ('fair share', FairShareQueue)]:
+		print name
+		waits = simulate(queueClass(), args)
+		for priority in FairShareQueue.CLASSES:
+			report('  %s' % priority, waits.get(priority, []))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,114 @@
+#!/usr/bin/python
+''' Throughput of the tcprelay SocketRelay over local socketpairs:
+	the ring buffer relay vs. the previous string buffer relay.
+	Data is written into one end of the relay and read from the other, no device is needed.
+'''
+import time
+import socket
+import select
+import threading
+import argparse
+
+import standin
+
+from python_client.tcprelay import SocketRelay
+
+
+class StringRelay(object):
+	''' the previous SocketRelay, buffering the data in (re-)concatenated strings '''
+	def __init__(self, a, b, maxbuf=65535):
+		self.a = a
+		self.b = b
+		self.atob = ""
+		self.btoa = ""
+		self.maxbuf = maxbuf
+	def handle(self):
+		while True:
+			rlist = []
+			wlist = []
+			xlist = [self.a, self.b]
+			if self.atob:
+				wlist.append(self.b)
+			if self.btoa:
+				wlist.append(self.a)
+			if len(self.atob) < self.maxbuf:
+				rlist.append(self.a)
+			if len(self.btoa) < self.maxbuf:
+				rlist.append(self.b)
+			rlo, wlo, xlo = select.select(rlist, wlist, xlist)
+			if xlo:
+				return
+			if self.a in wlo:
+				n = self.a.send(self.btoa)
+				self.btoa = self.btoa[n:]
+			if self.b in wlo:
+				n = self.b.send(self.atob)
+				self.atob = self.atob[n:]
+			if self.a in rlo:
+				s = self.a.recv(self.maxbuf - len(self.atob))
+				if not s:
+					return
+				self.atob += s
+			if self.b in rlo:
+				s = self.b.recv(self.maxbuf - len(self.btoa))
+				if not s:
+					return
+				self.btoa += s
+
+
+def _write(sock, total, chunk):
+	data = b'x' * chunk
+	sent = 0
+	while sent < total:
+		sock.sendall(data)
+		sent += len(data)
+	sock.shutdown(socket.SHUT_WR)
+
+def _read(sock, total, received):
+	buf = bytearray(256*1024)
+	while received[0] < total:
+		n = sock.recv_into(buf)
+		if not n:
+			break
+		received[0] += n
+
+def run(relayClass, total, bufsize):
+	''' relay `total` bytes, returns the elapsed seconds '''
+	src, relayA = socket.socketpair()
+	relayB, dst = socket.socketpair()
+	received = [0]
+	writer = threading.Thread(target=_write, args=(src, total, 64*1024))
+	reader = threading.Thread(target=_read, args=(dst, total, received))
+	relay = relayClass(relayA, relayB, bufsize)
+	relayThread = threading.Thread(target=relay.handle)
+	startTime = time.time()
+	for thread in (reader, relayThread, writer):
+		thread.start()
+	reader.join()
+	duration = time.time() - startTime
+	# the relay returns on the EOF of the writer
+	writer.join()
+	relayThread.join()
+	for sock in (src, relayA, relayB, dst):
+		sock.close()
+	if received[0] != total:
+		raise Exception('relayed %d of %d bytes' % (received[0], total))
+	return duration
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('--mb', type=int, default=20, help='MB relayed per run (defaults to 20).')
+	parser.add_argument('--bufsize', type=int, default=64, help='relay buffer size in KB (defaults to 64).')
+	parser.add_argument('-n', type=int, default=5, help='runs per variant (defaults to 5).')
+	args = parser.parse_args()
+
+	total = args.mb * 1024 * 1024
+	for name, relayClass in [('string buffers (previous)', StringRelay), ('ring buffers', SocketRelay)]:
+		durations = list(run(relayClass, total, args.bufsize * 1024) for i in xrange(args.n))
+		standin.report(name, durations)
+		print '%-28s %.0f MB/s (best run)' % ('', args.mb / min(durations))
+
+
+if __name__ == '__main__':
+	main()
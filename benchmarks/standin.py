@@ -0,0 +1,127 @@
+''' A local stand-in for the DiOS backend (and other http services) used by the benchmarks and tests.
+	Only the endpoints needed there are implemented, the handler of a route gets the request
+	handler and the parsed json body (or None) and returns a (status, jsonData) tuple.
+'''
+import os
+import sys
+import json
+import re
+import socket
+import threading
+import time
+import BaseHTTPServer
+import SocketServer
+
+# make the worker modules importable
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+	request_queue_size = 128
+
+	def handle_error(self, request, client_address):
+		# clients closing their keep-alive connections
+		pass
+
+
+class StandInServer(object):
+
+	def __init__(self, routes, latency=0):
+		''' routes: list of (method, regex, handler) tuples, a handler may return None
+			after writing the response itself (via the request handlers wfile)
+			latency: seconds every request is delayed (simulated processing time)
+		'''
+		self.routes = list((method, re.compile(pattern), handler) for method, pattern, handler in routes)
+		self.latency = latency
+		self.requests = 0
+		self.connections = 0
+		self._lock = threading.Lock()
+		server = self
+
+		class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+			# keep-alive
+			protocol_version = 'HTTP/1.1'
+			# send each response with a single write (avoids nagle/delayed ack stalls)
+			wbufsize = -1
+
+			def setup(self):
+				BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+				self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+				with server._lock:
+					server.connections += 1
+
+			def _handle(self, method):
+				with server._lock:
+					server.requests += 1
+				body = None
+				length = int(self.headers.getheader('Content-Length') or 0)
+				if length:
+					data = self.rfile.read(length)
+					try:
+						body = json.loads(data)
+					except ValueError:
+						body = data
+				if server.latency:
+					time.sleep(server.latency)
+				path = self.path.split('?')[0]
+				for routeMethod, pattern, handler in server.routes:
+					match = pattern.match(path)
+					if routeMethod == method and match:
+						result = handler(self, body, *match.groups())
+						break
+				else:
+					result = 404, {'error': 'not found'}
+				# None: the handler has written the response itself
+				if result is not None:
+					self._respond(*result)
+
+			def _respond(self, status, data):
+				payload = ''
+				if data is not None:
+					payload = json.dumps(data)
+				self.send_response(status)
+				self.send_header('Content-Type', 'application/json')
+				self.send_header('Content-Length', str(len(payload)))
+				self.end_headers()
+				self.wfile.write(payload)
+				self.wfile.flush()
+
+			def do_GET(self):
+				self._handle('GET')
+
+			def do_POST(self):
+				self._handle('POST')
+
+			def do_PUT(self):
+				self._handle('PUT')
+
+			def log_message(self, *args):
+				pass
+
+		self.httpd = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+		self.url = 'http://127.0.0.1:%d' % self.httpd.server_address[1]
+		self._thread = threading.Thread(target=self.httpd.serve_forever)
+		self._thread.daemon = True
+
+	def start(self):
+		self._thread.start()
+		return self
+
+	def stop(self):
+		self.httpd.shutdown()
+		self.httpd.server_close()
+
+
+def percentile(values, p):
+	values = sorted(values)
+	if not values:
+		return 0.0
+	return values[min(len(values) - 1, int(len(values) * p))]
+
+def report(name, durations):
+	''' print mean and percentiles of the given durations (seconds) in ms '''
+	print '%-28s n=%-6d mean=%7.2fms  p50=%7.2fms  p95=%7.2fms  p99=%7.2fms' % (name, len(durations),
+		1000 * sum(durations) / max(len(durations), 1), 1000 * percentile(durations, 0.5),
+		1000 * percentile(durations, 0.95), 1000 * percentile(durations, 0.99))
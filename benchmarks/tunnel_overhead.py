@@ -0,0 +1,130 @@
+#!/usr/bin/python
+''' Memory and context switches of the device tunnels: a process per device with a thread per
+	relayed connection (the previous DeviceServer) vs. the single poll loop of DeviceConnectionHandler.
+	Connections are local socketpairs, every connection exchanges request/response messages
+	like the pilot's HTTP requests, no device is needed. The resource usage of the relay
+	processes is measured with getrusage() and summed up.
+'''
+import time
+import socket
+import resource
+import threading
+import argparse
+from multiprocessing import Process, Queue
+
+import standin
+
+from python_client.tcprelay import SocketRelay
+from deviceconnection import Poller, RelayConnection
+
+
+def _usage():
+	usage = resource.getrusage(resource.RUSAGE_SELF)
+	# ru_maxrss in KB (linux)
+	return usage.ru_maxrss, usage.ru_nvcsw + usage.ru_nivcsw
+
+def _threaded_relays(pairs, results):
+	''' the previous DeviceServer of a single device: a thread per connection '''
+	threads = list(threading.Thread(target=SocketRelay(lsock, dsock).handle) for lsock, dsock in pairs)
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	results.put(_usage())
+
+def _poll_loop(pairs, results):
+	''' the relay loop of DeviceConnectionHandler for all connections '''
+	poller = Poller()
+	relays = {}
+	for lsock, dsock in pairs:
+		conn = RelayConnection(None, lsock, dsock)
+		for fd in conn.fds():
+			relays[fd] = conn
+			poller.register(fd, conn.interest(fd))
+	while relays:
+		for fd, events in poller.poll(1.0):
+			conn = relays.get(fd)
+			if not conn:
+				continue
+			if conn.handle(fd, events):
+				for connfd in conn.fds():
+					poller.modify(connfd, conn.interest(connfd))
+			else:
+				for connfd in conn.fds():
+					poller.unregister(connfd)
+					relays.pop(connfd)
+	poller.close()
+	results.put(_usage())
+
+
+def _recv(sock, size):
+	received = 0
+	while received < size:
+		n = len(sock.recv(size - received))
+		if not n:
+			raise Exception('connection closed')
+		received += n
+
+def run(variant, args):
+	''' returns (duration, max. rss in KB, context switches) summed over all relay processes '''
+	# (client, local relay side, device relay side, device) per connection and device
+	devices = []
+	for d in xrange(args.devices):
+		conns = []
+		for c in xrange(args.connections):
+			client, lsock = socket.socketpair()
+			dsock, device = socket.socketpair()
+			conns.append((client, lsock, dsock, device))
+		devices.append(conns)
+	results = Queue()
+	if variant == 'threads':
+		processes = list(Process(target=_threaded_relays, args=(list((l, d) for c, l, d, dev in conns), results)) for conns in devices)
+	else:
+		processes = [Process(target=_poll_loop, args=(list((l, d) for conns in devices for c, l, d, dev in conns), results))]
+	for process in processes:
+		process.start()
+
+	allConns = list(conn for conns in devices for conn in conns)
+	request = b'x' * args.request_size
+	response = b'y' * args.response_size
+	startTime = time.time()
+	for i in xrange(args.requests):
+		for client, lsock, dsock, device in allConns:
+			client.sendall(request)
+		for client, lsock, dsock, device in allConns:
+			_recv(device, len(request))
+			device.sendall(response)
+		for client, lsock, dsock, device in allConns:
+			_recv(client, len(response))
+	duration = time.time() - startTime
+	for client, lsock, dsock, device in allConns:
+		client.shutdown(socket.SHUT_WR)
+		device.shutdown(socket.SHUT_WR)
+
+	usages = list(results.get() for process in processes)
+	for process in processes:
+		process.join()
+	for conn in allConns:
+		for sock in conn:
+			sock.close()
+	return duration, sum(rss for rss, switches in usages), sum(switches for rss, switches in usages)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('--devices', type=int, default=40, help='number of devices (defaults to 40).')
+	parser.add_argument('--connections', type=int, default=4, help='concurrent connections per device (defaults to 4).')
+	parser.add_argument('--requests', type=int, default=200, help='requests per connection (defaults to 200).')
+	parser.add_argument('--request-size', type=int, default=512, help='request size in bytes (defaults to 512).')
+	parser.add_argument('--response-size', type=int, default=16*1024, help='response size in bytes (defaults to 16384).')
+	args = parser.parse_args()
+
+	for name, variant, processes in [('process per device, threads', 'threads', args.devices), ('single poll loop', 'poll', 1)]:
+		duration, rss, switches = run(variant, args)
+		requests = args.devices * args.connections * args.requests
+		print '%-30s %3d processes  %7.1f MB max. rss (sum)  %8d context switches  %6.0f requests/s' % (name,
+			processes, rss / 1024.0, switches, requests / duration)
+
+
+if __name__ == '__main__':
+	main()
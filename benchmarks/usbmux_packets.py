@@ -0,0 +1,109 @@
+#!/usr/bin/python
+''' Listener packet rate of the usbmux client against a fake usbmuxd (a unix socket in a temp dir):
+	a burst of device attach packets is sent and processed with MuxConnection.process(),
+	with exact-size reads (one recv per header/body, as before) and with readahead.
+'''
+import os
+import time
+import shutil
+import socket
+import struct
+import tempfile
+import plistlib
+import threading
+import argparse
+
+import standin
+
+from python_client.usbmux import MuxConnection, BinaryProtocol, PlistProtocol
+
+
+def _packet(version, resp, tag, payload):
+	return struct.pack("IIII", 16 + len(payload), version, resp, tag) + payload
+
+def _attached(protoclass, devid):
+	''' a device attach packet as sent by usbmuxd '''
+	if protoclass is BinaryProtocol:
+		payload = struct.pack("IH256sHI", devid, 0x12a8, 'serial%037d' % devid, 0, devid)
+		return _packet(0, BinaryProtocol.TYPE_DEVICE_ADD, 0, payload)
+	payload = plistlib.writePlistToString({'MessageType': 'Attached', 'DeviceID': devid,
+		'Properties': {'ProductID': 0x12a8, 'SerialNumber': 'serial%037d' % devid, 'LocationID': devid}})
+	return _packet(1, PlistProtocol.TYPE_PLIST, 0, payload)
+
+def _result(protoclass, tag):
+	if protoclass is BinaryProtocol:
+		return _packet(0, BinaryProtocol.TYPE_RESULT, tag, struct.pack("I", 0))
+	return _packet(1, PlistProtocol.TYPE_PLIST, tag, plistlib.writePlistToString({'MessageType': 'Result', 'Number': 0}))
+
+
+class FakeUSBMuxd(object):
+	''' accepts a single listener, answers its Listen request and sends the given packets '''
+
+	def __init__(self, path, protoclass, packets):
+		self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.server.bind(path)
+		self.server.listen(1)
+		self.protoclass = protoclass
+		self.packets = packets
+		self.thread = threading.Thread(target=self._serve)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def _recv(self, conn, size):
+		data = ''
+		while len(data) < size:
+			chunk = conn.recv(size - len(data))
+			if not chunk:
+				raise Exception('listener disconnected')
+			data += chunk
+		return data
+
+	def _serve(self):
+		conn, address = self.server.accept()
+		try:
+			length, version, req, tag = struct.unpack("IIII", self._recv(conn, 16))
+			self._recv(conn, length - 16)
+			conn.sendall(_result(self.protoclass, tag))
+			conn.sendall(''.join(self.packets))
+			# keep the connection open until the client is done
+			conn.recv(1)
+		finally:
+			conn.close()
+			self.server.close()
+
+
+def run(protoclass, count, readahead):
+	''' process `count` attach packets, returns the elapsed seconds '''
+	tmpDir = tempfile.mkdtemp()
+	try:
+		path = os.path.join(tmpDir, 'usbmuxd')
+		muxd = FakeUSBMuxd(path, protoclass, list(_attached(protoclass, devid) for devid in xrange(count)))
+		listener = MuxConnection(path, protoclass, readahead=readahead)
+		listener.listen()
+		startTime = time.time()
+		while len(listener.devices) < count:
+			listener.process(1.0)
+		duration = time.time() - startTime
+		listener.close()
+		muxd.thread.join()
+		return duration
+	finally:
+		shutil.rmtree(tmpDir)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('--packets', type=int, default=1000, help='attach packets per run (defaults to 1000).')
+	parser.add_argument('--plist', action='store_true', help='use the plist protocol (usbmuxd version 1).')
+	parser.add_argument('-n', type=int, default=5, help='runs per variant (defaults to 5).')
+	args = parser.parse_args()
+
+	protoclass = PlistProtocol if args.plist else BinaryProtocol
+	for name, readahead in [('exact-size reads', False), ('readahead', True)]:
+		durations = list(run(protoclass, args.packets, readahead) for i in xrange(args.n))
+		standin.report(name, durations)
+		print '%-28s %.0f packets/s (best run)' % ('', args.packets / min(durations))
+
+
+if __name__ == '__main__':
+	main()
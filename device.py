@@ -24,6 +24,8 @@ import plistlib
 import re
 import logging
 import os
+import time
+import threading
 
 from store import AppStore
 from enum import Enum
@@ -32,6 +34,175 @@ import deviceconnection
 
 logger = logging.getLogger('worker.'+__name__)
 
+
+class DeviceTelemetry(object):
+	''' Cached lockdown information of a device.
+
+		Every lockdown domain is cached with its own ttl. Stale domains are
+		queried together (one ideviceinfo process per domain, run concurrently),
+		optionally by a background thread, thus callers usually get cached values
+		without forking any process.
+	'''
+
+	# lockdown domain (None: base device info) and ttl in seconds
+	DOMAINS = {
+		'base': (None, 24*60*60),
+		'disk_usage': ('com.apple.disk_usage', 60),
+		'international': ('com.apple.international', 60*60),
+		'itunes_store': ('com.apple.mobile.iTunes.store', 60*60),
+	}
+	# refresh interval of the background thread (seconds)
+	REFRESH_INTERVAL = 30
+
+	def __init__(self, udid):
+		self.udid = udid
+		self._data = {}
+		self._updated = {}
+		self._lock = threading.Lock()
+		self._thread = None
+		self._stop = threading.Event()
+
+	def _command(self, domain):
+		cmd = ["ideviceinfo", "--xml", "--udid", self.udid]
+		if self.DOMAINS[domain][0]:
+			cmd.extend(["--domain", self.DOMAINS[domain][0]])
+		return cmd
+
+	def stale(self, domain):
+		updated = self._updated.get(domain)
+		return updated is None or time.time() - updated > self.DOMAINS[domain][1]
+
+	def refresh(self, domains=None):
+		''' query the given (default: all stale) domains concurrently '''
+		if domains is None:
+			domains = list(domain for domain in self.DOMAINS if self.stale(domain))
+		processes = {}
+		for domain in domains:
+			processes[domain] = subprocess.Popen(self._command(domain), stdout=subprocess.PIPE)
+		for domain, process in processes.iteritems():
+			output, unused_err = process.communicate()
+			if process.returncode != 0:
+				logger.warning("Querying %s of device %s failed (%s)" % (domain, self.udid, process.returncode))
+				continue
+			values = {}
+			if len(output) > 0:
+				try:
+					values = plistlib.readPlistFromString(output)
+				except Exception as e:
+					logger.warning("Unable to parse %s of device %s: %s" % (domain, self.udid, e))
+					continue
+			with self._lock:
+				self._data[domain] = values
+				self._updated[domain] = time.time()
+
+	def get(self, domain):
+		''' the (cached) values of a domain as dict '''
+		if self.stale(domain):
+			self.refresh([domain])
+		with self._lock:
+			return self._data.get(domain, {})
+
+	def invalidate(self, domain=None):
+		with self._lock:
+			if domain:
+				self._updated.pop(domain, None)
+			else:
+				self._updated.clear()
+
+	def snapshot(self):
+		''' all cached values and their age in seconds '''
+		now = time.time()
+		with self._lock:
+			return {
+				'udid': self.udid,
+				'domains': dict(self._data),
+				'age': dict((domain, now - updated) for domain, updated in self._updated.iteritems())
+			}
+
+	def _refresh_loop(self):
+		while not self._stop.is_set():
+			try:
+				self.refresh()
+			except Exception as e:
+				logger.warning("Refreshing telemetry of device %s failed: %s" % (self.udid, e))
+			self._stop.wait(self.REFRESH_INTERVAL)
+
+	def start(self):
+		''' refresh stale domains in a background thread '''
+		if self._thread and self._thread.is_alive():
+			return
+		self._stop.clear()
+		self._thread = threading.Thread(target=self._refresh_loop)
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		self._stop.set()
+
+
+class InstalledAppsIndex(object):
+	''' Cached index of the apps installed on a device.
+
+		The index is loaded on demand and kept until it is invalidated (e.g. by
+		our own installs/uninstalls) or older than MAX_AGE. Every reload computes
+		the difference to the previous snapshot.
+	'''
+
+	# apps may be installed by other means (e.g. the pilot), thus reload after a while (seconds)
+	MAX_AGE = 10*60
+
+	def __init__(self, loader):
+		self.loader = loader
+		self.apps = None
+		self.updated = None
+		self.lastDiff = None
+		self._lock = threading.Lock()
+
+	@staticmethod
+	def diff(old, new):
+		''' returns a dict with the added, removed and changed (other version) bundleIds '''
+		old = old or {}
+		new = new or {}
+		return {
+			'added': list(bundleId for bundleId in new if bundleId not in old),
+			'removed': list(bundleId for bundleId in old if bundleId not in new),
+			'changed': list(bundleId for bundleId in new if bundleId in old and new[bundleId].get('version') != old[bundleId].get('version'))
+		}
+
+	def refresh(self):
+		''' reload the index. returns the diff to the previous snapshot '''
+		apps = self.loader()
+		with self._lock:
+			self.lastDiff = self.diff(self.apps, apps)
+			if self.apps is not None and any(self.lastDiff.itervalues()):
+				logger.debug('installed apps changed: %s' % self.lastDiff)
+			self.apps = apps
+			self.updated = time.time()
+		return self.lastDiff
+
+	def invalidate(self):
+		with self._lock:
+			self.updated = None
+
+	def valid(self):
+		return self.updated is not None and time.time() - self.updated < self.MAX_AGE
+
+	def get(self, refresh=False):
+		if refresh or not self.valid():
+			self.refresh()
+		return self.apps
+
+	def __contains__(self, bundleId):
+		return bundleId in self.get()
+
+	def version(self, bundleId):
+		''' the installed version of the app or None if not installed '''
+		app = self.get().get(bundleId)
+		if app:
+			return app['version']
+		return None
+
+
 class iDevice(object):
 
 
@@ -52,9 +223,9 @@ class iDevice(object):
 
 	def __init__(self, udid):
 		self.udid = udid
-		self.deviceDict = {}
-		self.accountDict = {}
-		self.locale_val = ""
+		self.telemetry = DeviceTelemetry(udid)
+		self.apps = InstalledAppsIndex(self._list_installed_apps)
+		self.lastInstallDuration = None
 
 
 	def __str__(self):
@@ -66,10 +237,7 @@ class iDevice(object):
 	def device_info_dict(self):
 		''' raw device information as dict
 		'''
-		if (len(self.deviceDict) == 0):
-			output = subprocess.check_output(["ideviceinfo", "--xml", "--udid", self.udid])
-			self.deviceDict = plistlib.readPlistFromString(output)
-		return self.deviceDict
+		return self.telemetry.get('base')
 
 	DEVICE_INFO = Enum(['DeviceName', 'DeviceClass', 'ProductType', 'ProductVersion', 'WiFiAddress'])
 
@@ -82,9 +250,7 @@ class iDevice(object):
 	def locale(self):
 		''' the devices locale setting
 		'''
-		if (self.locale_val == ""):
-			self.locale_val = subprocess.check_output(["ideviceinfo", "--udid", self.udid, "--domain", "com.apple.international", "--key", "Locale"]).strip()
-		return self.locale_val
+		return self.telemetry.get('international').get('Locale', '')
 
 
 	def base_url(self):
@@ -100,14 +266,14 @@ class iDevice(object):
 
 ### more device informations
 	def free_bytes(self):
-		''' get the free space left on the device in bytes
+		''' get the free space left on the device in bytes, None if unknown
 		'''
-		output = subprocess.check_output(["ideviceinfo", "--udid", self.udid, "--domain", "com.apple.disk_usage", "--key", "TotalDataAvailable"])
-		free_bytes = 0
+		diskUsage = self.telemetry.get('disk_usage')
+		free_bytes = None
 		try:
-			free_bytes = long(output)
-		except ValueError:
-			logger.warning("Unable to get free space for device %s. Output: %s" % (self, output))
+			free_bytes = long(diskUsage['TotalDataAvailable'])
+		except (KeyError, ValueError):
+			logger.warning("Unable to get free space for device %s. Disk usage: %s" % (self, diskUsage))
 		return free_bytes
 
 
@@ -115,14 +281,10 @@ class iDevice(object):
 	def account_info_dict(self):
 		''' get raw account info from device as dict.
 		'''
-		if (len(self.accountDict) == 0):
-			output = subprocess.check_output(["ideviceinfo", "--xml", "--udid", self.udid, "--domain", "com.apple.mobile.iTunes.store", "--key", "KnownAccounts"])
-			if len(output) > 0:
-				self.accountDict = plistlib.readPlistFromString(output)
-			else:
-				logger.warning("No accounts found for device %s" % device)
-				self.accountDict = {}
-		return self.accountDict
+		accounts = self.telemetry.get('itunes_store').get('KnownAccounts', [])
+		if len(accounts) == 0:
+			logger.warning("No accounts found for device %s" % self)
+		return accounts
 
 	ACCOUNT_INFO = Enum({
 		'APPLE_ID':'AppleID',
@@ -165,9 +327,13 @@ class iDevice(object):
 		'ACCOUNT_ID':'ApplicationDSID'
 	})
 
-	def installed_apps(self):
-		''' list all installed apps as dict.
+	def installed_apps(self, refresh=False):
+		''' all installed apps as dict (bundleId -> appData).
+			The result is cached, use `refresh` to force reloading the list from the device.
 		'''
+		return self.apps.get(refresh)
+
+	def _list_installed_apps(self):
 		output = subprocess.check_output(["ideviceinstaller", "--udid", self.udid, "--list-apps", "-o", "list_user", "-o", "xml"])
 		if (len(output)==0):
 			return {}
@@ -220,16 +386,42 @@ class iDevice(object):
 			returns True or False
 		'''
 		result=True
+		output = ''
+		startTime = time.time()
 		try:
 			output = subprocess.check_output(["ideviceinstaller", "--udid", self.udid, "--install", app_archive_path])
 			logger.debug('output: %s' % output)
 			if (len(output)==0):
 				result=False
+			# ideviceinstaller reports failures via its output but exits with 0
+			elif 'ERROR' in output:
+				logger.error('installing app %s failed <output: %s>' % (app_archive_path, output))
+				result=False
 		except subprocess.CalledProcessError as e:
-			logger.error('installing app %s failed with: %s <output: %s>' % (app_archive_path, e, output))
+			logger.error('installing app %s failed with: %s <output: %s>' % (app_archive_path, e, e.output))
 			result=False
+		self.lastInstallDuration = time.time() - startTime
+		self.apps.invalidate()
 		return result
 
+	INSTALL_TIMEOUT = 180
+
+	def wait_for_app(self, bundleId, timeout=INSTALL_TIMEOUT):
+		''' wait until the app shows up in the list of installed apps.
+			The list is checked immediately and then with an exponential backoff.
+			returns True or False (timeout)
+		'''
+		deadline = time.time() + timeout
+		delay = 1
+		while True:
+			if bundleId in self.installed_apps(refresh=True):
+				return True
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				return False
+			time.sleep(min(delay, remaining))
+			delay = min(delay * 2, 30)
+
 	def uninstall(self, bundleId):
 		''' uninstall an app on the device from given bundleId
 			returns True or False
@@ -243,6 +435,7 @@ class iDevice(object):
 		except subprocess.CalledProcessError as e:
 			logger.error('uninstalling app %s failed with: %s <output: %s>' % (bundleId, e, output))
 			result=False
+		self.apps.invalidate()
 		return result
 
 	def archive(self, bundleId, app_archive_folder, app_only=True):
@@ -265,5 +458,6 @@ class iDevice(object):
 		except subprocess.CalledProcessError as e:
 			logger.error('archiving app %s failed with: %s <output: %s>', bundleId, e, output)
 			result=False
+		self.apps.invalidate()
 		return result
 
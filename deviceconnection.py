@@ -1,162 +1,467 @@
-import SocketServer
-import logging
-from multiprocessing import Process, Manager, Event, log_to_stderr
+import os
+import socket
+import select
+import errno
+import json
+import tempfile
+import time
+from multiprocessing import Process, Event, log_to_stderr
 
-from python_client import SocketRelay, ThreadedTCPServer, USBMux, MuxError
+from python_client import USBMux, MuxError
+from python_client.tcprelay import RingBuffer
 
 
 _LOGGER = log_to_stderr()
 _JOIN_TIMEOUT = 5
 
-class DeviceTCPRelay(SocketServer.BaseRequestHandler):
+# the pilots port on the device
+_DEVICE_PORT = 8080
+_RELAY_BUFSIZE = 128*1024
+# interval to publish the connection statistics (seconds)
+_STATS_INTERVAL = 1.0
+# max. time to wait for the device handler to become ready (seconds)
+_READY_TIMEOUT = 10
 
-	def handle(self):
-		if self.server.stopped():
-			return
 
-		if not self.server.muxdev:
-			_LOGGER.error("Device invalid")
-			self.request.close()
-			return
+class DeviceRegistry(object):
+	''' Read-mostly registry of the device tunnels, shared between processes via a file.
 
-		_LOGGER.debug("Connecting to device %s" % str(self.server.muxdev))
-		dsock = None
-		try:
-			dsock = self.server.mux.connect(self.server.muxdev, self.server.rport)
-		except MuxError:
-			_LOGGER.warning("Connection to device %s died!" % str(self.server.muxdev))
-			if self.request:
-				self.request.close()
-			return
-		lsock = self.request
-		_LOGGER.debug("Connection established, relaying data")
+		The handler process replaces the file atomically on every change. Readers
+		keep the parsed content and only reload it if the file was replaced, thus
+		a lookup costs a single stat() call.
+	'''
+
+	def __init__(self, path=None):
+		if path is None:
+			fd, path = tempfile.mkstemp(prefix='worker-devices-', suffix='.json')
+			os.close(fd)
+		self.path = path
+		self._data = {'devices': {}, 'stats': {}}
+		self._fileId = None
+		self.write(self._data)
+
+	def write(self, data):
+		tmpPath = '%s.%d' % (self.path, os.getpid())
+		f = open(tmpPath, 'w')
 		try:
-			fwd = SocketRelay(dsock, lsock)
-				#, self.server.bufsize * 1024)
-			fwd.handle()
+			json.dump(data, f)
 		finally:
-			dsock.close()
-			lsock.close()
-		_LOGGER.debug("Connection closed")
+			f.close()
+		os.rename(tmpPath, self.path)
 
+	def read(self):
+		try:
+			st = os.stat(self.path)
+		except OSError:
+			return self._data
+		fileId = (st.st_ino, st.st_mtime, st.st_size)
+		if fileId != self._fileId:
+			f = open(self.path, 'r')
+			try:
+				self._data = json.load(f)
+			except ValueError:
+				_LOGGER.warning("Invalid device registry: %s" % self.path)
+			finally:
+				f.close()
+			self._fileId = fileId
+		return self._data
 
+	def remove(self):
+		if os.path.exists(self.path):
+			os.remove(self.path)
 
-class DeviceServer(ThreadedTCPServer, Process):
-	
-	#causes handle_request to return
-	timeout = 1
-	
-	def __init__(self, mux, muxdevice, server_address, RequestHandlerClass):
-		Process.__init__(self)
-		ThreadedTCPServer.__init__(self, server_address, RequestHandlerClass)
-		self.mux = mux
-		self.muxdev = muxdevice
-		self._stop = Event()
 
-	def stop(self):
-		self._stop.set()
-		
-	def stopped(self):
-		return self._stop.is_set()
+class Poller(object):
+	''' minimal level-triggered poller. Uses epoll if available, select otherwise. '''
 
-	def run(self):
-		if self.stopped():
-			_LOGGER.warning("Thread already stopped")
-		
-		while not self.stopped():
-			self.handle_request()
-		self.socket.close()
-		_LOGGER.debug("%s will exit now" % (str(self)))
+	READ = 1
+	WRITE = 2
+
+	def __init__(self):
+		self._fds = {}
+		self._epoll = None
+		if hasattr(select, 'epoll'):
+			self._epoll = select.epoll()
+
+	def _epoll_mask(self, events):
+		mask = 0
+		if events & self.READ:
+			mask |= select.EPOLLIN
+		if events & self.WRITE:
+			mask |= select.EPOLLOUT
+		return mask
+
+	def register(self, fd, events):
+		self._fds[fd] = events
+		if self._epoll:
+			self._epoll.register(fd, self._epoll_mask(events))
+
+	def modify(self, fd, events):
+		if self._fds.get(fd) == events:
+			return
+		self._fds[fd] = events
+		if self._epoll:
+			self._epoll.modify(fd, self._epoll_mask(events))
+
+	def unregister(self, fd):
+		if self._fds.pop(fd, None) is not None and self._epoll:
+			self._epoll.unregister(fd)
+
+	def poll(self, timeout):
+		''' returns a list of (fd, events) tuples '''
+		result = []
+		if self._epoll:
+			for fd, mask in self._epoll.poll(timeout):
+				events = 0
+				# errors and hangups are reported as readable, recv() will fail or return EOF
+				if mask & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+					events |= self.READ
+				if mask & select.EPOLLOUT:
+					events |= self.WRITE
+				result.append((fd, events))
+			return result
+
+		rlist = list(fd for fd, events in self._fds.iteritems() if events & self.READ)
+		wlist = list(fd for fd, events in self._fds.iteritems() if events & self.WRITE)
+		rlo, wlo, xlo = select.select(rlist, wlist, [], timeout)
+		for fd in set(rlo) | set(wlo):
+			events = 0
+			if fd in rlo:
+				events |= self.READ
+			if fd in wlo:
+				events |= self.WRITE
+			result.append((fd, events))
+		return result
+
+	def close(self):
+		if self._epoll:
+			self._epoll.close()
+
+
+class RelayConnection(object):
+	''' a single relayed connection between a local client and the device '''
+
+	def __init__(self, muxdev, lsock, dsock, bufsize=_RELAY_BUFSIZE):
+		self.muxdev = muxdev
+		self.lsock = lsock
+		self.dsock = dsock
+		self.toDevice = RingBuffer(bufsize)
+		self.toLocal = RingBuffer(bufsize)
+		self.localEOF = False
+		self.deviceEOF = False
+		self.localShutdown = False
+		self.deviceShutdown = False
+		self.bytesToDevice = 0
+		self.bytesFromDevice = 0
+		for sock in (lsock, dsock):
+			sock.setblocking(0)
+
+	def fds(self):
+		return (self.lsock.fileno(), self.dsock.fileno())
+
+	def interest(self, fd):
+		''' the events to poll for on the given fd '''
+		events = 0
+		if fd == self.lsock.fileno():
+			inBuf, outBuf, eof = self.toDevice, self.toLocal, self.localEOF
+		else:
+			inBuf, outBuf, eof = self.toLocal, self.toDevice, self.deviceEOF
+		if not eof and inBuf.free():
+			events |= Poller.READ
+		if outBuf:
+			events |= Poller.WRITE
+		return events
+
+	def _forward_eof(self):
+		''' half-close the other side once all data of a closed side has been forwarded '''
+		if self.localEOF and not self.toDevice and not self.deviceShutdown:
+			self.dsock.shutdown(socket.SHUT_WR)
+			self.deviceShutdown = True
+		if self.deviceEOF and not self.toLocal and not self.localShutdown:
+			self.lsock.shutdown(socket.SHUT_WR)
+			self.localShutdown = True
+
+	def finished(self):
+		''' both sides have closed and all data has been forwarded '''
+		return self.localShutdown and self.deviceShutdown
+
+	def handle(self, fd, events):
+		''' process the poll events of one of the connections sockets.
+			returns False if the connection should be closed
+		'''
+		local = fd == self.lsock.fileno()
+		try:
+			if events & Poller.WRITE:
+				if local:
+					self.toLocal.send_to(self.lsock)
+				else:
+					self.bytesToDevice += self.toDevice.send_to(self.dsock)
+			if events & Poller.READ:
+				if local:
+					if not self.localEOF and self.toDevice.free():
+						self.localEOF = self.toDevice.recv_from(self.lsock) == 0
+				else:
+					if not self.deviceEOF and self.toLocal.free():
+						n = self.toLocal.recv_from(self.dsock)
+						self.bytesFromDevice += n
+						self.deviceEOF = n == 0
+			self._forward_eof()
+		except socket.error as e:
+			if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+				return True
+			_LOGGER.debug("Relay connection to %s failed: %s" % (str(self.muxdev), e))
+			return False
+		return not self.finished()
+
+	def close(self):
+		for sock in (self.lsock, self.dsock):
+			try:
+				sock.close()
+			except socket.error:
+				pass
 
 
 class DeviceConnectionHandler(Process):
-			
+	''' Serves a local TCP port for every connected device and relays all
+		connections to the devices pilot via usbmux.
+		All listening sockets, pending usbmux connects and relayed connections
+		are handled by a single poll loop within this process.
+	'''
+
 	def __init__(self):
 		super(DeviceConnectionHandler, self).__init__()
 		self._stop = Event()
-		self.manager = Manager()
-		
-		# devices: dont read that field after start() (will be empty)
-		self.devices = {}
-		# a managed dict to sync changes between threads
-		self.device_id_map = self.manager.dict()
-		
-		self.mux = USBMux()	
+		# set as soon as the initially connected devices are served
+		self.ready = Event()
+
+		# device tunnel addresses and connection statistics for all processes
+		self.registry = DeviceRegistry()
+
+		self.mux = USBMux()
+
+		# device serial -> tunnel address, only valid within the handler process
+		self.device_id_map = {}
+
+		# only valid within the handler process
+		self.poller = None
+		self.listeners = {}
+		# mux socket fd -> (MuxConnection, client socket, device) of connections waiting for the connect reply
+		self.connecting = {}
+		self.relays = {}
+		self.stats = {}
+		self.published = None
+
+
+	def _add_device(self, dev):
+		_LOGGER.info("New Device: %s" % str(dev))
+		lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		lsock.bind(('localhost', 0))
+		lsock.listen(16)
+		lsock.setblocking(0)
+		self.listeners[lsock.fileno()] = (lsock, dev)
+		self.poller.register(lsock.fileno(), Poller.READ)
+		self.stats[dev.serial] = {
+			'connections': 0,
+			'totalConnections': 0,
+			'bytesToDevice': 0,
+			'bytesFromDevice': 0
+		}
+		self.device_id_map[dev.serial] = lsock.getsockname()
+		self._publish()
+		_LOGGER.debug("Serving device %s via %s" % (str(dev), lsock.getsockname()))
+
+	def _remove_device(self, dev):
+		_LOGGER.info("Device gone: %s" % str(dev))
+		for fd, (lsock, ldev) in self.listeners.items():
+			if ldev == dev:
+				self.poller.unregister(fd)
+				lsock.close()
+				self.listeners.pop(fd)
+		for fd, (connector, csock, cdev) in self.connecting.items():
+			if cdev == dev:
+				self._close_connecting(fd)
+		for conn in set(self.relays.values()):
+			if conn.muxdev == dev:
+				self._close_relay(conn)
+		self.device_id_map.pop(dev.serial, None)
+		self.stats.pop(dev.serial, None)
+		self._publish()
+
+	def _sync_devices(self):
+		muxdevs = list(self.mux.devices)
+		served = set(dev for lsock, dev in self.listeners.itervalues())
+		for dev in muxdevs:
+			if dev not in served:
+				self._add_device(dev)
+		for dev in served:
+			if dev not in muxdevs:
+				self._remove_device(dev)
+
+	def _accept(self, lsock, dev):
+		try:
+			csock, addr = lsock.accept()
+		except socket.error as e:
+			if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+				_LOGGER.warning("Accepting connection for %s failed: %s" % (str(dev), e))
+			return
+		_LOGGER.debug("Connecting to device %s" % str(dev))
+		try:
+			# the relay is set up as soon as usbmuxd replies, see _connected()
+			connector = self.mux.start_connect(dev, _DEVICE_PORT)
+		except (MuxError, socket.error):
+			_LOGGER.warning("Connection to device %s died!" % str(dev))
+			csock.close()
+			return
+		fd = connector.socket.sock.fileno()
+		self.connecting[fd] = (connector, csock, dev)
+		self.poller.register(fd, Poller.READ)
+
+	def _connected(self, fd):
+		''' process the (partial) connect reply of usbmuxd '''
+		connector, csock, dev = self.connecting[fd]
+		try:
+			dsock = connector.finish_connect()
+		except (MuxError, socket.error) as e:
+			_LOGGER.warning("Connection to device %s died: %s" % (str(dev), e))
+			self._close_connecting(fd)
+			return
+		if dsock is None:
+			return
+		self.poller.unregister(fd)
+		self.connecting.pop(fd)
+		conn = RelayConnection(dev, csock, dsock)
+		for fd in conn.fds():
+			self.relays[fd] = conn
+			self.poller.register(fd, conn.interest(fd))
+		stats = self.stats[dev.serial]
+		stats['connections'] += 1
+		stats['totalConnections'] += 1
+		_LOGGER.debug("Connection established, relaying data")
+
+	def _close_connecting(self, fd):
+		connector, csock, dev = self.connecting.pop(fd)
+		self.poller.unregister(fd)
+		for sock in (connector.socket.sock, csock):
+			try:
+				sock.close()
+			except socket.error:
+				pass
+
+	def _close_relay(self, conn):
+		for fd in conn.fds():
+			self.poller.unregister(fd)
+			self.relays.pop(fd, None)
+		conn.close()
+		stats = self.stats.get(conn.muxdev.serial)
+		if stats:
+			stats['connections'] -= 1
+			stats['bytesToDevice'] += conn.bytesToDevice
+			stats['bytesFromDevice'] += conn.bytesFromDevice
+		_LOGGER.debug("Connection closed")
+
+	def _collect_stats(self):
+		allStats = {}
+		for serial, stats in self.stats.iteritems():
+			stats = dict(stats)
+			# include the traffic of open connections
+			for conn in set(self.relays.itervalues()):
+				if conn.muxdev.serial == serial:
+					stats['bytesToDevice'] += conn.bytesToDevice
+					stats['bytesFromDevice'] += conn.bytesFromDevice
+			allStats[serial] = stats
+		return allStats
+
+	def _publish(self):
+		data = {
+			'devices': self.device_id_map,
+			'stats': self._collect_stats()
+		}
+		if data != self.published:
+			self.registry.write(data)
+			self.published = data
 
 
 	def handle(self):
 		""" Start device handling. Will not return until calling stop() """
-				
+		self.poller = Poller()
+		muxfd = self.mux.listener.socket.sock.fileno()
+		self.poller.register(muxfd, Poller.READ)
+
 		if not self.mux.devices:
 			self.mux.process(1.0)
-		
+		self._sync_devices()
+		self._publish()
+		self.ready.set()
+
+		lastStats = 0
 		while not self.stopped():
-			muxdevs = self.mux.devices
-	#		print muxdevs
-	
-			#create new device handlers
-			for dev in muxdevs:
-				if dev not in self.devices:
-					_LOGGER.info("New Device: %s" % str(dev))
-					
-					# create device connection tunnel via usbmux
-					server = DeviceServer(self.mux, dev, ('localhost', 0), DeviceTCPRelay)
-					server.rport = 8080
-
-					server.start()
-					self.devices[dev] = server
-					self.device_id_map[dev.serial] = server.server_address
-					
-					_LOGGER.debug("Serving device %s via %s" % (str(dev), server.server_address))
-	
-					
-			#remove invalid devices
-			for dev in self.devices.keys():
-				if dev not in muxdevs:
-					_LOGGER.info("Device gone: %s" % str(dev))
-					_LOGGER.debug("Server: %s" % server)
-					server.stop()
-					server.join(_JOIN_TIMEOUT)
-					_LOGGER.debug("Server stopped: %s" % server)
-					self.devices.pop(dev)
-					self.device_id_map.pop(dev.serial)
-			
-			#check for new devices, ...
-			self.mux.process(0.1)
-			
-			
+			for fd, events in self.poller.poll(_STATS_INTERVAL):
+				if fd == muxfd:
+					#check for new devices, ...
+					self.mux.process(0)
+					self._sync_devices()
+				elif fd in self.listeners:
+					lsock, dev = self.listeners[fd]
+					self._accept(lsock, dev)
+				elif fd in self.connecting:
+					self._connected(fd)
+				elif fd in self.relays:
+					conn = self.relays[fd]
+					if conn.handle(fd, events):
+						for connfd in conn.fds():
+							self.poller.modify(connfd, conn.interest(connfd))
+					else:
+						self._close_relay(conn)
+
+			if time.time() - lastStats > _STATS_INTERVAL:
+				self._publish()
+				lastStats = time.time()
+
 
 	def stop(self):
 		self._stop.set()
-		
+
 	def stopped(self):
 		return self._stop.is_set()
 
 	def run(self):
 		self.handle()
-		
-		_LOGGER.debug("stopping device servers...")
-		for server in self.devices.itervalues():
-			server.stop()
-			server.join(_JOIN_TIMEOUT)
+
+		_LOGGER.debug("closing device connections...")
+		for fd in self.connecting.keys():
+			self._close_connecting(fd)
+		for conn in set(self.relays.values()):
+			self._close_relay(conn)
+		for lsock, dev in self.listeners.itervalues():
+			lsock.close()
+		self.poller.close()
+		self.registry.remove()
 		_LOGGER.debug("%s will exit now" % (str(self)))
-		
+
 	def device_connection_info(self, deviceUUID):
 		'''Returns a tuple of ip and port'''
-		if deviceUUID in self.device_id_map:
-				return self.device_id_map[deviceUUID]
+		devices = self.registry.read()['devices']
+		if deviceUUID in devices:
+			return tuple(devices[deviceUUID])
 		else:
 			return None
 
+	def device_statistics(self, deviceUUID):
+		'''Returns a dict with the number of open and total connections and the relayed bytes'''
+		return self.registry.read()['stats'].get(deviceUUID)
+
 
 _SHARED_DEVICE_HANDLER = None
 
 def shared_device_handler():
+	''' the device handler of this worker.
+		Start it in the worker process before forking device loops, thus all of them share it.
+	'''
 	global _SHARED_DEVICE_HANDLER
 	if not _SHARED_DEVICE_HANDLER:
-		_SHARED_DEVICE_HANDLER = DeviceConnectionHandler()	
+		_SHARED_DEVICE_HANDLER = DeviceConnectionHandler()
 		_SHARED_DEVICE_HANDLER.start()
-		import time
-		time.sleep(1)
+		if not _SHARED_DEVICE_HANDLER.ready.wait(_READY_TIMEOUT):
+			_LOGGER.warning("Device handler not ready after %ss" % _READY_TIMEOUT)
 	return _SHARED_DEVICE_HANDLER
-
@@ -0,0 +1,135 @@
+import logging
+import time
+
+from job import Job
+
+logger = logging.getLogger('worker.'+__name__)
+
+
+class FairShareQueue(object):
+	''' Claimed jobs waiting for a device of this worker.
+
+		Jobs are handed out by priority class (jobDict['priority'], see Job.PRIORITY) and,
+		within a class, to the account and store country with the fewest running jobs.
+		A job may limit the number of jobs running concurrently for its account and
+		country (jobDict['quota'] = {'account': n, 'country': n}), jobs exceeding
+		their quota are deferred up to MAX_DEFER_TIME.
+		Waiting jobs are promoted by one class every AGING_TIME, thus low priority
+		jobs are not starved by a steady stream of high priority jobs.
+		A job claimed for a device (or pinned to one by jobDict['device']) is only
+		handed to that device.
+	'''
+
+	CLASSES = [Job.PRIORITY.HIGH, Job.PRIORITY.NORMAL, Job.PRIORITY.LOW]
+	DEFAULT_PRIORITY = Job.PRIORITY.NORMAL
+	# seconds
+	AGING_TIME = 10*60
+	MAX_DEFER_TIME = 10*60
+
+	def __init__(self):
+		# (claimed, device udid or None, jobDict) tuples
+		self.jobs = []
+		# device udid -> (account, country) of the running jobs, oldest first.
+		# A pipelining device holds its next job while the current one is running.
+		self.running = {}
+		# priority class -> [dispatched jobs, summed queueing time]
+		self.latency = dict((cls, [0, 0.0]) for cls in self.CLASSES)
+
+	def __len__(self):
+		return len(self.jobs)
+
+	@classmethod
+	def priority(cls, jobDict):
+		priority = jobDict.get('priority', cls.DEFAULT_PRIORITY)
+		if priority not in cls.CLASSES:
+			priority = cls.DEFAULT_PRIORITY
+		return priority
+
+	@staticmethod
+	def share_keys(jobDict):
+		jobInfo = jobDict.get('jobInfo', {})
+		return jobInfo.get('accountId'), jobInfo.get('storeCountry')
+
+	@staticmethod
+	def pinned_device(jobDict):
+		device = jobDict.get('device')
+		if isinstance(device, dict):
+			device = device.get('udid')
+		return device
+
+	def put(self, jobDict, now=None, udid=None):
+		''' udid: the device the job was claimed for '''
+		self.jobs.append((now or time.time(), udid or self.pinned_device(jobDict), jobDict))
+
+	def remove_jobs(self, udid):
+		''' remove and return the queued jobs bound to a device '''
+		jobDicts = list(jobDict for claimed, device, jobDict in self.jobs if device == udid)
+		self.jobs = list(entry for entry in self.jobs if entry[1] != udid)
+		return jobDicts
+
+	def started(self, udid, jobDict):
+		self.running.setdefault(udid, []).append(self.share_keys(jobDict))
+
+	def finished(self, udid):
+		''' the oldest job of the device has finished (or was given up) '''
+		jobs = self.running.get(udid)
+		if jobs:
+			jobs.pop(0)
+		if not jobs:
+			self.running.pop(udid, None)
+
+	def removed(self, udid):
+		''' the device is gone, forget all its jobs '''
+		self.running.pop(udid, None)
+
+	def _usage(self):
+		accounts = {}
+		countries = {}
+		for jobs in self.running.itervalues():
+			for account, country in jobs:
+				accounts[account] = accounts.get(account, 0) + 1
+				countries[country] = countries.get(country, 0) + 1
+		return accounts, countries
+
+	def _over_quota(self, jobDict, accounts, countries):
+		quota = jobDict.get('quota') or {}
+		account, country = self.share_keys(jobDict)
+		if quota.get('account') and accounts.get(account, 0) >= quota['account']:
+			return True
+		if quota.get('country') and countries.get(country, 0) >= quota['country']:
+			return True
+		return False
+
+	def pop(self, udid=None, now=None):
+		''' remove and return the next job to execute on the device or None '''
+		now = now or time.time()
+		accounts, countries = self._usage()
+		best = None
+		bestKey = None
+		for index, (claimed, device, jobDict) in enumerate(self.jobs):
+			if device and device != udid:
+				continue
+			pinned = self.pinned_device(jobDict)
+			if pinned and pinned != udid:
+				continue
+			waited = now - claimed
+			if waited < self.MAX_DEFER_TIME and self._over_quota(jobDict, accounts, countries):
+				continue
+			account, country = self.share_keys(jobDict)
+			rank = max(0, self.CLASSES.index(self.priority(jobDict)) - int(waited / self.AGING_TIME))
+			key = (rank, accounts.get(account, 0), countries.get(country, 0), claimed)
+			if bestKey is None or key < bestKey:
+				best = index
+				bestKey = key
+		if best is None:
+			return None
+
+		claimed, device, jobDict = self.jobs.pop(best)
+		stats = self.latency[self.priority(jobDict)]
+		stats[0] += 1
+		stats[1] += now - claimed
+		return jobDict
+
+	def stats(self):
+		''' the number of dispatched jobs and their mean queueing time per priority class '''
+		return dict((cls, (count, total / count if count else 0.0)) for cls, (count, total) in self.latency.iteritems())
@@ -0,0 +1,135 @@
+import os
+import json
+import logging
+import time
+import requests
+
+from multiprocessing.pool import ThreadPool
+
+logger = logging.getLogger('scheduler.'+__name__)
+
+
+def itunes_feed_url(feed, country, limit, genre=None):
+	''' url of an iTunes RSS feed (e.g. topfreeapplications, newfreeapplications) '''
+	genrePath = ''
+	if genre:
+		genrePath = 'genre=%i/' % int(genre)
+	return 'https://itunes.apple.com/%s/rss/%s/limit=%i/%sjson' % (country, feed, limit, genrePath)
+
+
+class FeedWatcher(object):
+	''' Periodically fetches iTunes RSS feeds and schedules the apps that newly appeared.
+
+		Feeds are fetched concurrently using conditional requests (ETag/If-Modified-Since).
+		The ETag, Last-Modified and the bundleIds of every feed are stored in a state file,
+		thus a restarted watcher only schedules apps added in the meantime.
+		Apps that could not be scheduled are retried with the next poll.
+	'''
+
+	STATE_PATH = '/tmp/feedwatcher-state.json'
+	# fetch interval (seconds)
+	INTERVAL = 60*60
+	CONCURRENCY = 8
+	TIMEOUT = 30
+
+	def __init__(self, scheduler, feeds, interval=None, statePath=None, account=None, executionStrategy=None):
+		''' feeds: list of (url, storeCountry) tuples '''
+		self.scheduler = scheduler
+		self.feeds = feeds
+		self.interval = interval or self.INTERVAL
+		self.statePath = statePath or self.STATE_PATH
+		self.account = account
+		self.executionStrategy = executionStrategy
+		self.session = requests.Session()
+		self.state = {}
+		if os.path.exists(self.statePath):
+			with open(self.statePath, 'r') as f:
+				self.state = json.load(f)
+
+	def _save_state(self):
+		tmpPath = '%s.tmp' % self.statePath
+		with open(tmpPath, 'w') as f:
+			json.dump(self.state, f)
+		os.rename(tmpPath, self.statePath)
+
+	def _fetch(self, url):
+		''' fetch a feed if it changed.
+			returns a list of bundleIds or None if the feed is unchanged (or the request failed)
+		'''
+		feedState = self.state.get(url, {})
+		headers = {}
+		if feedState.get('etag'):
+			headers['If-None-Match'] = feedState['etag']
+		if feedState.get('lastModified'):
+			headers['If-Modified-Since'] = feedState['lastModified']
+		try:
+			r = self.session.get(url, headers=headers, timeout=self.TIMEOUT)
+		except requests.RequestException as e:
+			logger.error('Fetching feed %s failed: %s' % (url, e))
+			return None
+		if r.status_code == 304:
+			logger.debug('feed %s not modified' % url)
+			return None
+		if r.status_code != 200:
+			logger.error('Fetching feed %s failed: %s' % (url, r.status_code))
+			return None
+
+		feedState['etag'] = r.headers.get('ETag')
+		feedState['lastModified'] = r.headers.get('Last-Modified')
+		self.state[url] = feedState
+		entries = json.loads(r.text)['feed'].get('entry', [])
+		# a feed with a single entry is not wrapped in a list
+		if isinstance(entries, dict):
+			entries = [entries]
+		return list(entry['id']['attributes']['im:bundleId'] for entry in entries)
+
+	def poll(self):
+		''' fetch all feeds once and schedule the new entries.
+			returns the number of scheduled apps
+		'''
+		pool = ThreadPool(min(self.CONCURRENCY, len(self.feeds)))
+		try:
+			results = pool.map(lambda feed: self._fetch(feed[0]), self.feeds)
+		finally:
+			pool.close()
+			pool.join()
+
+		jobDicts = []
+		for (url, country), bundleIds in zip(self.feeds, results):
+			if bundleIds is None:
+				continue
+			previous = set(self.state[url].get('entries', []))
+			new = list(bundleId for bundleId in bundleIds if bundleId not in previous)
+			logger.info('%s: %d entries, %d new' % (url, len(bundleIds), len(new)))
+			for bundleId in new:
+				jobDicts.append(self.scheduler._bundleId_job(bundleId, account=self.account, country=country, executionStrategy=self.executionStrategy))
+
+		# (storeCountry, bundleId) of the jobs that failed
+		failed = set()
+		def onBatch(batch, jobIds):
+			for jobDict, jobId in zip(batch, jobIds):
+				if not jobId:
+					failed.add((jobDict['jobInfo'].get('storeCountry'), jobDict['jobInfo']['bundleId']))
+
+		scheduled = 0
+		if jobDicts:
+			scheduled = self.scheduler.schedule_many(jobDicts, onBatch=onBatch)['scheduled']
+
+		for (url, country), bundleIds in zip(self.feeds, results):
+			if bundleIds is not None:
+				entries = list(bundleId for bundleId in bundleIds if (country, bundleId) not in failed)
+				if len(entries) < len(bundleIds):
+					# refetch the feed next time, even if it is unchanged
+					self.state[url]['etag'] = None
+					self.state[url]['lastModified'] = None
+				self.state[url]['entries'] = entries
+		self._save_state()
+		return scheduled
+
+	def run(self):
+		''' poll the feeds every `interval` seconds until interrupted '''
+		while True:
+			startTime = time.time()
+			scheduled = self.poll()
+			logger.info('%d apps scheduled from %d feeds' % (scheduled, len(self.feeds)))
+			time.sleep(max(0, self.interval - (time.time() - startTime)))
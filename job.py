@@ -1,12 +1,12 @@
 
 import os
 import logging
-import base64
 import time
 
 from enum import Enum
 from store import AppStore, AppStoreException
 from pilot import Pilot
+from appcache import AppArchiveCache
 
 logger = logging.getLogger('worker.'+__name__)
 
@@ -18,6 +18,7 @@ class Job(object):
 
 	STATE = Enum([u'undefined', u'pending', u'running', u'finished', u'failed'])
 	TYPE = Enum([u'run_app', u'install_app', u'exec_cmd'])
+	PRIORITY = Enum([u'high', u'normal', u'low'])
 
 	def __init__(self, backend, device, jobDict):
 		self.jobDict = jobDict
@@ -28,6 +29,12 @@ class Job(object):
 		self.device = device
 		self.backend = backend
 
+	def prepare(self):
+		''' do the network work of the job (lookups, downloads) in advance.
+			Must not access the device, as it may run while another job is using it.
+		'''
+		pass
+
 	def execute(self):
 		raise NotImplementedError
 
@@ -37,9 +44,22 @@ class InstallAppJob(Job):
 
 	APP_ARCHIVE_PATH='/tmp/apparchive/'
 
+	# shared by all jobs of a process; the cache itself is shared host-wide
+	_archiveCache = None
+
 	def __init__(self, backend, device, jobDict):
 		super(InstallAppJob, self).__init__(backend, device, jobDict)
 		self.appId = None
+		# durations (seconds) of the install steps from backend
+		self.installTimings = {}
+		# results of prepare()
+		self.prepared = {}
+
+	@property
+	def archiveCache(self):
+		if InstallAppJob._archiveCache is None:
+			InstallAppJob._archiveCache = AppArchiveCache()
+		return InstallAppJob._archiveCache
 
 	def _archive_app_binary(self, bundleId):
 		logger.debug('archiving %s' % bundleId)
@@ -54,6 +74,57 @@ class InstallAppJob(Job):
 			raise JobExecutionError('unable to archive app binary: %s' % str(e))
 
 
+	def _archive_size(self, app):
+		size = 0
+		try:
+			size = int(app['fileSizeBytes'])
+		except ValueError:
+			size = -1
+		return size
+
+	def _fetch_app_archive(self, app, version, using=False):
+		''' get the archive of a backend app (via the archive cache)
+			returns the path of the archive or None, with `using` a context manager
+			yielding it and protecting the archive from eviction meanwhile
+		'''
+		appId = app['_id']
+		size = self._archive_size(app)
+		fetch = self.archiveCache.using if using else self.archiveCache.fetch
+		return fetch(appId, app.get('version', version),
+			lambda path: self.backend.get_app_archive(appId, path, expectedSize=max(size, 0)))
+
+	def _backend_app(self, bundleId, version):
+		if 'backendApp' in self.prepared:
+			return self.prepared['backendApp']
+		return self.backend.get_app_bundleId(bundleId, version)
+
+	def prepare(self):
+		''' look up the app in the backend and download its archive into the cache.
+			Apps unknown to the backend are looked up in the AppStore instead.
+		'''
+		jobInfo = self.jobDict.get('jobInfo', {})
+		if jobInfo.get('appType') != 'AppStoreApp' or 'bundleId' not in jobInfo:
+			return
+		bundleId = jobInfo['bundleId']
+		version = jobInfo.get('version')
+
+		app = self.backend.get_app_bundleId(bundleId, version)
+		self.prepared['backendApp'] = app
+		if app and '_id' in app:
+			if 'fileSizeBytes' in app:
+				logger.info('prefetching app archive of %s' % bundleId)
+				self._fetch_app_archive(app, version)
+			return
+
+		# results are kept in the store cache
+		store = AppStore(jobInfo.get('storeCountry', 'de'))
+		try:
+			trackId = store.get_trackId_for_bundleId(bundleId)
+			store.get_app_info(trackId)
+			store.get_app_data(trackId)
+		except AppStoreException as e:
+			logger.warning('prefetching appInfo of %s failed: %s' % (bundleId, e))
+
 	def _install_app(self, pilot):
 		''' try to install the app
 			will raise a JobExecutionError on failure
@@ -100,7 +171,7 @@ class InstallAppJob(Job):
 				alreadyInstalled = True
 
 			# check the backend for already existing app
-			app = self.backend.get_app_bundleId(bundleId, version)
+			app = self._backend_app(bundleId, version)
 			logger.debug('backend result for bundleId %s: %s' % (bundleId, app))
 			if app and '_id' in app:
 				self.appId = app['_id']
@@ -117,29 +188,31 @@ class InstallAppJob(Job):
 				
 				# dirty check for ipa-size < ~50MB
 				if app and 'fileSizeBytes' in app:
-					size = 0
-					try:
-						size = int(app['fileSizeBytes'])
-					except ValueError:
-						size = -1
+					size = self._archive_size(app)
 					if size > 0 or size < 40000000:
 						
 						# actually install from backend
 						logger.info('installing app %s from backend (size: %s)' % (bundleId,size))
-						if not os.path.exists(self.APP_ARCHIVE_PATH):
-							os.makedirs(self.APP_ARCHIVE_PATH)
-						appPath = '%s%s.ipa' % (self.APP_ARCHIVE_PATH, bundleId)
+						startTime = time.time()
 						
 						logger.debug('fetch app %s from backend' % bundleId)
-						if self.backend.get_app_archive(self.appId, appPath):							
-							logger.info('installing app %s via device handler' % bundleId)
-							self.device.install(appPath)
-							os.remove(appPath)
-							tries = 3
-							while tries > 0 and bundleId not in self.device.installed_apps():
-								tries = tries-1
-								time.sleep(60)
-							if bundleId in self.device.installed_apps():
+						with self._fetch_app_archive(app, version, using=True) as appPath:
+							if appPath:
+								logger.info('installing app %s via device handler' % bundleId)
+								self.installTimings['download'] = time.time() - startTime
+								installed = self.device.install(appPath)
+						if appPath:
+							self.installTimings['install'] = self.device.lastInstallDuration
+
+							# a failed install is checked only once
+							timeout = 0
+							if installed:
+								timeout = self.device.INSTALL_TIMEOUT
+							verifyTime = time.time()
+							found = self.device.wait_for_app(bundleId, timeout=timeout)
+							self.installTimings['verify'] = time.time() - verifyTime
+							logger.info('install timings for %s: %s' % (bundleId, ', '.join('%s: %.1fs' % t for t in self.installTimings.iteritems())))
+							if found:
 								return True
 							else:							
 								logging.warning('installing the app via device handler failed! - Install via AppStore instead')
@@ -198,7 +271,9 @@ class InstallAppJob(Job):
 				# install via appstore
 				logger.info('installing app %s via appstore' % bundleId)
 
-				if not pilot.install_appstore(appInfo, accountId, taskInfo={'backendUrl':self.backend.baseUrl}):
+				installed = pilot.install_appstore(appInfo, accountId, taskInfo={'backendUrl':self.backend.baseUrl})
+				self.device.apps.invalidate()
+				if not installed:
 					logger.error("App installation failed")
 					raise JobExecutionError("App installation failed")
 
@@ -216,6 +291,7 @@ class InstallAppJob(Job):
 		elif 'CydiaApp' == jobInfo['appType']:
 			logger.info('installing app %s via cydia' % bundleId)
 			pilot.install_cydia(bundleId)
+			self.device.apps.invalidate()
 			return True
 
 		else:
@@ -232,7 +308,7 @@ class InstallAppJob(Job):
 			backendJobData = self.backend.get_job(self.jobId)
 			## set job running
 			backendJobData['state'] = Job.STATE.RUNNING
-			self.backend.post_job(backendJobData)
+			self.backend.queue_job(backendJobData)
 	
 		pilot = Pilot(self.device.base_url())
 	
@@ -261,7 +337,7 @@ class InstallAppJob(Job):
 	
 		## set job finished
 		if self.jobId:
-			self.backend.post_job(backendJobData)
+			self.backend.queue_job(backendJobData)
 	
 		return result
 	
@@ -274,7 +350,20 @@ class RunAppJob(Job):
 	def __init__(self, backend, device, jobDict):
 		super(RunAppJob, self).__init__(backend, device, jobDict)
 		self.appId = None
+		self.installJob = None
+
+	def _install_job(self):
+		if not self.installJob:
+			installJobDict = {
+				'_id': False,
+				'jobInfo': self.jobDict['jobInfo']
+			}
+			self.installJob = InstallAppJob(self.backend, self.device, installJobDict)
+		return self.installJob
 
+	def prepare(self):
+		if 'jobInfo' in self.jobDict:
+			self._install_job().prepare()
 
 	def _install_app(self, pilot):
 		''' try to install the app
@@ -284,11 +373,7 @@ class RunAppJob(Job):
 
 		'''
 		logger.debug('_installApp')
-		installJobDict = {
-			'_id': False,
-			'jobInfo': self.jobDict['jobInfo']
-		}
-		installJob = InstallAppJob(self.backend, self.device, installJobDict)
+		installJob = self._install_job()
 		logger.debug('executing InstallJob')
 		if not installJob.execute():
 			logger.debug('Unable to install app')
@@ -329,14 +414,8 @@ class RunAppJob(Job):
 		if self.device.archive(bundleId, self.APP_ARCHIVE_PATH, app_only=False):
 			appPath = self.APP_ARCHIVE_PATH + bundleId + '.ipa'
 			if os.path.exists(appPath):
-				f = open(appPath, 'rb')
-				appData = f.read()
-				f.close()
-				try:
-					appData = base64.b64encode(appData)
-					self.backend.post_result(runId, 'app_archive', appData)
-				except TypeError:
-					logger.error('Unable to encode app archive!')
+				if not self.backend.post_result_archive(runId, 'app_archive', appPath):
+					logger.error('Unable to upload app archive!')
 
 				#delete app archive from disk
 				os.remove(appPath)
@@ -353,7 +432,7 @@ class RunAppJob(Job):
 		backendJobData = self.backend.get_job(self.jobId)
 		## set job running
 		backendJobData['state'] = Job.STATE.RUNNING
-		self.backend.post_job(backendJobData)
+		self.backend.queue_job(backendJobData)
 
 		pilot = Pilot(self.device.base_url())
 
@@ -389,17 +468,17 @@ class RunAppJob(Job):
 			# self._save_run_results(runId, bundleId, uninstallApp=installDone)
 
 			## set run finished
-			self.backend.post_run(self.appId, self.backend.RUN_STATE.FINISHED, runId=runId, executionStrategy=executionStrategy)
+			self.backend.queue_run(self.appId, self.backend.RUN_STATE.FINISHED, runId, executionStrategy=executionStrategy)
 
 		except JobExecutionError, e:
 			logger.error("Job execution failed: %s" % str(e))
 			backendJobData['state'] = Job.STATE.FAILED
-			self.backend.post_job(backendJobData)
+			self.backend.queue_job(backendJobData)
 			return False
 
 		## set job finished
 		backendJobData['state'] = Job.STATE.FINISHED
-		self.backend.post_job(backendJobData)
+		self.backend.queue_job(backendJobData)
 
 		return True
 
@@ -11,34 +11,75 @@ class PilotException(Exception):
 
 class Pilot(object):
 
-	_WAIT_SLEEP_TIME = 5
+	# adaptive polling: the interval starts at the minimum and is doubled up to the maximum (seconds)
+	_WAIT_MIN_SLEEP_TIME = 0.5
+	_WAIT_MAX_SLEEP_TIME = 5
+	# the pilot may hold /status?wait=<seconds> requests until the status changes
+	_WAIT_LONG_POLL_TIME = 20
 
-	def __init__(self, baseUrl):
+	def __init__(self, baseUrl, longPoll=True):
 		self.baseUrl = baseUrl.strip('/')
-
+		self.longPoll = longPoll
+		# duration (seconds) of the last task waited for
+		self.lastTaskDuration = None
+
+
+	def _get_status(self, wait=None):
+		params = None
+		timeout = 30
+		if wait:
+			params = {'wait': wait}
+			timeout += wait
+		r = requests.get('%s/status' % self.baseUrl, params=params, timeout=timeout)
+		if (r.status_code != 200):
+			raise PilotException('unable to get pilot status from device: %s' % r.text)
+		status = json.loads(r.text)
+		if 'taskRunning' not in status:
+			raise PilotException('Invalid Pilot status: %s' % r.text)
+		return status
 
 	def _wait_for_task_finished(self, taskInfo=None):
-		finished = False
-		while not finished:
-			r = requests.get('%s/status' % self.baseUrl)
-			if (r.status_code != 200):
-				raise PilotException('unable to get pilot status from device: %s' % r.text)
-			status = json.loads(r.text)
-			if 'taskRunning' not in status:
-				raise PilotException('Invalid Pilot status: %s' % r.text)
+		''' wait until the current task (or the one described by taskInfo) has finished.
+			Uses long polling if supported by the pilot, otherwise polls with an increasing interval.
+			returns the duration of the wait in seconds
+		'''
+		startTime = time.time()
+		sleepTime = Pilot._WAIT_MIN_SLEEP_TIME
+		wait = None
+		lastStatus = None
+		while True:
+			requestTime = time.time()
+			status = self._get_status(wait)
 
 			# check if finished
 			if status['taskRunning'] == False:
-				finished = True
+				break
 
 			# check if the next job is already running
 			elif taskInfo and status['taskInfo'] != taskInfo:
-				finished = True
-
-			else:
-				logger.debug('waiting for task to finish...')
-				time.sleep(Pilot._WAIT_SLEEP_TIME)
-		logger.info('task finished.')
+				break
+
+			if wait:
+				# a pilot without long poll support answers immediately with an unchanged status
+				if status == lastStatus and time.time() - requestTime < wait / 2.0:
+					logger.info('pilot does not support long polling, falling back to polling')
+					self.longPoll = False
+					wait = None
+				else:
+					lastStatus = status
+					continue
+			elif self.longPoll:
+				wait = Pilot._WAIT_LONG_POLL_TIME
+				lastStatus = status
+				continue
+
+			logger.debug('waiting for task to finish...')
+			time.sleep(sleepTime)
+			sleepTime = min(sleepTime * 2, Pilot._WAIT_MAX_SLEEP_TIME)
+
+		self.lastTaskDuration = time.time() - startTime
+		logger.info('task finished after %.1fs.' % self.lastTaskDuration)
+		return self.lastTaskDuration
 
 
 	def installed_applications(self):
@@ -114,8 +155,8 @@ class Pilot(object):
 			return False
 
 		## wait until the execution has finished
-		self._wait_for_task_finished(taskInfo=taskInfo)
-		logger.info('execution of %s finished', bundleId)
+		duration = self._wait_for_task_finished(taskInfo=taskInfo)
+		logger.info('execution of %s finished after %.1fs', bundleId, duration)
 		return True
 
 
@@ -25,12 +25,45 @@ from optparse import OptionParser
 import sys
 import threading
 
+class RingBuffer(object):
+	"""Fixed size byte ring buffer. Data is received into and sent from
+	the preallocated buffer via memoryviews, thus never copied in Python."""
+	def __init__(self, size):
+		self.size = size
+		self.buf = bytearray(size)
+		self.view = memoryview(self.buf)
+		self.start = 0
+		self.length = 0
+	def __len__(self):
+		return self.length
+	def free(self):
+		return self.size - self.length
+	def recv_from(self, sock):
+		"""Receive as much as fits into the contiguous free space. Returns the
+		number of bytes received, 0 on EOF."""
+		end = (self.start + self.length) % self.size
+		count = min(self.size - end, self.free())
+		n = sock.recv_into(self.view[end:end+count], count)
+		self.length += n
+		return n
+	def send_to(self, sock):
+		"""Send the contiguous part of the buffered data. Returns the number of
+		bytes sent."""
+		count = min(self.size - self.start, self.length)
+		n = sock.send(self.view[self.start:self.start+count])
+		self.length -= n
+		if self.length == 0:
+			self.start = 0
+		else:
+			self.start = (self.start + n) % self.size
+		return n
+
 class SocketRelay(object):
 	def __init__(self, a, b, maxbuf=65535):
 		self.a = a
 		self.b = b
-		self.atob = ""
-		self.btoa = ""
+		self.atob = RingBuffer(maxbuf)
+		self.btoa = RingBuffer(maxbuf)
 		self.maxbuf = maxbuf
 	def handle(self):
 		while True:
@@ -41,29 +74,23 @@ class SocketRelay(object):
 				wlist.append(self.b)
 			if self.btoa:
 				wlist.append(self.a)
-			if len(self.atob) < self.maxbuf:
+			if self.atob.free():
 				rlist.append(self.a)
-			if len(self.btoa) < self.maxbuf:
+			if self.btoa.free():
 				rlist.append(self.b)
 			rlo, wlo, xlo = select.select(rlist, wlist, xlist)
 			if xlo:
 				return
 			if self.a in wlo:
-				n = self.a.send(self.btoa)
-				self.btoa = self.btoa[n:]
+				self.btoa.send_to(self.a)
 			if self.b in wlo:
-				n = self.b.send(self.atob)
-				self.atob = self.atob[n:]
+				self.atob.send_to(self.b)
 			if self.a in rlo:
-				s = self.a.recv(self.maxbuf - len(self.atob))
-				if not s:
+				if not self.atob.recv_from(self.a):
 					return
-				self.atob += s
 			if self.b in rlo:
-				s = self.b.recv(self.maxbuf - len(self.btoa))
-				if not s:
+				if not self.btoa.recv_from(self.b):
 					return
-				self.btoa += s
 			#print "Relay iter: %8d atob, %8d btoa, lists: %r %r %r"%(len(self.atob), len(self.btoa), rlo, wlo, xlo)
 
 class TCPRelay(SocketServer.BaseRequestHandler):
@@ -18,7 +18,7 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
-import socket, struct, select, sys
+import socket, struct, select, sys, errno
 
 try:
 	import plistlib
@@ -26,6 +26,12 @@ try:
 except:
 	haveplist = False
 
+try:
+	import biplist
+	havebiplist = True
+except:
+	havebiplist = False
+
 class MuxError(Exception):
 	pass
 
@@ -33,9 +39,16 @@ class MuxVersionError(MuxError):
 	pass
 
 class SafeStreamSocket:
-	def __init__(self, address, family):
+	def __init__(self, address, family, readahead=False):
 		self.sock = socket.socket(family, socket.SOCK_STREAM)
 		self.sock.connect(address)
+		# with readahead, recv() reads as much as available and keeps the rest
+		# buffered, thus multiple packets are received with a single syscall.
+		# Must not be used for sockets that are handed over after connecting.
+		self.readahead = readahead
+		self.rbuf = bytearray()
+		self.chunk = bytearray(65536)
+		self.chunkview = memoryview(self.chunk)
 	def send(self, msg):
 		totalsent = 0
 		while totalsent < len(msg):
@@ -43,13 +56,34 @@ class SafeStreamSocket:
 			if sent == 0:
 				raise MuxError("socket connection broken")
 			totalsent = totalsent + sent
+	def pending(self):
+		return len(self.rbuf)
+	def fill(self, size):
+		# for non-blocking sockets: buffer the available data up to `size` bytes,
+		# returns True once `size` bytes are buffered
+		if len(self.rbuf) < size:
+			try:
+				n = self.sock.recv_into(self.chunkview, min(size - len(self.rbuf), len(self.chunk)))
+			except socket.error as e:
+				if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+					return False
+				raise
+			if n == 0:
+				raise MuxError("socket connection broken")
+			self.rbuf += self.chunkview[:n]
+		return len(self.rbuf) >= size
 	def recv(self, size):
-		msg = ''
-		while len(msg) < size:
-			chunk = self.sock.recv(size-len(msg))
-			if chunk == '':
+		while len(self.rbuf) < size:
+			if self.readahead:
+				want = len(self.chunk)
+			else:
+				want = min(size - len(self.rbuf), len(self.chunk))
+			n = self.sock.recv_into(self.chunkview, want)
+			if n == 0:
 				raise MuxError("socket connection broken")
-			msg = msg + chunk
+			self.rbuf += self.chunkview[:n]
+		msg = str(self.rbuf[:size])
+		del self.rbuf[:size]
 		return msg
 
 class MuxDevice(object):
@@ -120,10 +154,13 @@ class PlistProtocol(BinaryProtocol):
 	TYPE_DEVICE_REMOVE = "Detached" #???
 	TYPE_PLIST = 8
 	VERSION = 1
-	def __init__(self, socket):
+	def __init__(self, socket, binary=False):
 		if not haveplist:
 			raise Exception("You need the plistlib module")
+		if binary and not havebiplist:
+			raise Exception("You need the biplist module to send binary plists")
 		BinaryProtocol.__init__(self, socket)
+		self.binary = binary
 	
 	def _pack(self, req, payload):
 		return payload
@@ -137,16 +174,25 @@ class PlistProtocol(BinaryProtocol):
 			req = [self.TYPE_CONNECT, self.TYPE_LISTEN][req-2]
 		payload['MessageType'] = req
 		payload['ProgName'] = 'tcprelay'
-		BinaryProtocol.sendpacket(self, self.TYPE_PLIST, tag, plistlib.writePlistToString(payload))
+		if self.binary:
+			data = biplist.writePlistToString(payload, binary=True)
+		else:
+			data = plistlib.writePlistToString(payload)
+		BinaryProtocol.sendpacket(self, self.TYPE_PLIST, tag, data)
 	def getpacket(self):
 		resp, tag, payload = BinaryProtocol.getpacket(self)
 		if resp != self.TYPE_PLIST:
 			raise MuxError("Received non-plist type %d"%resp)
-		payload = plistlib.readPlistFromString(payload)
+		if payload.startswith("bplist00"):
+			if not havebiplist:
+				raise MuxError("Received binary plist, you need the biplist module")
+			payload = biplist.readPlistFromString(payload)
+		else:
+			payload = plistlib.readPlistFromString(payload)
 		return payload['MessageType'], tag, payload
 
 class MuxConnection(object):
-	def __init__(self, socketpath, protoclass):
+	def __init__(self, socketpath, protoclass, readahead=False):
 		self.socketpath = socketpath
 		if sys.platform in ['win32', 'cygwin']:
 			family = socket.AF_INET
@@ -154,7 +200,7 @@ class MuxConnection(object):
 		else:
 			family = socket.AF_UNIX
 			address = self.socketpath
-		self.socket = SafeStreamSocket(address, family)
+		self.socket = SafeStreamSocket(address, family, readahead)
 		self.proto = protoclass(self.socket)
 		self.pkttag = 1
 		self.devices = []
@@ -194,18 +240,52 @@ class MuxConnection(object):
 	def process(self, timeout=None):
 		if self.proto.connected:
 			raise MuxError("Socket is connected, cannot process listener events")
-		rlo, wlo, xlo = select.select([self.socket.sock], [], [self.socket.sock], timeout)
-		if xlo:
-			self.socket.sock.close()
-			raise MuxError("Exception in listener socket")
-		if rlo:
+		if not self.socket.pending():
+			rlo, wlo, xlo = select.select([self.socket.sock], [], [self.socket.sock], timeout)
+			if xlo:
+				self.socket.sock.close()
+				raise MuxError("Exception in listener socket")
+			if not rlo:
+				return
+		self._processpacket()
+		# handle all further packets received with the same read
+		while self._haspacket():
 			self._processpacket()
+	def _haspacket(self):
+		pending = self.socket.pending()
+		if pending < 4:
+			return False
+		dlen = struct.unpack("I", str(self.socket.rbuf[:4]))[0]
+		return pending >= dlen
 	def connect(self, device, port):
 		ret = self._exchange(self.proto.TYPE_CONNECT, {'DeviceID':device.devid, 'PortNumber':((port<<8) & 0xFF00) | (port>>8)})
 		if ret != 0:
 			raise MuxError("Connect failed: error %d"%ret)
 		self.proto.connected = True
 		return self.socket.sock
+	def start_connect(self, device, port):
+		# sends the connect request without waiting for the reply,
+		# call finish_connect() whenever the socket becomes readable
+		self.connecttag = self.pkttag
+		self.pkttag += 1
+		self.proto.sendpacket(self.proto.TYPE_CONNECT, self.connecttag, {'DeviceID':device.devid, 'PortNumber':((port<<8) & 0xFF00) | (port>>8)})
+		self.socket.sock.setblocking(0)
+	def finish_connect(self):
+		# reads the available part of the connect reply, returns the
+		# connected (non-blocking) socket or None if the reply is incomplete
+		if not self.socket.fill(4):
+			return None
+		dlen = struct.unpack("I", str(self.socket.rbuf[:4]))[0]
+		if not self.socket.fill(dlen):
+			return None
+		# the whole reply is buffered, nothing beyond it has been read
+		recvtag, data = self._getreply()
+		if recvtag != self.connecttag:
+			raise MuxError("Reply tag mismatch: expected %d, got %d"%(self.connecttag, recvtag))
+		if data['Number'] != 0:
+			raise MuxError("Connect failed: error %d"%data['Number'])
+		self.proto.connected = True
+		return self.socket.sock
 	def close(self):
 		self.socket.sock.close()
 
@@ -217,13 +297,13 @@ class USBMux(object):
 			else:
 				socketpath = "/var/run/usbmuxd"
 		self.socketpath = socketpath
-		self.listener = MuxConnection(socketpath, BinaryProtocol)
+		self.listener = MuxConnection(socketpath, BinaryProtocol, readahead=True)
 		try:
 			self.listener.listen()
 			self.version = 0
 			self.protoclass = BinaryProtocol
 		except MuxVersionError:
-			self.listener = MuxConnection(socketpath, PlistProtocol)
+			self.listener = MuxConnection(socketpath, PlistProtocol, readahead=True)
 			self.listener.listen()
 			self.protoclass = PlistProtocol
 			self.version = 1
@@ -233,6 +313,15 @@ class USBMux(object):
 	def connect(self, device, port):
 		connector = MuxConnection(self.socketpath, self.protoclass)
 		return connector.connect(device, port)
+	def start_connect(self, device, port):
+		# returns the MuxConnection, see MuxConnection.finish_connect()
+		connector = MuxConnection(self.socketpath, self.protoclass)
+		try:
+			connector.start_connect(device, port)
+		except:
+			connector.close()
+			raise
+		return connector
 
 if __name__ == "__main__":
 	mux = USBMux()
@@ -0,0 +1,84 @@
+import os
+import logging
+import hashlib
+import sqlite3
+import struct
+import threading
+import time
+
+logger = logging.getLogger('worker.'+__name__)
+
+
+class ScheduleIndex(object):
+	''' Persistent index of scheduled apps, used to skip apps that were scheduled recently.
+
+		Every bundleId/storeCountry/executionStrategy combination is stored as a 64 bit hash
+		(the sqlite rowid) and the time it was last scheduled, thus millions of keys need only a
+		few dozen MB. Hash collisions are possible but negligible (and only cause a skipped app).
+	'''
+
+	INDEX_PATH = '/tmp/scheduler-index.sqlite'
+	# entries older than this are removed (seconds)
+	MAX_AGE = 365*24*60*60
+
+	def __init__(self, path=None, maxAge=None):
+		self.path = path or self.INDEX_PATH
+		self.maxAge = maxAge or self.MAX_AGE
+		self._local = threading.local()
+
+	def __str__(self):
+		return "<ScheduleIndex: %s>" % self.path
+
+	@property
+	def conn(self):
+		# sqlite connections must not be shared with other threads or forked processes
+		local = self._local
+		if getattr(local, 'pid', None) != os.getpid():
+			conn = sqlite3.connect(self.path, timeout=30)
+			conn.execute('CREATE TABLE IF NOT EXISTS scheduled (key INTEGER PRIMARY KEY, scheduled REAL)')
+			conn.commit()
+			local.conn = conn
+			local.pid = os.getpid()
+		return local.conn
+
+	@staticmethod
+	def key(bundleId, country=None, executionStrategy=None):
+		''' the (signed) 64 bit hash of a combination '''
+		data = u'%s\x00%s\x00%s' % (bundleId, country or '', executionStrategy or '')
+		digest = hashlib.sha1(data.encode('utf-8')).digest()
+		return struct.unpack('<q', digest[:8])[0]
+
+	@classmethod
+	def job_key(cls, jobDict):
+		jobInfo = jobDict.get('jobInfo', {})
+		return cls.key(jobInfo.get('bundleId'), jobInfo.get('storeCountry'), jobInfo.get('executionStrategy'))
+
+
+	def last_scheduled(self, key):
+		''' returns the time the key was scheduled last or None '''
+		row = self.conn.execute('SELECT scheduled FROM scheduled WHERE key = ?', (key,)).fetchone()
+		if row:
+			return row[0]
+		return None
+
+	def recent(self, key, window):
+		''' True if the key was scheduled within the last `window` seconds '''
+		scheduled = self.last_scheduled(key)
+		return scheduled is not None and scheduled > time.time() - window
+
+	def add(self, keys, timestamp=None):
+		timestamp = timestamp or time.time()
+		with self.conn:
+			self.conn.executemany('INSERT OR REPLACE INTO scheduled (key, scheduled) VALUES (?, ?)',
+				((key, timestamp) for key in keys))
+
+	def remove(self, keys):
+		with self.conn:
+			self.conn.executemany('DELETE FROM scheduled WHERE key = ?', ((key,) for key in keys))
+
+	def evict(self):
+		''' remove entries older than `maxAge` '''
+		with self.conn:
+			count = self.conn.execute('DELETE FROM scheduled WHERE scheduled < ?', (time.time() - self.maxAge,)).rowcount
+		if count > 0:
+			logger.debug('evicted %d entries from %s' % (count, self.path))
@@ -2,9 +2,18 @@
 
 import logging
 import json
+import time
+import copy
+import os
+import csv
 import requests
 
+from multiprocessing.pool import ThreadPool
+
 from backend import Backend
+from scheduleindex import ScheduleIndex
+from feedwatcher import FeedWatcher, itunes_feed_url
+from store import AppStore, AppStoreException
 
 logging.basicConfig(level=logging.WARNING)
 
@@ -21,6 +30,73 @@ def dict_merge(first, second):
 	return first
 
 
+def read_records(path, fileFormat=None):
+	''' lazily read app records (dicts) from a csv file (with header) or a json lines file.
+		yields (index, record) tuples
+	'''
+	if not fileFormat:
+		fileFormat = 'jsonl' if os.path.splitext(path)[1].lower() in ('.jsonl', '.json') else 'csv'
+	f = open(path, 'rb')
+	try:
+		if fileFormat == 'csv':
+			records = csv.DictReader(f)
+		else:
+			records = (json.loads(line) for line in f if line.strip())
+		for index, record in enumerate(records):
+			yield index, record
+	finally:
+		f.close()
+
+
+class Checkpoint(object):
+	''' Progress of a scheduling run over an input file.
+		Stores the index of the last submitted record, thus an interrupted run can be resumed.
+		Records that could not be scheduled are appended to `<path>.failed` (json lines
+		with the record index), which can be scheduled again with another run.
+	'''
+
+	def __init__(self, path, inputPath):
+		self.path = path
+		self.inputPath = inputPath
+		self.failedPath = '%s.failed' % path
+		self.index = -1
+		self.scheduled = 0
+		self.failed = 0
+		if os.path.exists(path):
+			with open(path, 'r') as f:
+				data = json.load(f)
+			if data.get('input') == os.path.abspath(inputPath):
+				self.index = data['index']
+				self.scheduled = data['scheduled']
+				self.failed = data['failed']
+				logger.info('resuming after record %d (%d scheduled, %d failed)', self.index, self.scheduled, self.failed)
+			else:
+				logger.warning('ignoring checkpoint %s of another input file (%s)', path, data.get('input'))
+		if self.index < 0 and os.path.exists(self.failedPath):
+			os.remove(self.failedPath)
+
+	def add_failed(self, records):
+		''' records: (index, record) tuples, written before the checkpoint moves past them '''
+		with open(self.failedPath, 'a') as f:
+			for index, record in records:
+				f.write(json.dumps(dict(record, index=index)) + '\n')
+
+	def update(self, index, scheduled, failed):
+		self.index = index
+		self.scheduled += scheduled
+		self.failed += failed
+		data = {
+			'input': os.path.abspath(self.inputPath),
+			'index': self.index,
+			'scheduled': self.scheduled,
+			'failed': self.failed,
+		}
+		tmpPath = '%s.tmp' % self.path
+		with open(tmpPath, 'w') as f:
+			json.dump(data, f)
+		os.rename(tmpPath, self.path)
+
+
 class Scheduler(object):
 
 	# structure = {
@@ -31,6 +107,9 @@ class Scheduler(object):
 	# 	'worker': Worker,
 	# 	'device': Device,
 	# 	'date_added': float
+	# 	'priority': IS('high', 'normal', 'low'),
+	# 	'quota': dict
+	# 		account, country (max. concurrent jobs per worker)
 	# }
 
 	@classmethod
@@ -38,23 +117,144 @@ class Scheduler(object):
 		return {
 			'type':'run_app',
 			'state':'pending',
+			'priority':'normal',
 			'jobInfo': {
 				'appType':'AppStoreApp'
 			},
 		}
 
 
-	def __init__(self, backendUrl):
-		self.backend = Backend(backendUrl)
+	# number of jobs per bulk request
+	BATCH_SIZE = 100
+	# number of concurrent bulk requests
+	CONCURRENCY = 4
+
+	def __init__(self, backendUrl, batchSize=None, concurrency=None, scheduleIndex=None, skipWindow=None, queryBackend=False, priority=None, accountQuota=None, countryQuota=None):
+		''' scheduleIndex: ScheduleIndex recording all scheduled apps
+			skipWindow: skip apps scheduled within this period (seconds)
+			queryBackend: also ask the backend for recently added jobs of an app
+			priority: the priority class of the scheduled jobs
+			accountQuota/countryQuota: max. number of the jobs running concurrently per account/country on a worker
+		'''
+		self.jobDefaults = Scheduler._default_runjob()
+		if priority:
+			self.jobDefaults['priority'] = priority
+		if accountQuota:
+			self.jobDefaults.setdefault('quota', {})['account'] = accountQuota
+		if countryQuota:
+			self.jobDefaults.setdefault('quota', {})['country'] = countryQuota
+		self.batchSize = batchSize or self.BATCH_SIZE
+		self.concurrency = concurrency or self.CONCURRENCY
+		self.backend = Backend(backendUrl, poolSize=self.concurrency)
+		self.scheduleIndex = scheduleIndex
+		self.skipWindow = skipWindow
+		self.queryBackend = queryBackend
+		# number of jobs skipped as recently scheduled
+		self.skipped = 0
+		if self.scheduleIndex:
+			self.scheduleIndex.evict()
+
+	def _scheduled_recently(self, jobDict):
+		if not self.skipWindow:
+			return False
+		if self.scheduleIndex and self.scheduleIndex.recent(ScheduleIndex.job_key(jobDict), self.skipWindow):
+			return True
+		if self.queryBackend and self.backend.recentJobs:
+			jobInfo = jobDict.get('jobInfo', {})
+			return bool(self.backend.has_recent_job(jobInfo.get('bundleId'), jobInfo.get('storeCountry'),
+				jobInfo.get('executionStrategy'), since=time.time() - self.skipWindow))
+		return False
+
+	def _skip_scheduled(self, items, job=lambda item: item):
+		''' filter items whose job (see `job(item)`) was scheduled recently (or earlier in this iterable).
+			The schedule index is updated by schedule_many once the jobs are posted.
+		'''
+		# keys of the jobs passed on, the index does not know them before they are posted
+		keys = set()
+		for item in items:
+			jobDict = job(item)
+			if self.skipWindow:
+				key = ScheduleIndex.job_key(jobDict)
+				if key in keys or self._scheduled_recently(jobDict):
+					self.skipped += 1
+					logger.info('skipping recently scheduled app %s', jobDict['jobInfo']['bundleId'])
+					continue
+				keys.add(key)
+			yield item
 
 	def schedule_job(self, jobDict):
-		job = Scheduler._default_runjob()
-		job = dict_merge(job, jobDict)
+		''' returns the jobId, None on failure or False if the app was scheduled recently '''
+		job = dict_merge(copy.deepcopy(self.jobDefaults), jobDict)
+		if self._scheduled_recently(job):
+			self.skipped += 1
+			logger.info('skipping recently scheduled app %s', job['jobInfo']['bundleId'])
+			return False
 		jobId = self.backend.post_job(job)
+		if jobId and self.scheduleIndex:
+			self.scheduleIndex.add([ScheduleIndex.job_key(job)])
 		return jobId
 
 
-	def schedule_bundleId(self, bundleId, worker=None, device=None, account=None, country=None, executionStrategy=None):
+	def _post_batch(self, batch):
+		startTime = time.time()
+		try:
+			jobIds = self.backend.post_jobs(batch)
+		except requests.RequestException as e:
+			logger.error("Posting %d jobs failed: %s", len(batch), e)
+			jobIds = [None] * len(batch)
+		return jobIds, time.time() - startTime
+
+	def _batches(self, jobDicts):
+		batch = []
+		for jobDict in jobDicts:
+			batch.append(dict_merge(copy.deepcopy(self.jobDefaults), jobDict))
+			if len(batch) >= self.batchSize:
+				yield batch
+				batch = []
+		if batch:
+			yield batch
+
+	def schedule_many(self, jobDicts, onBatch=None, skipScheduled=True):
+		''' schedule the jobs of the given iterable in batches, `concurrency` batches are posted at once.
+			The iterable is consumed lazily, thus it may be a generator of arbitrary length.
+			onBatch(batch, jobIds) is called for every posted batch (in order).
+			returns a dict with the number of scheduled, failed and skipped jobs
+		'''
+		stats = {'batches': 0, 'scheduled': 0, 'failed': 0, 'skipped': self.skipped}
+		if skipScheduled:
+			jobDicts = self._skip_scheduled(jobDicts)
+		pool = ThreadPool(self.concurrency)
+		pending = []
+
+		def finish(batch, asyncResult):
+			jobIds, duration = asyncResult.get()
+			failed = jobIds.count(None)
+			stats['batches'] += 1
+			stats['scheduled'] += len(jobIds) - failed
+			stats['failed'] += failed
+			logger.info('batch %d: %d jobs scheduled, %d failed (%.2fs)', stats['batches'], len(jobIds) - failed, failed, duration)
+			if self.scheduleIndex:
+				self.scheduleIndex.add(list(ScheduleIndex.job_key(jobDict) for jobDict, jobId in zip(batch, jobIds) if jobId))
+			if onBatch:
+				onBatch(batch, jobIds)
+
+		try:
+			for batch in self._batches(jobDicts):
+				pending.append((batch, pool.apply_async(self._post_batch, (batch,))))
+				# bound the number of batches in memory
+				if len(pending) >= 2 * self.concurrency:
+					finish(*pending.pop(0))
+			while pending:
+				finish(*pending.pop(0))
+		finally:
+			pool.close()
+			pool.join()
+		stats['skipped'] = self.skipped - stats['skipped']
+		logger.info('%d jobs scheduled, %d failed, %d skipped', stats['scheduled'], stats['failed'], stats['skipped'])
+		return stats
+
+
+	def _bundleId_job(self, bundleId, worker=None, device=None, account=None, country=None, executionStrategy=None):
 		jobDict = {
 			'jobInfo': {
 				'bundleId':bundleId
@@ -70,23 +270,144 @@ class Scheduler(object):
 			jobDict['jobInfo']['storeCountry'] = country
 		if executionStrategy:
 			jobDict['jobInfo']['executionStrategy'] = executionStrategy
-		return self.schedule_job(jobDict)
+		return jobDict
+
+	def schedule_bundleId(self, bundleId, worker=None, device=None, account=None, country=None, executionStrategy=None):
+		return self.schedule_job(self._bundleId_job(bundleId, worker=worker, device=device, account=account, country=country, executionStrategy=executionStrategy))
 
 
 	def schedule_appId(self, appId, account=None, country=None, executionStrategy=None):
-		url = 'http://itunes.apple.com/lookup?id=%s' % appId
-		r = requests.get(url)
-		if r.status_code != 200:
-			logging.error("Requests to %s failed: %s", (url, r.text))
-			return False
+		return self.schedule_appIds([appId], account=account, country=country, executionStrategy=executionStrategy)
 
-		resDict = json.loads(r.text)
-		results = resDict['results']
-		if len(results) != 1:
-			logger.error("No app with id %s found", (appId))
+
+	def schedule_appIds(self, appIds, account=None, country=None, executionStrategy=None):
+		''' resolve the bundleIds of all given appIds (trackIds) with bulk lookups and schedule them '''
+		store = AppStore(country or 'us')
+		try:
+			apps = store.lookup_trackIds(appIds)
+		except AppStoreException as e:
+			logger.error("Lookup of %d appIds failed: %s", len(appIds), e)
 			return False
-		return self.schedule_bundleId(results[0]['bundleId'], account=account, country=country, executionStrategy=None)
 
+		result = True
+		jobDicts = []
+		for appId in appIds:
+			if int(appId) not in apps:
+				logger.error("No app with id %s found", appId)
+				result = False
+				continue
+			jobDicts.append(self._bundleId_job(apps[int(appId)]['bundleId'], account=account, country=country, executionStrategy=executionStrategy))
+		if len(jobDicts) == 1:
+			return self.schedule_job(jobDicts[0]) is not None and result
+		stats = self.schedule_many(jobDicts)
+		return stats['failed'] == 0 and result
+
+
+
+	def _record_jobs(self, records, account=None, country=None, executionStrategy=None, unresolved=None):
+		''' turn (index, record) tuples into (index, jobDict) tuples.
+			Records without bundleId are resolved via their appId/trackId in batches,
+			records that could not be resolved are appended to the `unresolved` list (in order).
+		'''
+		def resolve(chunk):
+			trackIds = {}
+			for index, record in chunk:
+				if not record.get('bundleId') and (record.get('appId') or record.get('trackId')):
+					try:
+						trackId = int(record.get('appId') or record.get('trackId'))
+					except (TypeError, ValueError):
+						continue
+					trackIds.setdefault(record.get('storeCountry') or country or 'us', []).append(trackId)
+			apps = {}
+			for storeCountry, ids in trackIds.iteritems():
+				try:
+					for trackId, app in AppStore(storeCountry).lookup_trackIds(ids).iteritems():
+						apps[(storeCountry, trackId)] = app
+				except AppStoreException as e:
+					logger.error("Lookup of %d appIds failed: %s", len(ids), e)
+
+			for index, record in chunk:
+				storeCountry = record.get('storeCountry') or country
+				bundleId = record.get('bundleId')
+				if not bundleId:
+					trackId = record.get('appId') or record.get('trackId')
+					try:
+						app = apps.get((storeCountry or 'us', int(trackId)))
+					except (TypeError, ValueError):
+						app = None
+					if not app:
+						logger.error("Unable to resolve record %d: %s", index, record)
+						if unresolved is not None:
+							unresolved.append((index, record))
+						continue
+					bundleId = app['bundleId']
+				yield index, self._bundleId_job(bundleId,
+					account=record.get('accountId') or account,
+					country=storeCountry,
+					executionStrategy=record.get('executionStrategy') or executionStrategy)
+
+		chunk = []
+		for item in records:
+			chunk.append(item)
+			if len(chunk) >= self.batchSize:
+				for job in resolve(chunk):
+					yield job
+				chunk = []
+		for job in resolve(chunk):
+			yield job
+
+
+	def schedule_file(self, path, fileFormat=None, checkpointPath=None, account=None, country=None, executionStrategy=None):
+		''' schedule all apps listed in a csv or json lines file.
+			Records need a bundleId or an appId/trackId, storeCountry, accountId and executionStrategy are optional.
+			The file is read lazily and the progress is written to a checkpoint file after every batch.
+		'''
+		checkpoint = Checkpoint(checkpointPath or '%s.checkpoint' % path, path)
+		records = ((index, record) for index, record in read_records(path, fileFormat) if index > checkpoint.index)
+
+		# indices of the submitted jobs, in order
+		indices = []
+		# (index, record) tuples of the records that could not be resolved, in order
+		unresolved = []
+		def jobs():
+			recordJobs = self._record_jobs(records, account=account, country=country, executionStrategy=executionStrategy, unresolved=unresolved)
+			for index, jobDict in self._skip_scheduled(recordJobs, job=lambda item: item[1]):
+				indices.append(index)
+				yield jobDict
+
+		def unresolvedUpTo(lastIndex):
+			count = 0
+			while count < len(unresolved) and unresolved[count][0] <= lastIndex:
+				count += 1
+			failedRecords = unresolved[:count]
+			del unresolved[:count]
+			return failedRecords
+
+		def onBatch(batch, jobIds):
+			batchIndices = indices[:len(batch)]
+			del indices[:len(batch)]
+			failedRecords = []
+			for index, jobDict, jobId in zip(batchIndices, batch, jobIds):
+				if not jobId:
+					logger.error("Unable to schedule %s", jobDict['jobInfo']['bundleId'])
+					jobInfo = jobDict['jobInfo']
+					failedRecords.append((index, dict((key, jobInfo[key]) for key in ('bundleId', 'storeCountry', 'accountId', 'executionStrategy') if key in jobInfo)))
+			scheduled = len(batch) - len(failedRecords)
+			failedRecords = sorted(unresolvedUpTo(batchIndices[-1]) + failedRecords)
+			if failedRecords:
+				checkpoint.add_failed(failedRecords)
+			checkpoint.update(batchIndices[-1], scheduled, len(failedRecords))
+
+		self.schedule_many(jobs(), onBatch=onBatch, skipScheduled=False)
+		# records after the last posted batch
+		if unresolved:
+			failedRecords = unresolvedUpTo(unresolved[-1][0])
+			checkpoint.add_failed(failedRecords)
+			checkpoint.update(max(failedRecords[-1][0], checkpoint.index), 0, len(failedRecords))
+		logger.info('%s: %d jobs scheduled, %d failed (in total)', path, checkpoint.scheduled, checkpoint.failed)
+		if checkpoint.failed:
+			logger.warning('the failed records are listed in %s, schedule them again with --file %s --file-format jsonl', checkpoint.failedPath, checkpoint.failedPath)
+		return checkpoint.failed == 0
 
 
 	def schedule_itunes(self, url, account=None, country=None, executionStrategy=None):
@@ -98,11 +419,9 @@ class Scheduler(object):
 
 		resDict = json.loads(r.text)
 		entries = resDict['feed']['entry']
-		result = True
-		for entry in entries:
-			if not self.schedule_bundleId(entry['id']['attributes']['im:bundleId'], account=account, country=country, executionStrategy=None):
-				result = False
-		return result
+		jobDicts = (self._bundleId_job(entry['id']['attributes']['im:bundleId'], account=account, country=country, executionStrategy=None) for entry in entries)
+		stats = self.schedule_many(jobDicts)
+		return stats['failed'] == 0
 
 
 
@@ -114,22 +433,44 @@ def main():
 	parser.add_argument('-a','--account', help='the accountId to use.')
 	
 	parser.add_argument('-s','--strategy', help='the execution strategy and duration to use.')
+	parser.add_argument('--batch-size', type=int, metavar='n', help='number of jobs per backend request (defaults to %d).' % Scheduler.BATCH_SIZE)
+	parser.add_argument('--concurrency', type=int, metavar='n', help='number of concurrent backend requests (defaults to %d).' % Scheduler.CONCURRENCY)
+	parser.add_argument('--priority', choices=['high', 'normal', 'low'], help='the priority class of the jobs (defaults to normal).')
+	parser.add_argument('--account-quota', type=int, metavar='n', help='max. number of these jobs running concurrently per account on a worker.')
+	parser.add_argument('--country-quota', type=int, metavar='n', help='max. number of these jobs running concurrently per store country on a worker.')
+	parser.add_argument('--skip-scheduled-days', type=float, metavar='n', help='skip apps scheduled (with the same country and strategy) within the last n days.')
+	parser.add_argument('--query-backend', action='store_true', help='also ask the backend for recently scheduled apps (with --skip-scheduled-days).')
+	parser.add_argument('--schedule-index', metavar='path', help='the index of scheduled apps (defaults to %s).' % ScheduleIndex.INDEX_PATH)
 	
 	# add commands
 	cmdGroup = parser.add_argument_group('datasources', 'choose the datasource to take the app(s) from')
 	mutalCmds = cmdGroup.add_mutually_exclusive_group(required=True)
 	mutalCmds.add_argument('--bundleId', metavar='com.company.app', help='just schedule a given bundleId.')
 	mutalCmds.add_argument('--appId', type=int, metavar='trackId', help='the apps appstore id')
+	mutalCmds.add_argument('--file', metavar='path', help='schedule all apps of a csv (with bundleId or appId column) or json lines file.')
 	mutalCmds.add_argument('--itunes-top', type=int, default=10, nargs='?', metavar='n', help='use the top N free apps (defaults to 10)')
 	mutalCmds.add_argument('--itunes-new', type=int, default=10, nargs='?', metavar='n', help='use the top N new (and free) apps (defaults to 10)')
+	cmdGroup.add_argument('--file-format', choices=['csv', 'jsonl'], help='format of the --file (defaults to the file extension).')
+	cmdGroup.add_argument('--checkpoint', metavar='path', help='checkpoint file of --file runs, an interrupted run is resumed from it (defaults to <file>.checkpoint). Records that could not be scheduled are written to <checkpoint>.failed.')
 	cmdGroup.add_argument('--itunes-genre', type=int, metavar='id', help='use the given genre only (defaults to all)')
 	cmdGroup.add_argument('--itunes-country', type=str, default="de", nargs='?', metavar='countryCode', help='the store country to use (defaults to "de")')
 
+	watchGroup = parser.add_argument_group('watcher', 'keep watching the iTunes feed and schedule newly appeared apps')
+	watchGroup.add_argument('--watch', type=float, metavar='minutes', help='fetch the --itunes-top/--itunes-new feeds every n minutes.')
+	watchGroup.add_argument('--watch-countries', metavar='de,us,...', help='the store countries to watch (defaults to --itunes-country).')
+	watchGroup.add_argument('--watch-genres', metavar='id,id,...', help='the genres to watch (defaults to --itunes-genre).')
+	watchGroup.add_argument('--watch-state', metavar='path', help='the state file of the watcher (defaults to %s).' % FeedWatcher.STATE_PATH)
+
 
 	args = parser.parse_args()
 #	logger.debug(args)
 
-	scheduler = Scheduler(args.backend)
+	skipWindow = None
+	if args.skip_scheduled_days:
+		skipWindow = args.skip_scheduled_days*24*60*60
+	scheduler = Scheduler(args.backend, batchSize=args.batch_size, concurrency=args.concurrency,
+		scheduleIndex=ScheduleIndex(args.schedule_index), skipWindow=skipWindow, queryBackend=args.query_backend,
+		priority=args.priority, accountQuota=args.account_quota, countryQuota=args.country_quota)
 
 	def printRes(res):
 		if res:
@@ -147,18 +488,37 @@ def main():
 		printRes(res)
 		return
 
-	genre = ''
-	if args.itunes_genre:
-		genre = 'genre=%i' % args.itunes_genre
+	if 'file' in args and args.file:
+		res = scheduler.schedule_file(args.file, fileFormat=args.file_format, checkpointPath=args.checkpoint, account=args.account, country=args.itunes_country, executionStrategy=args.strategy)
+		printRes(res)
+		return
 
+	feed = None
+	limit = None
 	if 'itunes_top' in args and args.itunes_top:
-		url = 'https://itunes.apple.com/%s/rss/topfreeapplications/limit=%i/genre=%s/json' % (args.itunes_country, args.itunes_top, genre)
-		res = scheduler.schedule_itunes(url, account=args.account, country=args.itunes_country, executionStrategy=args.strategy)
-		printRes(res)
+		feed = 'topfreeapplications'
+		limit = args.itunes_top
+	elif 'itunes_new' in args and args.itunes_new:
+		feed = 'newfreeapplications'
+		limit = args.itunes_new
+
+	if feed and args.watch:
+		countries = [args.itunes_country]
+		if args.watch_countries:
+			countries = args.watch_countries.split(',')
+		genres = [args.itunes_genre]
+		if args.watch_genres:
+			genres = list(int(genre) for genre in args.watch_genres.split(','))
+		feeds = list((itunes_feed_url(feed, country, limit, genre), country) for country in countries for genre in genres)
+		watcher = FeedWatcher(scheduler, feeds, interval=args.watch*60, statePath=args.watch_state, account=args.account, executionStrategy=args.strategy)
+		try:
+			watcher.run()
+		except KeyboardInterrupt:
+			logger.info('stopped watching')
 		return
 
-	if 'itunes_new' in args and args.itunes_new:
-		url = 'https://itunes.apple.com/%s/rss/newfreeapplications/limit=%i/genre=%s/json' % (args.itunes_country, args.itunes_new, genre)
+	if feed:
+		url = itunes_feed_url(feed, args.itunes_country, limit, args.itunes_genre)
 		res = scheduler.schedule_itunes(url, account=args.account, country=args.itunes_country, executionStrategy=args.strategy)
 		printRes(res)
 		return
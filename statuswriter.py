@@ -0,0 +1,262 @@
+import os
+import errno
+import json
+import logging
+import threading
+import time
+import copy
+
+from backend import jd, RequestRejected
+
+logger = logging.getLogger('worker.'+__name__)
+
+
+class StatusWriter(threading.Thread):
+	''' Posts job, run and result updates in the background.
+
+		Updates are appended to a local spool file before they are queued, thus
+		they survive a worker restart. Pending updates of the same job or run are
+		coalesced (the latest state wins) and sent as batch request if supported
+		by the backend. Failed requests are retried with an exponential backoff,
+		updates the backend rejects (4xx) are logged and dropped.
+
+		Spool format: one json object per line, either
+			{'op': 'put', 'seq': n, 'kind': 'job'|'run'|'result', 'data': {...}}
+			{'op': 'ack', 'seq': [n, ...]}
+	'''
+
+	SPOOL_PATH = '/tmp/worker-spool/'
+	BATCH_SIZE = 20
+	MIN_RETRY_INTERVAL = 1
+	MAX_RETRY_INTERVAL = 300
+
+	PATHS = {
+		'job': '/jobs',
+		'run': '/runs',
+		'result': '/results'
+	}
+
+	def __init__(self, backend, name):
+		super(StatusWriter, self).__init__()
+		self.daemon = True
+		self.backend = backend
+		self.spoolPath = '%s%s.jsonl' % (self.SPOOL_PATH, name)
+		# key -> (seqs, kind, data), sent in the order of `_order`
+		self._pending = {}
+		self._order = []
+		self._seq = 0
+		self._lock = threading.Condition()
+		self._stop = threading.Event()
+		self.retryInterval = self.MIN_RETRY_INTERVAL
+
+		try:
+			os.makedirs(self.SPOOL_PATH)
+		except OSError as e:
+			# created concurrently by another device loop
+			if e.errno != errno.EEXIST:
+				raise
+		self._replay_spool()
+		self._spool = open(self.spoolPath, 'a')
+
+
+	def stop(self):
+		self._stop.set()
+		with self._lock:
+			self._lock.notify_all()
+
+	def stopped(self):
+		return self._stop.is_set()
+
+
+	@staticmethod
+	def _key(kind, data, seq):
+		if kind == 'job' and '_id' in data:
+			return ('job', data['_id'])
+		if kind == 'run' and '_id' in data:
+			return ('run', data['_id'])
+		return (kind, seq)
+
+	def _add(self, seq, kind, data):
+		key = self._key(kind, data, seq)
+		if key in self._pending:
+			seqs = self._pending[key][0]
+			seqs.append(seq)
+		else:
+			seqs = [seq]
+			self._order.append(key)
+		self._pending[key] = (seqs, kind, data)
+		self._seq = max(self._seq, seq)
+
+	def _replay_spool(self):
+		''' restore all unacknowledged updates and compact the spool file '''
+		if not os.path.exists(self.spoolPath):
+			return
+		entries = {}
+		acked = set()
+		f = open(self.spoolPath, 'r')
+		try:
+			for line in f:
+				try:
+					entry = json.loads(line)
+				except ValueError:
+					# a partially written last line
+					logger.warning('Skipping invalid spool entry in %s' % self.spoolPath)
+					continue
+				if entry['op'] == 'put':
+					entries[entry['seq']] = entry
+				elif entry['op'] == 'ack':
+					acked.update(entry['seq'])
+		finally:
+			f.close()
+
+		tmpPath = self.spoolPath + '.tmp'
+		f = open(tmpPath, 'w')
+		try:
+			for seq in sorted(entries.keys()):
+				if seq in acked:
+					continue
+				entry = entries[seq]
+				self._add(seq, entry['kind'], entry['data'])
+				f.write(jd(entry) + '\n')
+		finally:
+			f.close()
+		os.rename(tmpPath, self.spoolPath)
+		if self._pending:
+			logger.info('restored %d pending updates from %s' % (len(self._pending), self.spoolPath))
+
+	def _write_spool(self, entry):
+		self._spool.write(jd(entry) + '\n')
+		self._spool.flush()
+		os.fsync(self._spool.fileno())
+
+
+	def put(self, kind, data):
+		# callers may keep on modifying their dicts
+		data = copy.deepcopy(data)
+		with self._lock:
+			self._seq += 1
+			self._write_spool({'op': 'put', 'seq': self._seq, 'kind': kind, 'data': data})
+			self._add(self._seq, kind, data)
+			self._lock.notify_all()
+
+	def put_job(self, jobDict):
+		self.put('job', jobDict)
+
+	def put_run(self, runData):
+		self.put('run', runData)
+
+	def put_result(self, resultData):
+		self.put('result', resultData)
+
+	def pending(self):
+		with self._lock:
+			return len(self._pending)
+
+	def flush(self, timeout=None):
+		''' wait until all pending updates are sent.
+			returns True if nothing is pending anymore
+		'''
+		deadline = None
+		if timeout is not None:
+			deadline = time.time() + timeout
+		with self._lock:
+			while self._pending and self.is_alive():
+				remaining = None
+				if deadline:
+					remaining = deadline - time.time()
+					if remaining <= 0:
+						break
+				self._lock.wait(remaining)
+			return not self._pending
+
+
+	def _send_single(self, kind, data):
+		''' returns True if the update was sent or rejected permanently '''
+		try:
+			if kind == 'job':
+				return self.backend.post_job(data, raiseRejected=True) is not None
+			elif kind == 'run':
+				return self.backend.post_run(data['app'], data['state'], runId=data.get('_id'), executionStrategy=data.get('executionStrategy'), raiseRejected=True) is not None
+			elif kind == 'result':
+				return self.backend.post_result(data['run'], data['resultInfo']['type'], data['resultInfo']['data'], raiseRejected=True) is not None
+		except RequestRejected as e:
+			# retrying would block all following updates forever
+			logger.error('Dropping %s update rejected by the backend (%s): %s' % (kind, e, data))
+			return True
+		logger.error('Dropping update of unknown kind %s' % kind)
+		return True
+
+	def _send(self, batch):
+		''' returns the keys of all sent (or dropped) updates '''
+		if len(batch) > 1 and self.backend.batchWrite:
+			try:
+				result = self.backend.post_batch(list((self.PATHS[kind], data) for key, kind, data, seq in batch), raiseRejected=True)
+			except RequestRejected as e:
+				# send the updates one by one, thus only the rejected ones are dropped
+				logger.warning('Batch of %d updates rejected by the backend (%s)' % (len(batch), e))
+				result = None
+			if result:
+				return list(key for key, kind, data, seq in batch)
+			elif result is False:
+				return []
+		sent = []
+		for key, kind, data, seq in batch:
+			try:
+				if not self._send_single(kind, data):
+					break
+			except Exception as e:
+				# the updates sent so far must be acked, otherwise they would be sent again
+				logger.warning('Posting %s update failed: %s' % (kind, e))
+				break
+			sent.append(key)
+		return sent
+
+	def _ack(self, batch, sentKeys):
+		with self._lock:
+			seqs = []
+			for key, kind, data, sentSeq in batch:
+				if key not in sentKeys:
+					continue
+				pendingSeqs, pendingKind, pendingData = self._pending[key]
+				if pendingData is data:
+					seqs.extend(pendingSeqs)
+					self._pending.pop(key)
+					self._order.remove(key)
+				else:
+					# updated while sending - ack the sent (and older) states only
+					seqs.extend(seq for seq in pendingSeqs if seq <= sentSeq)
+					pendingSeqs[:] = list(seq for seq in pendingSeqs if seq > sentSeq)
+			if seqs:
+				self._write_spool({'op': 'ack', 'seq': seqs})
+			self._lock.notify_all()
+
+
+	def run(self):
+		while True:
+			with self._lock:
+				while not self._pending and not self.stopped():
+					self._lock.wait(1)
+				if not self._pending:
+					break
+				batch = []
+				for key in self._order[:self.BATCH_SIZE]:
+					seqs, kind, data = self._pending[key]
+					batch.append((key, kind, data, seqs[-1]))
+
+			sentKeys = []
+			try:
+				sentKeys = self._send(batch)
+			except Exception as e:
+				logger.warning('Posting status updates failed: %s' % e)
+			self._ack(batch, sentKeys)
+
+			if len(sentKeys) < len(batch):
+				if self.stopped():
+					logger.warning('%d status updates remain spooled in %s' % (self.pending(), self.spoolPath))
+					break
+				logger.info('retrying status updates in %ss' % self.retryInterval)
+				self._stop.wait(self.retryInterval)
+				self.retryInterval = min(self.retryInterval * 2, self.MAX_RETRY_INTERVAL)
+			else:
+				self.retryInterval = self.MIN_RETRY_INTERVAL
+		self._spool.close()
@@ -1,10 +1,30 @@
 from bs4 import BeautifulSoup
 import urllib2
+import httplib
+import socket
 import json
+import logging
+
+from ttlcache import PersistentTTLCache
+
+logger = logging.getLogger('worker.'+__name__)
 
 class AppStoreException(Exception):
 	pass
-	
+
+class AppStoreNotFoundException(AppStoreException):
+	''' the store has no (unique) result for the lookup '''
+	pass
+
+
+_SHARED_STORE_CACHE = None
+
+def shared_store_cache():
+	global _SHARED_STORE_CACHE
+	if not _SHARED_STORE_CACHE:
+		_SHARED_STORE_CACHE = PersistentTTLCache(AppStore.CACHE_PATH)
+	return _SHARED_STORE_CACHE
+
 
 class AppStore(object):
 	
@@ -16,6 +36,20 @@ class AppStore(object):
 	view_SW_URL = "https://itunes.apple.com/%(country)s/app/id%(trackId)d"
 	search_Bundle_URL = "https://itunes.apple.com/%(country)s/lookup?bundleId=%(bundleId)s"
 	lookup_URL = "https://itunes.apple.com/lookup?id=%(trackId)d&country=%(country)s"
+	bulk_lookup_URL = "https://itunes.apple.com/lookup?%(field)s=%(ids)s&country=%(country)s"
+
+	# max. number of ids per bulk lookup request
+	LOOKUP_BATCH_SIZE = 150
+
+	CACHE_PATH = '/tmp/appstore-cache.sqlite'
+	# ttl in seconds per lookup type
+	CACHE_TTL = {
+		'trackId': 7*24*60*60,
+		'appInfo': 24*60*60,
+		'appData': 24*60*60
+	}
+	# ttl of "not found" results
+	NEGATIVE_CACHE_TTL = 60*60
 
 	def __do_request(self, url):
 		
@@ -32,14 +66,45 @@ class AppStore(object):
 		return response
 		
 
-	def __init__(self, country="de"):
+	def __init__(self, country="de", cache=None):
+		''' `cache`: a PersistentTTLCache, defaults to the shared store cache. Use False to disable caching.
+		'''
 		self.country = country
-	
+		if cache is None:
+			cache = shared_store_cache()
+		self.cache = cache
+
+
+	def _cached(self, kind, key, lookup):
+		''' returns the cached result for the given lookup or performs and caches it.
+			"not found" results are cached as well and raised as AppStoreNotFoundException.
+		'''
+		if not self.cache:
+			return lookup()
+		cacheKey = self._cache_key(kind, key)
+		entry = self.cache.get(cacheKey)
+		if entry:
+			value, error = entry
+			logger.debug('store cache hit for %s (hit rate: %.2f)' % (cacheKey, self.cache.hit_rate()))
+			if error:
+				raise AppStoreNotFoundException(error)
+			return value
+		try:
+			value = lookup()
+		except AppStoreNotFoundException as e:
+			self.cache.set_error(cacheKey, e, ttl=self.NEGATIVE_CACHE_TTL)
+			raise
+		self.cache.set(cacheKey, value, ttl=self.CACHE_TTL[kind])
+		return value
+
 	
 	def get_app_info(self, appId):
 		''' Get the appInfo from the iTunes store. 
 			The returned dictionary contains all neccessary fields needed to purchase the app.
 		'''
+		return self._cached('appInfo', appId, lambda: self._lookup_app_info(appId))
+
+	def _lookup_app_info(self, appId):
 		url = AppStore.view_SW_URL % {"country":self.country, "trackId":appId}
 
 		data = ""
@@ -54,12 +119,15 @@ class AppStore(object):
 		if (len(buyDivs) > 0):
 			return buyDivs[0].attrs
 		else:
-			raise AppStoreException("No App info found")
+			raise AppStoreNotFoundException("No App info found")
 
 
 	def get_app_data(self, appId):
 		''' Returns all data available from the store via lookup for the given appId (trackId)
 		'''
+		return self._cached('appData', appId, lambda: self._lookup_app_data(appId))
+
+	def _lookup_app_data(self, appId):
 		url = AppStore.lookup_URL % {"country":self.country, "trackId":appId}
 		
 		data = {}
@@ -72,9 +140,9 @@ class AppStore(object):
 		if 'resultCount' in data:
 			count = data['resultCount']
 			if  count < 1:
-				raise AppStoreException("BundleId not found")
+				raise AppStoreNotFoundException("BundleId not found")
 			elif count > 1 :
-				raise AppStoreException("BundleId not unique")
+				raise AppStoreNotFoundException("BundleId not unique")
 			else:
 				return data['results'][0]
 		else:
@@ -86,6 +154,9 @@ class AppStore(object):
 		''' Returns the corresponding trackId to the given bundle identifier.
 			This function will throw an AppStoreException unless exacly one result is found.
 		'''
+		return self._cached('trackId', bundleId, lambda: self._lookup_trackId_for_bundleId(bundleId))
+
+	def _lookup_trackId_for_bundleId(self, bundleId):
 		url = AppStore.search_Bundle_URL % {"country":self.country, "bundleId":bundleId}
 
 		data = {}
@@ -98,15 +169,90 @@ class AppStore(object):
 		if 'resultCount' in data:
 			count = data['resultCount']
 			if  count < 1:
-				raise AppStoreException("bundleId not found")
+				raise AppStoreNotFoundException("bundleId not found")
 			elif count > 1 :
-				raise AppStoreException("bundleId not unique")
+				raise AppStoreNotFoundException("bundleId not unique")
 			else:
 				return data['results'][0]['trackId']
 		else:
 			raise AppStoreException("Invalid response data")	
 		
 		
+	def _cache_key(self, kind, key):
+		return '%s:%s:%s' % (kind, self.country, key)
+
+	def _bulk_lookup(self, field, ids):
+		''' returns the lookup results for the given ids (one request per LOOKUP_BATCH_SIZE ids) '''
+		results = []
+		for i in range(0, len(ids), self.LOOKUP_BATCH_SIZE):
+			batch = ids[i:i+self.LOOKUP_BATCH_SIZE]
+			url = AppStore.bulk_lookup_URL % {"country":self.country, "field":field, "ids":','.join(str(x) for x in batch)}
+			try:
+				response = self.__do_request(url)
+				data = json.loads(response.read())
+			except (urllib2.URLError, httplib.HTTPException, socket.error, ValueError) as e:
+				# reading the body may time out or be cut off, the data may be garbled
+				raise AppStoreException(e)
+			if not isinstance(data, dict) or not 'results' in data:
+				raise AppStoreException("Invalid response data")
+			results.extend(data['results'])
+		return results
+
+	def _cache_results(self, results):
+		if not self.cache:
+			return
+		for result in results:
+			if not 'trackId' in result:
+				continue
+			self.cache.set(self._cache_key('appData', result['trackId']), result, ttl=self.CACHE_TTL['appData'])
+			if 'bundleId' in result:
+				self.cache.set(self._cache_key('trackId', result['bundleId']), result['trackId'], ttl=self.CACHE_TTL['trackId'])
+
+	def lookup_bundleIds(self, bundleIds):
+		''' Resolves many bundle identifiers with a few bulk requests.
+			Returns a dict mapping each found bundleId to its store data (as returned by get_app_data).
+			Results (and bundleIds not found) are added to the store cache.
+		'''
+		bundleIds = list(set(bundleIds))
+		results = self._bulk_lookup('bundleId', bundleIds)
+		self._cache_results(results)
+
+		found = {}
+		requested = dict((bundleId.lower(), bundleId) for bundleId in bundleIds)
+		for result in results:
+			bundleId = requested.get(result.get('bundleId', '').lower())
+			if bundleId:
+				found[bundleId] = result
+		if self.cache:
+			for bundleId in bundleIds:
+				if bundleId not in found:
+					self.cache.set_error(self._cache_key('trackId', bundleId), "bundleId not found", ttl=self.NEGATIVE_CACHE_TTL)
+		logger.debug('bulk lookup: %d of %d bundleIds found' % (len(found), len(bundleIds)))
+		return found
+
+	def lookup_trackIds(self, trackIds):
+		''' Resolves many trackIds with a few bulk requests.
+			Returns a dict mapping each found trackId to its store data (as returned by get_app_data).
+		'''
+		trackIds = list(set(int(trackId) for trackId in trackIds))
+		results = self._bulk_lookup('id', trackIds)
+		self._cache_results(results)
+		found = dict((result['trackId'], result) for result in results if 'trackId' in result)
+		logger.debug('bulk lookup: %d of %d trackIds found' % (len(found), len(trackIds)))
+		return found
+
+	def prewarm(self, bundleIds):
+		''' add the store data of all given bundleIds to the store cache.
+			BundleIds already cached are skipped.
+		'''
+		if not self.cache:
+			return
+		missing = list(bundleId for bundleId in set(bundleIds) if not self.cache.get(self._cache_key('trackId', bundleId)))
+		if missing:
+			logger.info('prewarming store cache with %d bundleIds (%s)' % (len(missing), self.country))
+			self.lookup_bundleIds(missing)
+
+
 	@staticmethod
 	def countryForStoreFrontId(storeFrontId):
 		if storeFrontId in AppStore.storeFrontIdToCountryDict:
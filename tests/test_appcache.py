@@ -0,0 +1,63 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from appcache import AppArchiveCache
+
+
+class AppArchiveCacheTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmpDir = tempfile.mkdtemp()
+		self.cache = AppArchiveCache(self.tmpDir)
+		self.downloads = 0
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpDir)
+
+	def _download(self, path):
+		self.downloads += 1
+		with open(path, 'wb') as f:
+			f.write('ipa')
+		return True
+
+	def _failed_download(self, path):
+		with open(path + '.part', 'wb') as f:
+			f.write('partial')
+		return False
+
+	def test_fetch_once(self):
+		objPath = self.cache.fetch('app', '1.0', self._download)
+		self.assertEqual(self.cache.fetch('app', '1.0', self._download), objPath)
+		self.assertEqual(self.downloads, 1)
+		self.assertEqual(open(objPath, 'rb').read(), 'ipa')
+
+	def test_using_evicted_archive(self):
+		objPath = self.cache.fetch('app', '1.0', self._download)
+		# evicted by another process after the ref was read
+		os.remove(objPath)
+		with self.cache.using('app', '1.0', self._download) as path:
+			self.assertEqual(path, objPath)
+			self.assertEqual(open(path, 'rb').read(), 'ipa')
+		self.assertEqual(self.downloads, 2)
+
+	def test_archive_in_use_is_not_evicted(self):
+		with self.cache.using('app', '1.0', self._download) as objPath:
+			self.cache.EVICTION_GRACE_TIME = 0
+			self.cache.maxSize = 1
+			self.cache.evict()
+			self.assertTrue(os.path.exists(objPath))
+		self.cache.evict()
+		self.assertFalse(os.path.exists(objPath))
+
+	def test_failed_download_leaves_no_files(self):
+		self.assertEqual(self.cache.fetch('app', '1.0', self._failed_download), None)
+		self.assertEqual(os.listdir(os.path.join(self.tmpDir, 'objects')), [])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,113 @@
+import os
+import sys
+import shutil
+import base64
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from benchmarks import standin
+from backend import Backend
+
+
+ARCHIVE = os.urandom(300*1024)
+
+
+class ArchiveDownloadTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmpDir = tempfile.mkdtemp()
+		self.path = os.path.join(self.tmpDir, 'app.ipa')
+		self.drops = 0
+		self.status = 200
+		self.server = standin.StandInServer([
+			('GET', r'^/apps/([^/]+)/ipa$', self._ipa),
+		]).start()
+		self.backend = Backend(self.server.url)
+
+	def tearDown(self):
+		self.server.stop()
+		shutil.rmtree(self.tmpDir)
+
+	def _ipa(self, req, body, appId):
+		if self.status != 200:
+			return self.status, {'error': 'failed'}
+		start = 0
+		rangeHeader = req.headers.getheader('Range')
+		if rangeHeader:
+			start = int(rangeHeader.split('=')[1].rstrip('-'))
+		data = ARCHIVE[start:]
+		req.send_response(206 if start else 200)
+		req.send_header('Content-Length', str(len(data)))
+		req.end_headers()
+		if self.drops > 0:
+			# drop the connection in the middle of the body
+			self.drops -= 1
+			req.wfile.write(data[:len(data)/2])
+			req.wfile.flush()
+			req.close_connection = 1
+			return None
+		req.wfile.write(data)
+		req.wfile.flush()
+		return None
+
+	def test_download(self):
+		self.assertTrue(self.backend.get_app_archive('a', self.path, expectedSize=len(ARCHIVE)))
+		self.assertTrue(open(self.path, 'rb').read() == ARCHIVE)
+
+	def test_resume_dropped_body(self):
+		self.drops = 2
+		# without expectedSize only the dropped stream itself triggers the resume
+		self.assertTrue(self.backend.get_app_archive('a', self.path))
+		self.assertTrue(open(self.path, 'rb').read() == ARCHIVE)
+
+	def test_no_part_file_on_failure(self):
+		self.status = 500
+		self.assertFalse(self.backend.get_app_archive('a', self.path))
+		self.assertEqual(os.listdir(self.tmpDir), [])
+
+	def test_no_part_file_on_checksum_mismatch(self):
+		self.assertFalse(self.backend.get_app_archive('a', self.path, checksum='0'*32))
+		self.assertEqual(os.listdir(self.tmpDir), [])
+
+
+class ResultArchiveTest(unittest.TestCase):
+
+	def setUp(self):
+		self.results = []
+		self.tmpDir = tempfile.mkdtemp()
+		self.path = os.path.join(self.tmpDir, 'result.ipa')
+		with open(self.path, 'wb') as f:
+			f.write(ARCHIVE)
+
+	def tearDown(self):
+		self.server.stop()
+		shutil.rmtree(self.tmpDir)
+
+	def _start(self, routes):
+		self.server = standin.StandInServer(routes).start()
+		self.backend = Backend(self.server.url)
+
+	def _result(self, req, body):
+		self.results.append(body)
+		return 200, {'resultId': str(len(self.results))}
+
+	def test_binary_upload(self):
+		def upload(req, body, runId, resultType):
+			self.results.append(body)
+			return 200, {'resultId': '1'}
+		self._start([('POST', r'^/runs/([^/]+)/results/([^/]+)$', upload)])
+		self.assertEqual(self.backend.post_result_archive('r', 'app_archive', self.path), '1')
+		self.assertTrue(self.results[0] == ARCHIVE)
+
+	def test_fallback_without_binary_uploads(self):
+		self._start([('POST', r'^/results$', self._result)])
+		self.assertEqual(self.backend.post_result_archive('r', 'app_archive', self.path), '1')
+		self.assertFalse(self.backend.resultArchives)
+		self.assertEqual(self.results[0]['resultInfo']['type'], 'app_archive')
+		self.assertTrue(base64.b64decode(self.results[0]['resultInfo']['data']) == ARCHIVE)
+
+
+if __name__ == '__main__':
+	unittest.main()
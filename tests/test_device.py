@@ -0,0 +1,61 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from benchmarks import standin
+from backend import Backend
+from device import iDevice
+
+
+class FreeBytesTest(unittest.TestCase):
+
+	def setUp(self):
+		self.device = iDevice('d1')
+		# no device attached, ideviceinfo fails
+		self.device.telemetry._command = lambda domain: ['false']
+
+	def test_unknown(self):
+		self.assertEqual(self.device.free_bytes(), None)
+
+	def test_retry_failed_query(self):
+		self.device.free_bytes()
+		self.device.telemetry._command = lambda domain: ['echo', '<plist><dict><key>TotalDataAvailable</key><integer>2048</integer></dict></plist>']
+		self.assertEqual(self.device.free_bytes(), 2048)
+
+
+class RegisterDeviceTest(unittest.TestCase):
+
+	def setUp(self):
+		self.registered = []
+		self.server = standin.StandInServer([
+			('GET', r'^/devices/([^/]+)$', lambda req, body, udid: (404, {})),
+			('GET', r'^/accounts$', lambda req, body: (200, {})),
+			('POST', r'^/devices$', self._register),
+		]).start()
+		self.backend = Backend(self.server.url)
+		self.device = iDevice('d1')
+		# cached lockdown values, no device attached
+		for domain, values in [('base', {'ProductVersion': '8.1'}), ('itunes_store', {})]:
+			self.device.telemetry._data[domain] = values
+			self.device.telemetry._updated[domain] = time.time()
+
+	def tearDown(self):
+		self.backend.reset_session()
+		self.server.stop()
+
+	def _register(self, req, body):
+		self.registered.append(body)
+		return 200, {}
+
+	def test_telemetry_snapshot(self):
+		self.assertTrue(self.backend.register_device(self.device))
+		telemetry = self.registered[0]['telemetry']
+		self.assertEqual(telemetry['domains']['base'], {'ProductVersion': '8.1'})
+		self.assertEqual(sorted(telemetry['age'].keys()), ['base', 'itunes_store'])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,86 @@
+import os
+import sys
+import time
+import Queue
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from worker import DeviceLoopMixin
+from backend import Backend
+
+
+class FakeBackend(object):
+	''' hands out `jobs`, calls `onClaim` before a job is returned '''
+
+	longPoll = True
+
+	def __init__(self, jobs):
+		self.jobs = jobs
+		self.onClaim = None
+		# duration of a claim (seconds), e.g. a long-poll request
+		self.claimTime = 0
+		self.posted = []
+
+	def get_job_for_device(self, udid, wait=None):
+		if not self.jobs:
+			return None
+		if self.onClaim:
+			self.onClaim()
+		time.sleep(self.claimTime)
+		return self.jobs.pop(0)
+
+	def post_job(self, jobDict):
+		self.posted.append(jobDict)
+		return jobDict['_id']
+
+	release_job = Backend.__dict__['release_job']
+
+
+class PrefetchTest(unittest.TestCase):
+
+	def setUp(self):
+		self.backend = FakeBackend([{'_id': 'j1', 'type': 'exec_cmd', 'state': 'running'}])
+		device = type('Device', (object,), {'udid': 'd1'})()
+		self.loop = DeviceLoopMixin(device, self.backend, pipeline=True)
+		self.loop.preparedJobs = Queue.Queue(maxsize=1)
+		self.loop._prefetchLock = threading.Lock()
+
+	def test_release_job_claimed_while_stopping(self):
+		# the loop is stopped during the (long-poll) claim
+		self.backend.onClaim = self.loop.stop
+		self.loop._prefetch_loop()
+		self.assertTrue(self.loop.preparedJobs.empty())
+		self.assertEqual(list((d['_id'], d['state']) for d in self.backend.posted), [('j1', 'pending')])
+
+	def _start_prefetcher(self):
+		prefetcher = threading.Thread(target=self.loop._prefetch_loop)
+		prefetcher.daemon = True
+		prefetcher.start()
+		return prefetcher
+
+	def test_release_prepared_job(self):
+		prefetcher = self._start_prefetcher()
+		while self.loop.preparedJobs.empty():
+			prefetcher.join(0.01)
+		self.loop.stop()
+		self.loop._stop_prefetcher(prefetcher)
+		self.assertFalse(prefetcher.is_alive())
+		self.assertEqual(list((d['_id'], d['state']) for d in self.backend.posted), [('j1', 'pending')])
+
+	def test_wait_for_pending_claim(self):
+		claiming = threading.Event()
+		self.backend.onClaim = claiming.set
+		self.backend.claimTime = 0.3
+		prefetcher = self._start_prefetcher()
+		claiming.wait(5)
+		# the device loop stops during the (long-poll) claim
+		self.loop.stop()
+		self.loop._stop_prefetcher(prefetcher)
+		self.assertFalse(prefetcher.is_alive())
+		self.assertEqual(list((d['_id'], d['state']) for d in self.backend.posted), [('j1', 'pending')])
+
+
+if __name__ == '__main__':
+	unittest.main()
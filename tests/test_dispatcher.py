@@ -0,0 +1,157 @@
+import os
+import sys
+import time
+import Queue
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from worker import JobDispatcher
+from fairshare import FairShareQueue
+
+
+class FakeBackend(object):
+	''' fails the first `failures` claims with a ValueError (like an invalid json response) '''
+
+	longPoll = False
+	batchClaim = True
+
+	def __init__(self, failures=0):
+		self.failures = failures
+		self.jobs = []
+		# udid -> jobs the backend claims for this device only
+		self.deviceJobs = {}
+		self.released = []
+
+	def get_jobs_for_devices(self, udids, wait=None):
+		if self.failures > 0:
+			self.failures -= 1
+			raise ValueError('No JSON object could be decoded')
+		jobs = {}
+		for udid in sorted(udids):
+			if self.deviceJobs.get(udid):
+				jobs[udid] = self.deviceJobs[udid].pop(0)
+			elif self.jobs:
+				jobs[udid] = self.jobs.pop(0)
+		return jobs
+
+	def release_job(self, jobDict):
+		self.released.append(jobDict['_id'])
+		return True
+
+
+class FakeLoop(object):
+
+	def __init__(self, udid):
+		self.device = type('Device', (object,), {'udid': udid})()
+		self.jobQueue = Queue.Queue()
+		self._stopped = False
+
+	def stop(self):
+		self._stopped = True
+
+	def stopped(self):
+		return self._stopped
+
+
+class JobDispatcherTest(unittest.TestCase):
+
+	def setUp(self):
+		self.backend = FakeBackend()
+		self.dispatcher = JobDispatcher(self.backend)
+		self.dispatcher.pollInterval = 0.01
+
+	def tearDown(self):
+		self.dispatcher.stop()
+		self.dispatcher.join(5)
+
+	def _start(self, udids):
+		loops = list(FakeLoop(udid) for udid in udids)
+		for loop in loops:
+			self.dispatcher.add_loop(loop)
+			self.dispatcher.request_job(loop.device.udid)
+		self.dispatcher.start()
+		return loops
+
+	def test_dispatch(self):
+		self.backend.jobs = [{'_id': 'j1'}, {'_id': 'j2'}]
+		loops = self._start(['d1', 'd2'])
+		jobIds = set(loop.jobQueue.get(timeout=5)['_id'] for loop in loops)
+		self.assertEqual(jobIds, set(['j1', 'j2']))
+
+	def test_dispatch_to_claimed_device(self):
+		self.backend.deviceJobs = {'d3': [{'_id': 'j1'}]}
+		loops = self._start(['d1', 'd2', 'd3', 'd4'])
+		self.assertEqual(loops[2].jobQueue.get(timeout=5)['_id'], 'j1')
+		for loop in loops[:2] + loops[3:]:
+			self.assertTrue(loop.jobQueue.empty())
+
+	def test_release_jobs_of_removed_loop(self):
+		# the job claimed for d1 is deferred by its quota until d1 is gone
+		quota = {'account': 1}
+		jobInfo = {'accountId': 'a1'}
+		self.backend.deviceJobs = {'d1': [{'_id': 'j1', 'quota': quota, 'jobInfo': jobInfo}, {'_id': 'j2', 'quota': quota, 'jobInfo': jobInfo}]}
+		loop, = self._start(['d1'])
+		self.assertEqual(loop.jobQueue.get(timeout=5)['_id'], 'j1')
+		self.dispatcher.request_job('d1')
+		self.assertRaises(Queue.Empty, loop.jobQueue.get, timeout=0.5)
+		self.dispatcher.remove_loop('d1')
+		self.assertEqual(self.backend.released, ['j2'])
+
+	def test_skip_stopped_loops(self):
+		self.backend.jobs = [{'_id': 'j1'}]
+		loop = FakeLoop('d1')
+		self.dispatcher.add_loop(loop)
+		self.dispatcher.request_job('d1')
+		loop.stop()
+		self.dispatcher.start()
+		time.sleep(0.5)
+		self.assertTrue(loop.jobQueue.empty())
+		# not even claimed
+		self.assertEqual(len(self.backend.jobs), 1)
+
+	def test_release_dispatched_jobs_of_removed_loop(self):
+		self.backend.deviceJobs = {'d1': [{'_id': 'j1'}]}
+		loop, = self._start(['d1'])
+		# the loop ends without taking the job
+		while loop.jobQueue.empty():
+			time.sleep(0.01)
+		self.dispatcher.remove_loop('d1')
+		self.assertEqual(self.backend.released, ['j1'])
+
+	def test_survives_errors(self):
+		self.backend.failures = 2
+		self.backend.jobs = [{'_id': 'j1'}]
+		loop, = self._start(['d1'])
+		self.assertEqual(loop.jobQueue.get(timeout=5)['_id'], 'j1')
+		self.assertTrue(self.dispatcher.is_alive())
+
+	def test_quota_counts_running_jobs(self):
+		quota = {'account': 1}
+		jobInfo = {'accountId': 'a1'}
+		self.backend.jobs = [{'_id': 'j1', 'quota': quota, 'jobInfo': jobInfo}, {'_id': 'j2', 'quota': quota, 'jobInfo': jobInfo}]
+		loop, = self._start(['d1'])
+		self.assertEqual(loop.jobQueue.get(timeout=5)['_id'], 'j1')
+		# a pipelining device requests its next job while j1 is still running
+		self.dispatcher.request_job('d1')
+		self.assertRaises(Queue.Empty, loop.jobQueue.get, timeout=0.5)
+		self.dispatcher.job_finished('d1')
+		self.assertEqual(loop.jobQueue.get(timeout=5)['_id'], 'j2')
+
+
+class FairShareQueueTest(unittest.TestCase):
+
+	def test_pop_for_device(self):
+		queue = FairShareQueue()
+		queue.put({'_id': 'j1', 'priority': 'high'}, udid='d1')
+		queue.put({'_id': 'j2', 'priority': 'high', 'device': 'd2'})
+		queue.put({'_id': 'j3', 'priority': 'low'})
+		self.assertEqual(queue.pop('d3')['_id'], 'j3')
+		self.assertEqual(queue.pop('d3'), None)
+		self.assertEqual(queue.pop('d1')['_id'], 'j1')
+		self.assertEqual(queue.pop('d1'), None)
+		self.assertEqual(queue.pop('d2')['_id'], 'j2')
+
+
+if __name__ == '__main__':
+	unittest.main()
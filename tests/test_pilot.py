@@ -0,0 +1,89 @@
+import os
+import sys
+import time
+import urlparse
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from benchmarks import standin
+from pilot import Pilot
+
+
+class FakePilot(object):
+	''' /status of a pilot running a single task for `duration` seconds '''
+
+	def __init__(self, duration, longPoll, taskInfo=None):
+		self.duration = duration
+		self.longPoll = longPoll
+		self.taskInfo = taskInfo or {'bundleId': 'com.example.app'}
+		self.finished = threading.Event()
+		self.requests = []
+		self.server = standin.StandInServer([
+			('GET', r'^/status$', self._status),
+		]).start()
+		self.timer = threading.Timer(duration, self.finished.set)
+		self.timer.start()
+
+	def stop(self):
+		self.timer.cancel()
+		self.server.stop()
+
+	def _status(self, req, body):
+		query = urlparse.parse_qs(urlparse.urlparse(req.path).query)
+		wait = float(query['wait'][0]) if 'wait' in query else None
+		self.requests.append(wait)
+		if wait and self.longPoll:
+			# hold the request until the task has finished
+			self.finished.wait(wait)
+		if self.finished.is_set():
+			return 200, {'taskRunning': False}
+		return 200, {'taskRunning': True, 'taskInfo': self.taskInfo}
+
+
+class WaitForTaskTest(unittest.TestCase):
+
+	def setUp(self):
+		self.sleepTimes = Pilot._WAIT_MIN_SLEEP_TIME, Pilot._WAIT_MAX_SLEEP_TIME
+		Pilot._WAIT_MIN_SLEEP_TIME = 0.05
+		Pilot._WAIT_MAX_SLEEP_TIME = 0.2
+		self.pilot = None
+
+	def tearDown(self):
+		Pilot._WAIT_MIN_SLEEP_TIME, Pilot._WAIT_MAX_SLEEP_TIME = self.sleepTimes
+		if self.pilot:
+			self.pilot.stop()
+
+	def test_long_poll(self):
+		self.pilot = FakePilot(1.0, longPoll=True)
+		pilot = Pilot(self.pilot.server.url)
+		duration = pilot._wait_for_task_finished()
+		self.assertTrue(pilot.longPoll)
+		# an immediate status request, then a single held request
+		self.assertEqual(self.pilot.requests, [None, Pilot._WAIT_LONG_POLL_TIME])
+		self.assertTrue(0.9 < duration < 1.5)
+		self.assertEqual(pilot.lastTaskDuration, duration)
+
+	def test_fallback_to_polling(self):
+		self.pilot = FakePilot(1.0, longPoll=False)
+		pilot = Pilot(self.pilot.server.url)
+		duration = pilot._wait_for_task_finished()
+		self.assertFalse(pilot.longPoll)
+		self.assertTrue(0.9 < duration < 1.5)
+		# polls with an increasing interval after the fallback, no further long polls
+		self.assertEqual(self.pilot.requests[:2], [None, Pilot._WAIT_LONG_POLL_TIME])
+		self.assertFalse(Pilot._WAIT_LONG_POLL_TIME in self.pilot.requests[2:])
+		self.assertTrue(len(self.pilot.requests) < 15)
+
+	def test_next_task_running(self):
+		self.pilot = FakePilot(10.0, longPoll=False, taskInfo={'bundleId': 'com.example.next'})
+		pilot = Pilot(self.pilot.server.url, longPoll=False)
+		startTime = time.time()
+		pilot._wait_for_task_finished(taskInfo={'bundleId': 'com.example.app'})
+		self.assertTrue(time.time() - startTime < 1)
+		self.assertEqual(self.pilot.requests, [None])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,148 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import itertools
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import scheduler
+from benchmarks import standin
+from scheduler import Scheduler, read_records
+from store import AppStoreException
+from scheduleindex import ScheduleIndex
+
+
+class ScheduleFileTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmpDir = tempfile.mkdtemp()
+		self.path = os.path.join(self.tmpDir, 'apps.jsonl')
+		self.ids = itertools.count()
+		# bundleIds the backend refuses to schedule
+		self.failing = set()
+		self.posted = []
+		self.server = standin.StandInServer([
+			('POST', r'^/jobs/bulk$', self._bulk),
+		]).start()
+		self.scheduler = Scheduler(self.server.url, batchSize=2, concurrency=2)
+
+	def tearDown(self):
+		self.scheduler.backend.reset_session()
+		self.server.stop()
+		shutil.rmtree(self.tmpDir)
+
+	def _bulk(self, req, body):
+		jobIds = []
+		for jobDict in body['jobs']:
+			bundleId = jobDict['jobInfo']['bundleId']
+			if bundleId in self.failing:
+				jobIds.append(None)
+			else:
+				self.posted.append(bundleId)
+				jobIds.append(str(next(self.ids)))
+		return 200, {'jobIds': jobIds}
+
+	def _write_records(self, bundleIds):
+		with open(self.path, 'w') as f:
+			for bundleId in bundleIds:
+				f.write(json.dumps({'bundleId': bundleId, 'storeCountry': 'us'}) + '\n')
+
+	def test_failed_records(self):
+		self._write_records(['a', 'b', 'c', 'd', 'e'])
+		self.failing = set(['b', 'e'])
+		self.assertFalse(self.scheduler.schedule_file(self.path))
+		self.assertEqual(sorted(self.posted), ['a', 'c', 'd'])
+
+		failedPath = self.path + '.checkpoint.failed'
+		failed = list(record for index, record in read_records(failedPath, 'jsonl'))
+		self.assertEqual(list((r['index'], r['bundleId'], r['storeCountry']) for r in failed), [(1, 'b', 'us'), (4, 'e', 'us')])
+
+		# the failed records are a valid input file
+		self.failing = set()
+		self.assertTrue(self.scheduler.schedule_file(failedPath, fileFormat='jsonl'))
+		self.assertEqual(sorted(self.posted), ['a', 'b', 'c', 'd', 'e'])
+
+	def test_unresolved_records(self):
+		class AppStore(object):
+			''' knows trackId 1 in the us store only '''
+			def __init__(self, country):
+				self.country = country
+			def lookup_trackIds(self, trackIds):
+				if self.country != 'us':
+					raise AppStoreException('lookup failed')
+				return dict((trackId, {'bundleId': 'app%d' % trackId}) for trackId in trackIds if trackId == 1)
+
+		with open(self.path, 'w') as f:
+			for record in [{'appId': 1}, {'appId': 2}, {'appId': 1, 'storeCountry': 'de'}, {'bundleId': 'b'}, {'appId': 'x'}]:
+				f.write(json.dumps(record) + '\n')
+		originalAppStore = scheduler.AppStore
+		scheduler.AppStore = AppStore
+		try:
+			self.assertFalse(self.scheduler.schedule_file(self.path))
+		finally:
+			scheduler.AppStore = originalAppStore
+		self.assertEqual(sorted(self.posted), ['app1', 'b'])
+
+		failed = list(record for index, record in read_records(self.path + '.checkpoint.failed', 'jsonl'))
+		self.assertEqual(list(r['index'] for r in failed), [1, 2, 4])
+		self.assertEqual(list(r.get('appId') for r in failed), [2, 1, 'x'])
+		with open(self.path + '.checkpoint') as f:
+			checkpoint = json.load(f)
+		self.assertEqual((checkpoint['index'], checkpoint['scheduled'], checkpoint['failed']), (4, 2, 3))
+
+
+class ScheduleIndexTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmpDir = tempfile.mkdtemp()
+		self.index = ScheduleIndex(os.path.join(self.tmpDir, 'index.sqlite'))
+		self.ids = itertools.count()
+		self.failing = set()
+		self.posted = []
+		# bundleIds already in the index while their post was in flight
+		self.indexedEarly = []
+		self.server = standin.StandInServer([
+			('POST', r'^/jobs/bulk$', self._bulk),
+		]).start()
+		self.scheduler = Scheduler(self.server.url, batchSize=2, concurrency=2, scheduleIndex=self.index, skipWindow=24*60*60)
+
+	def tearDown(self):
+		self.scheduler.backend.reset_session()
+		self.server.stop()
+		shutil.rmtree(self.tmpDir)
+
+	def _bulk(self, req, body):
+		jobIds = []
+		for jobDict in body['jobs']:
+			bundleId = jobDict['jobInfo']['bundleId']
+			if self.index.recent(ScheduleIndex.job_key(jobDict), 60):
+				self.indexedEarly.append(bundleId)
+			if bundleId in self.failing:
+				jobIds.append(None)
+			else:
+				self.posted.append(bundleId)
+				jobIds.append(str(next(self.ids)))
+		return 200, {'jobIds': jobIds}
+
+	def _schedule(self, bundleIds):
+		return self.scheduler.schedule_many(self.scheduler._bundleId_job(bundleId, country='us') for bundleId in bundleIds)
+
+	def test_index_after_post(self):
+		self.failing = set(['b'])
+		stats = self._schedule(['a', 'b', 'c', 'a', 'd'])
+		self.assertEqual((stats['scheduled'], stats['failed'], stats['skipped']), (3, 1, 1))
+		self.assertEqual(sorted(self.posted), ['a', 'c', 'd'])
+		self.assertEqual(self.indexedEarly, [])
+
+		# only the failed app is scheduled again
+		self.failing = set()
+		stats = self._schedule(['a', 'b', 'c', 'd'])
+		self.assertEqual((stats['scheduled'], stats['failed'], stats['skipped']), (1, 0, 3))
+		self.assertEqual(sorted(self.posted), ['a', 'b', 'c', 'd'])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,84 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import requests
+from backend import Backend, RequestRejected
+from statuswriter import StatusWriter
+
+
+class FakeBackend(object):
+	''' posts results one by one, raises for every result listed in `failing` (once),
+		rejects every result listed in `rejected`
+	'''
+
+	batchWrite = False
+
+	def __init__(self):
+		self.results = []
+		self.failing = set()
+		self.rejected = set()
+
+	def post_result(self, runId, resultType, resultData, raiseRejected=False):
+		if resultData in self.failing:
+			self.failing.discard(resultData)
+			raise requests.ConnectionError('connection reset')
+		if resultData in self.rejected:
+			if raiseRejected:
+				raise RequestRejected(400, 'invalid result')
+			return None
+		self.results.append(resultData)
+		return 'r%d' % len(self.results)
+
+
+class StatusWriterTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmpDir = tempfile.mkdtemp()
+		self.backend = FakeBackend()
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpDir)
+
+	def _writer_class(self):
+		spoolPath = os.path.join(self.tmpDir, 'spool') + '/'
+		return type('TestStatusWriter', (StatusWriter,), {'SPOOL_PATH': spoolPath, 'MIN_RETRY_INTERVAL': 0.01})
+
+	def test_partial_batch_is_not_resent(self):
+		writer = self._writer_class()(self.backend, 'device')
+		self.backend.failing.add('b')
+		for data in ('a', 'b', 'c'):
+			writer.put_result(Backend.result_data('run', 'log', data))
+		writer.start()
+		self.assertTrue(writer.flush(10))
+		writer.stop()
+		writer.join(5)
+		self.assertEqual(self.backend.results, ['a', 'b', 'c'])
+
+	def test_rejected_update_is_dropped(self):
+		cls = self._writer_class()
+		writer = cls(self.backend, 'device')
+		self.backend.rejected.add('b')
+		for data in ('a', 'b', 'c'):
+			writer.put_result(Backend.result_data('run', 'log', data))
+		writer.start()
+		self.assertTrue(writer.flush(10))
+		writer.stop()
+		writer.join(5)
+		self.assertEqual(self.backend.results, ['a', 'c'])
+		# the dropped update is acked, thus not restored from the spool
+		self.assertEqual(cls(self.backend, 'device').pending(), 0)
+
+	def test_existing_spool_dir(self):
+		cls = self._writer_class()
+		os.makedirs(cls.SPOOL_PATH)
+		cls(self.backend, 'device1')
+		cls(self.backend, 'device2')
+
+
+if __name__ == '__main__':
+	unittest.main()
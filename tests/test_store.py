@@ -0,0 +1,53 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from benchmarks import standin
+from store import AppStore, AppStoreException
+
+
+class BulkLookupTest(unittest.TestCase):
+
+	def setUp(self):
+		self.body = '{"resultCount": 1, "results": [{"trackId": 1, "bundleId": "a"}]}'
+		self.truncate = False
+		self.server = standin.StandInServer([
+			('GET', r'^/lookup', self._lookup),
+		]).start()
+		self.lookupURL = AppStore.bulk_lookup_URL
+		AppStore.bulk_lookup_URL = self.server.url + '/lookup?%(field)s=%(ids)s&country=%(country)s'
+		self.store = AppStore('de', cache=False)
+
+	def tearDown(self):
+		AppStore.bulk_lookup_URL = self.lookupURL
+		self.server.stop()
+
+	def _lookup(self, req, body):
+		req.send_response(200)
+		req.send_header('Content-Length', str(len(self.body)))
+		req.end_headers()
+		if self.truncate:
+			req.wfile.write(self.body[:len(self.body)/2])
+			req.wfile.flush()
+			req.close_connection = 1
+			return None
+		req.wfile.write(self.body)
+		req.wfile.flush()
+		return None
+
+	def test_lookup(self):
+		self.assertEqual(self.store.lookup_bundleIds(['a']), {'a': {'trackId': 1, 'bundleId': 'a'}})
+
+	def test_truncated_body(self):
+		self.truncate = True
+		self.assertRaises(AppStoreException, self.store.lookup_bundleIds, ['a'])
+
+	def test_garbled_body(self):
+		self.body = '<html>Service Unavailable</html>'
+		self.assertRaises(AppStoreException, self.store.lookup_bundleIds, ['a'])
+
+
+if __name__ == '__main__':
+	unittest.main()
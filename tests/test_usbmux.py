@@ -0,0 +1,64 @@
+import os
+import sys
+import shutil
+import socket
+import struct
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from python_client.usbmux import MuxConnection, MuxDevice, MuxError, BinaryProtocol
+
+
+def _result(tag, number):
+	return struct.pack("IIII", 20, 0, BinaryProtocol.TYPE_RESULT, tag) + struct.pack("I", number)
+
+
+class StartConnectTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmpDir = tempfile.mkdtemp()
+		path = os.path.join(self.tmpDir, 'usbmuxd')
+		server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		server.bind(path)
+		server.listen(1)
+		self.connector = MuxConnection(path, BinaryProtocol)
+		self.usbmuxd, addr = server.accept()
+		server.close()
+		self.device = MuxDevice(1, 0x12a8, 'serial', 0)
+
+	def tearDown(self):
+		self.connector.close()
+		self.usbmuxd.close()
+		shutil.rmtree(self.tmpDir)
+
+	def _connect_request(self):
+		self.connector.start_connect(self.device, 8080)
+		header = self.usbmuxd.recv(16)
+		length, version, req, tag = struct.unpack("IIII", header)
+		self.assertEqual(req, BinaryProtocol.TYPE_CONNECT)
+		self.usbmuxd.recv(length - 16)
+		return tag
+
+	def test_partial_reply(self):
+		tag = self._connect_request()
+		# nothing received yet, the socket does not block
+		self.assertEqual(self.connector.finish_connect(), None)
+		reply = _result(tag, 0)
+		self.usbmuxd.sendall(reply[:6])
+		self.assertEqual(self.connector.finish_connect(), None)
+		# the device data following the reply is not consumed
+		self.usbmuxd.sendall(reply[6:] + 'HTTP/1.1')
+		sock = self.connector.finish_connect()
+		self.assertEqual(self.connector.socket.pending(), 0)
+		self.assertEqual(sock.recv(64), 'HTTP/1.1')
+
+	def test_connect_refused(self):
+		tag = self._connect_request()
+		self.usbmuxd.sendall(_result(tag, 3))
+		self.assertRaises(MuxError, self.connector.finish_connect)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,100 @@
+import os
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger('worker.'+__name__)
+
+
+class PersistentTTLCache(object):
+	''' A key-value cache stored in a sqlite database, thus shared between processes.
+
+		Entries expire after their ttl, the least recently used entries are removed
+		once the cache holds more than `maxEntries`. Besides values the cache can hold
+		negative entries (an error message) to remember failed lookups.
+		Values need to be json serializable.
+	'''
+
+	DEFAULT_TTL = 24*60*60
+	MAX_ENTRIES = 100000
+
+	def __init__(self, path, ttl=None, maxEntries=None):
+		self.path = path
+		self.ttl = ttl or self.DEFAULT_TTL
+		self.maxEntries = maxEntries or self.MAX_ENTRIES
+		self.hits = 0
+		self.misses = 0
+		self._local = threading.local()
+		self._inserts = 0
+
+	def __str__(self):
+		return "<PersistentTTLCache: %s (hits: %d, misses: %d)>" % (self.path, self.hits, self.misses)
+
+	@property
+	def conn(self):
+		# sqlite connections must not be shared with other threads or forked processes
+		local = self._local
+		if getattr(local, 'pid', None) != os.getpid():
+			conn = sqlite3.connect(self.path, timeout=30)
+			conn.execute('CREATE TABLE IF NOT EXISTS cache ('
+				'key TEXT PRIMARY KEY, value TEXT, error TEXT, expires REAL, accessed REAL)')
+			conn.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+			conn.commit()
+			local.conn = conn
+			local.pid = os.getpid()
+		return local.conn
+
+	def hit_rate(self):
+		total = self.hits + self.misses
+		if total == 0:
+			return 0.0
+		return float(self.hits) / total
+
+
+	def get(self, key):
+		''' returns a (value, error) tuple or None if the key is not cached (or expired) '''
+		now = time.time()
+		try:
+			row = self.conn.execute('SELECT value, error, expires FROM cache WHERE key = ?', (key,)).fetchone()
+			if row is None or row[2] < now:
+				self.misses += 1
+				return None
+			with self.conn:
+				self.conn.execute('UPDATE cache SET accessed = ? WHERE key = ?', (now, key))
+		except sqlite3.Error as e:
+			logger.warning('cache lookup failed for %s: %s' % (key, e))
+			self.misses += 1
+			return None
+		self.hits += 1
+		value, error = row[0], row[1]
+		if value is not None:
+			value = json.loads(value)
+		return (value, error)
+
+	def _put(self, key, value, error, ttl):
+		now = time.time()
+		try:
+			with self.conn:
+				self.conn.execute('INSERT OR REPLACE INTO cache (key, value, error, expires, accessed) VALUES (?, ?, ?, ?, ?)',
+					(key, value, error, now + (ttl or self.ttl), now))
+			self._inserts += 1
+			if self._inserts % 100 == 0:
+				self.evict()
+		except sqlite3.Error as e:
+			logger.warning('cache update failed for %s: %s' % (key, e))
+
+	def set(self, key, value, ttl=None):
+		self._put(key, json.dumps(value), None, ttl)
+
+	def set_error(self, key, error, ttl=None):
+		''' add a negative entry '''
+		self._put(key, None, str(error), ttl)
+
+	def evict(self):
+		''' remove expired and least recently used entries '''
+		with self.conn:
+			self.conn.execute('DELETE FROM cache WHERE expires < ?', (time.time(),))
+			self.conn.execute('DELETE FROM cache WHERE key IN '
+				'(SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)', (self.maxEntries,))
@@ -5,8 +5,11 @@ import logging
 import time
 import traceback
 import requests
+import threading
+import Queue
 
 from multiprocessing import Process, Event
+from multiprocessing import Queue as ProcessQueue
 
 logging.basicConfig(level=logging.WARNING)
 logger = logging.getLogger('worker')
@@ -16,17 +19,47 @@ logger.setLevel(level=logging.INFO)
 from job import JobFactory
 from device import iDevice
 from backend import Backend
+from statuswriter import StatusWriter
+from fairshare import FairShareQueue
+from store import AppStore
+from python_client import USBMux, MuxError
+import deviceconnection
 #from pilot import Pilot
 
 MIN_FREE_DEVICE_BYTES = 1024**3
 
-class DeviceLoop(Process):
-
-	def __init__(self, device, backend):
-		super(DeviceLoop, self).__init__()
+class DeviceLoopMixin(object):
+	''' The job loop of a single device.
+		Runs either in its own process (DeviceLoop) or as a thread of the worker (DeviceThread).
+	'''
+
+	# max. time the backend may hold a long-poll job request (seconds)
+	JOB_WAIT_TIME = 25
+	# polling interval bounds for backends without long-poll support (seconds)
+	MIN_POLL_INTERVAL = 2
+	MAX_POLL_INTERVAL = 30
+	# max. time to block on the dispatcher queue before checking the device again (seconds)
+	JOB_QUEUE_TIMEOUT = 5
+	# max. time to wait for pending status updates on shutdown (seconds)
+	STATUS_FLUSH_TIMEOUT = 30
+	# max. time to wait for the prefetcher on shutdown, longer than a pending job request (seconds)
+	PREFETCH_JOIN_TIMEOUT = JOB_WAIT_TIME + JOB_QUEUE_TIMEOUT
+
+	def __init__(self, device, backend, dispatcher=None, pipeline=False):
+		super(DeviceLoopMixin, self).__init__()
 		self.device = device
 		self.backend = backend
+		# claim and prepare the next job while the current one is executed
+		self.pipeline = pipeline
+		self.preparedJobs = None
 		self._stop = Event()
+		self.pollInterval = self.MIN_POLL_INTERVAL
+		# jobs are handed over by a JobDispatcher if present
+		self.dispatcher = dispatcher
+		self.jobQueue = None
+		self._jobRequested = False
+		if dispatcher:
+			self.jobQueue = ProcessQueue()
 
 	def stop(self):
 		self._stop.set()
@@ -34,15 +67,159 @@ class DeviceLoop(Process):
 	def stopped(self):
 		return self._stop.is_set()
 
+	def _wait_for_job(self):
+		''' get the next job for this device.
+			Uses a long-poll request if supported by the backend, adaptive polling otherwise.
+			returns a jobDict or None
+		'''
+		if self.jobQueue is not None:
+			return self._wait_for_dispatched_job()
+
+		longPoll = self.backend.longPoll
+		jobDict = self.backend.get_job_for_device(self.device.udid, wait=self.JOB_WAIT_TIME)
+		if jobDict:
+			self.pollInterval = self.MIN_POLL_INTERVAL
+			return jobDict
+
+		# the backend already waited for us
+		if jobDict is None and longPoll and self.backend.longPoll:
+			return None
+
+		logger.info('waiting for job... (%s, %ss)' % (str(self.device), self.pollInterval))
+		self._stop.wait(self.pollInterval)
+		self.pollInterval = min(self.pollInterval * 2, self.MAX_POLL_INTERVAL)
+		return None
+
+	def _wait_for_dispatched_job(self):
+		if not self._jobRequested:
+			self.dispatcher.request_job(self.device.udid)
+			self._jobRequested = True
+		try:
+			jobDict = self.jobQueue.get(timeout=self.JOB_QUEUE_TIMEOUT)
+		except Queue.Empty:
+			return None
+		self._jobRequested = False
+		return jobDict
+
+	def _create_job(self, jobDict):
+		job = JobFactory.job_from_dict(jobDict, self.backend, self.device)
+		if not job:
+			logging.error("Invalid Job: %s created from jobDict: %s" % (job, jobDict))
+		return job
+
+	def _job_finished(self):
+		''' tell the dispatcher that the oldest job handed to this device is done '''
+		if self.dispatcher:
+			self.dispatcher.job_finished(self.device.udid)
+
+	def _release_job(self, jobDict):
+		''' hand a claimed job that will not be executed back to the backend '''
+		self._job_finished()
+		self.backend.release_job(jobDict)
+
+	def _release_dispatched_jobs(self):
+		while True:
+			try:
+				jobDict = self.jobQueue.get_nowait()
+			except Queue.Empty:
+				return
+			self._release_job(jobDict)
+
+	def _release_prepared_jobs(self):
+		while True:
+			try:
+				job = self.preparedJobs.get_nowait()
+			except Queue.Empty:
+				return
+			self.preparedJobs.task_done()
+			self._release_job(job.jobDict)
+
+	def _prefetch_loop(self):
+		''' claims and prepares jobs, staying one job ahead of the device loop '''
+		while not self.stopped():
+			jobDict = self._wait_for_job()
+			if not jobDict:
+				continue
+			if self.stopped():
+				# claimed while the loop was stopped
+				self._release_job(jobDict)
+				break
+			job = self._create_job(jobDict)
+			if not job:
+				self._job_finished()
+				continue
+			try:
+				startTime = time.time()
+				job.prepare()
+				logger.info('prepared job %s in %.1fs (%s)' % (job.jobId, time.time() - startTime, str(self.device)))
+			except Exception as e:
+				# the job will do the work itself
+				logger.warning("Preparing job failed: %s" % e)
+			with self._prefetchLock:
+				if self.stopped():
+					self._release_job(jobDict)
+					break
+				# the queue is empty, put() does not block
+				self.preparedJobs.put(job)
+			# wait until the device loop has taken the job
+			self.preparedJobs.join()
+
+	def _stop_prefetcher(self, prefetcher):
+		''' release the prepared job and wait for a pending claim of the prefetcher,
+			a job claimed meanwhile is released by the prefetcher itself
+		'''
+		# jobs prepared from now on are released by the prefetcher itself
+		with self._prefetchLock:
+			self._release_prepared_jobs()
+		prefetcher.join(self.PREFETCH_JOIN_TIMEOUT)
+		if prefetcher.is_alive():
+			logger.warning('Prefetcher of %s did not stop in time' % str(self.device))
+
+	def _next_job(self):
+		''' returns the next job to execute or None '''
+		if self.preparedJobs is not None:
+			try:
+				job = self.preparedJobs.get(timeout=self.JOB_QUEUE_TIMEOUT)
+			except Queue.Empty:
+				return None
+			self.preparedJobs.task_done()
+			return job
+
+		jobDict = self._wait_for_job()
+		if jobDict:
+			job = self._create_job(jobDict)
+			if not job:
+				self._job_finished()
+			return job
+		return None
+
 	def run(self):
+		# never share pooled connections with the parent process
+		self.backend.reset_session()
+		# post job and run updates in the background
+		self.backend.writer = StatusWriter(self.backend, self.device.udid)
+		self.backend.writer.start()
+
+		# keep the device information up to date in the background
+		self.device.telemetry.start()
+
 		logger.info("registering device %s with backend" % str(self.device))
 		self.backend.register_device(self.device)
 
+		prefetcher = None
+		if self.pipeline:
+			self.preparedJobs = Queue.Queue(maxsize=1)
+			self._prefetchLock = threading.Lock()
+			prefetcher = threading.Thread(target=self._prefetch_loop)
+			prefetcher.daemon = True
+			prefetcher.start()
+
 		logger.info("entering device loop: %s" % str(self.device))
 		while not self.stopped():
 			
+			# unknown if the disk usage query failed, it is retried with the next job
 			free_bytes = self.device.free_bytes()
-			if (free_bytes < MIN_FREE_DEVICE_BYTES):
+			if (free_bytes is not None and free_bytes < MIN_FREE_DEVICE_BYTES):
 				logger.error("Low disk space on device: %s (%s < %s). Stopping execution now." % (self.device, free_bytes, MIN_FREE_DEVICE_BYTES))
 				#pilot = Pilot(self.device.base_url())
 				#pilot.inject('SpringBoard', "") ## TODO add cycript command to reboot an idevice here
@@ -51,42 +228,276 @@ class DeviceLoop(Process):
 				self.stop()
 				break
 			
-			jobDict = self.backend.get_job_for_device(self.device.udid)
+			job = self._next_job()
+
+			if job and self.stopped():
+				# the device may be gone already
+				logger.info('Device loop stopped, not executing job %s' % str(job))
+				self._release_job(job.jobDict)
+			elif job:
+				logger.info('Executing Job %s' % str(job))
+				try:
+					job.execute()
+				except requests.ConnectionError as e:
+					logger.error("Executing job failed: %s" % e)
+					tb = traceback.format_exc()
+					logger.error("traceback: %s" % tb)
+					logger.error("Device loop will be stopped now.")
+					self.stop()
+					
+				except Exception as e:
+					logger.error("Executing job failed: %s" % e)
+					tb = traceback.format_exc()
+					logger.error("traceback: %s" % tb)
+				self._job_finished()
+
+		if prefetcher:
+			self._stop_prefetcher(prefetcher)
+		if self.jobQueue is not None:
+			# dispatched after the last request, the dispatcher skips stopped loops from now on
+			self._release_dispatched_jobs()
+		self.device.telemetry.stop()
+		logger.info("sending pending status updates... (%s)" % str(self.device))
+		self.backend.writer.stop()
+		self.backend.writer.join(self.STATUS_FLUSH_TIMEOUT)
+
+
+class DeviceLoop(DeviceLoopMixin, Process):
+	''' a device loop in its own process '''
+	pass
+
+
+class DeviceThread(DeviceLoopMixin, threading.Thread):
+	''' A device loop running as thread of the worker process.
+		Each thread uses its own backend session and status writer, an unexpected
+		error only ends the loop of the affected device.
+	'''
+
+	def __init__(self, device, backend, dispatcher=None, pipeline=False):
+		super(DeviceThread, self).__init__(device, backend.copy(), dispatcher=dispatcher, pipeline=pipeline)
+		self.daemon = True
+		self.name = 'DeviceThread-%s' % device.udid
+
+	def run(self):
+		try:
+			super(DeviceThread, self).run()
+		except Exception as e:
+			logger.error("Device loop of %s failed: %s" % (self.device, e))
+			logger.error("traceback: %s" % traceback.format_exc())
+			self.device.telemetry.stop()
+			if self.backend.writer:
+				self.backend.writer.stop()
+
+	def terminate(self):
+		# threads can not be killed, the daemon thread ends with the worker process
+		logger.warning('Unable to terminate device thread of %s' % self.device)
+
+
+
+
+class JobDispatcher(threading.Thread):
+	''' Claims jobs for all idle device loops of the worker in a single backend request
+		and hands them over to the loops via their job queues.
+		Falls back to per-device requests if the backend does not support batch claiming.
+
+		Claimed jobs pass a FairShareQueue, thus idle devices get the most urgent of the jobs
+		claimed for them. Jobs deferred by their quota are kept until MAX_BACKLOG jobs are queued,
+		jobs of a removed device loop are released.
+	'''
+
+	# max. number of claimed jobs waiting for a device
+	MAX_BACKLOG = 20
+	# log the queueing statistics every n dispatched jobs
+	STATS_INTERVAL = 50
+	# max. time to wait for jobs still in transit to a removed loop (seconds)
+	DRAIN_TIMEOUT = 0.1
+	# device loop events
+	JOB_REQUESTED = 'requested'
+	JOB_FINISHED = 'finished'
+
+	def __init__(self, backend):
+		super(JobDispatcher, self).__init__()
+		self.daemon = True
+		self.backend = backend
+		self.deviceLoops = {}
+		# (event, udid) tuples sent by the device loops, in order
+		self.loopEvents = ProcessQueue()
+		self.waiting = set()
+		self.queue = FairShareQueue()
+		self.dispatched = 0
+		self._lock = threading.Lock()
+		self._stop = threading.Event()
+		self.pollInterval = DeviceLoop.MIN_POLL_INTERVAL
+
+	def stop(self):
+		self._stop.set()
+
+	def stopped(self):
+		return self._stop.is_set()
 
+	def add_loop(self, dLoop):
+		with self._lock:
+			self.deviceLoops[dLoop.device.udid] = dLoop
+
+	def remove_loop(self, udid):
+		''' called after the loop has ended '''
+		with self._lock:
+			dLoop = self.deviceLoops.pop(udid, None)
+			self.waiting.discard(udid)
+			self.queue.removed(udid)
+			jobDicts = self.queue.remove_jobs(udid)
+			# dispatched while the loop was stopping
+			while dLoop:
+				try:
+					jobDicts.append(dLoop.jobQueue.get(timeout=self.DRAIN_TIMEOUT))
+				except Queue.Empty:
+					break
+		# claimed for this device, no other device may run them
+		for jobDict in jobDicts:
+			self.backend.release_job(jobDict)
+
+	def request_job(self, udid):
+		''' called by a device loop (from its own process) to request its next job '''
+		self.loopEvents.put((self.JOB_REQUESTED, udid))
+
+	def job_finished(self, udid):
+		''' called by a device loop (from its own process) after its oldest job has finished '''
+		self.loopEvents.put((self.JOB_FINISHED, udid))
+
+	def _collect_requests(self, timeout):
+		try:
+			event, udid = self.loopEvents.get(timeout=timeout)
+			while True:
+				with self._lock:
+					if event == self.JOB_FINISHED:
+						self.queue.finished(udid)
+					elif udid in self.deviceLoops:
+						self.waiting.add(udid)
+				event, udid = self.loopEvents.get_nowait()
+		except Queue.Empty:
+			pass
+
+	def _claim_jobs(self, udids, wait=DeviceLoop.JOB_WAIT_TIME):
+		if self.backend.batchClaim:
+			jobs = self.backend.get_jobs_for_devices(udids, wait=wait)
+			if jobs is not None or self.backend.batchClaim:
+				return jobs or {}
+		jobs = {}
+		for udid in udids:
+			jobDict = self.backend.get_job_for_device(udid)
 			if jobDict:
-				job = JobFactory.job_from_dict(jobDict, self.backend, self.device)
-				if job:
-					logger.info('Executing Job %s' % str(job))
-					try:
-						job.execute()
-					except requests.ConnectionError as e:
-						logger.error("Executing job failed: %s" % e)
-						tb = traceback.format_exc()
-						logger.error("traceback: %s" % tb)
-						logger.error("Device loop will be stopped now.")
-						self.stop()
-						
-					except Exception as e:
-						logger.error("Executing job failed: %s" % e)
-						tb = traceback.format_exc()
-						logger.error("traceback: %s" % tb)
-				else:
-					logging.error("Invalid Job: %s created from jobDict: %s" % (job, jobDict))
-			else:
-				logger.info('waiting for job... (%s)' % str(self.device))
-#				print jobDict
-				#sleep some time
-				time.sleep(30)
+				jobs[udid] = jobDict
+		return jobs
+
+	def _prewarm_store_cache(self, jobs):
+		''' resolve the store data of all claimed AppStore apps with a few bulk requests '''
+		bundleIds = {}
+		for jobDict in jobs.itervalues():
+			jobInfo = jobDict.get('jobInfo', {})
+			if jobInfo.get('appType') == 'AppStoreApp' and 'bundleId' in jobInfo:
+				bundleIds.setdefault(jobInfo.get('storeCountry', 'de'), []).append(jobInfo['bundleId'])
+		for country, ids in bundleIds.iteritems():
+			try:
+				AppStore(country).prewarm(ids)
+			except Exception as e:
+				# only an optimization, the jobs look up their apps themselves
+				logger.warning('Prewarming store cache failed: %s' % e)
+
+	def _dispatch(self):
+		''' hand out queued jobs to the waiting devices '''
+		with self._lock:
+			for udid in list(self.waiting):
+				dLoop = self.deviceLoops.get(udid)
+				if not dLoop or dLoop.stopped():
+					self.waiting.discard(udid)
+					continue
+				jobDict = self.queue.pop(udid)
+				if not jobDict:
+					continue
+				self.waiting.discard(udid)
+				self.queue.started(udid, jobDict)
+				dLoop.jobQueue.put(jobDict)
+				self.dispatched += 1
+				if self.dispatched % self.STATS_INTERVAL == 0:
+					self._log_stats()
+
+	def _log_stats(self):
+		for priority, (count, latency) in sorted(self.queue.stats().iteritems()):
+			logger.info('%s priority: %d jobs dispatched, mean queueing time %.1fs' % (priority, count, latency))
+
+	def _run_once(self):
+		''' collect job requests, claim jobs for the waiting devices and dispatch them '''
+		# block until the first device is waiting
+		timeout = 1 if not self.waiting else 0
+		self._collect_requests(timeout)
+		self._dispatch()
+		with self._lock:
+			udids = list(self.waiting)
+		if not udids or len(self.queue) >= self.MAX_BACKLOG:
+			# devices are waiting for deferred jobs only
+			if udids:
+				self._stop.wait(DeviceLoop.MIN_POLL_INTERVAL)
+			return
+
+		# do not hold the request while queued jobs are deferred
+		wait = None
+		if len(self.queue) == 0:
+			wait = DeviceLoop.JOB_WAIT_TIME
+		longPoll = self.backend.longPoll and self.backend.batchClaim and wait
+		try:
+			jobs = self._claim_jobs(udids, wait=wait)
+		except requests.RequestException as e:
+			logger.error("Claiming jobs failed: %s" % e)
+			jobs = {}
+		for udid, jobDict in jobs.iteritems():
+			self.queue.put(jobDict, udid=udid)
+		if len(jobs) > 1:
+			self._prewarm_store_cache(jobs)
+		self._dispatch()
+
+		if jobs:
+			self.pollInterval = DeviceLoop.MIN_POLL_INTERVAL
+		elif not (longPoll and self.backend.longPoll):
+			logger.info('waiting for jobs... (%d devices, %ss)' % (len(udids), self.pollInterval))
+			self._stop.wait(self.pollInterval)
+			self.pollInterval = min(self.pollInterval * 2, DeviceLoop.MAX_POLL_INTERVAL)
 
+	def run(self):
+		while not self.stopped():
+			try:
+				self._run_once()
+			except Exception as e:
+				# the device loops depend on this thread, never let it die
+				logger.error("Dispatching jobs failed: %s" % e)
+				logger.error("traceback: %s" % traceback.format_exc())
+				self._stop.wait(self.pollInterval)
+				self.pollInterval = min(self.pollInterval * 2, DeviceLoop.MAX_POLL_INTERVAL)
 
+		self._log_stats()
+		if len(self.queue) > 0:
+			logger.warning('%d claimed jobs were not dispatched' % len(self.queue))
 
 
 class Worker(Process):
 
-	def __init__(self, backendUrl):
+	# max. time to wait for usbmux device events before checking the device loops (seconds)
+	DEVICE_EVENT_TIMEOUT = 1.0
+	# device polling interval if the usbmux listener is not available (seconds)
+	DEVICE_POLL_INTERVAL = 5
+
+	# device loop implementation per runtime
+	RUNTIMES = {
+		'processes': DeviceLoop,
+		'threads': DeviceThread,
+	}
+
+	def __init__(self, backendUrl, poolSize=None, timeout=None, longPoll=True, batchClaim=False, pipeline=False, runtime='processes'):
 		super(Worker, self).__init__()
 		self.name = socket.gethostname()
-		self.backend = Backend(backendUrl)
+		self.backend = Backend(backendUrl, poolSize=poolSize, timeout=timeout, longPoll=longPoll)
+		self.batchClaim = batchClaim
+		self.pipeline = pipeline
+		self.deviceLoopClass = self.RUNTIMES[runtime]
 		worker = self.backend.worker_for_name(self.name)
 		if '_id' in worker:
 			self.workerId = worker['_id']
@@ -101,17 +512,60 @@ class Worker(Process):
 	def stopped(self):
 		return self._stop.is_set()
 
+	def _device_listener(self):
+		''' connect to usbmuxd to get notified about device attach/detach events.
+			returns None if usbmuxd is not available (devices will be polled instead)
+		'''
+		try:
+			return USBMux()
+		except (MuxError, socket.error) as e:
+			logger.warning('Unable to listen for usbmux device events (%s). Polling devices instead.' % e)
+			return None
+
 	def run(self):
  		deviceLoops = {}
-
+		# loops that did not stop in time (threads can not be terminated)
+		stoppingLoops = {}
+		# start the device tunnels once, the device loops inherit the handler
+		deviceHandler = deviceconnection.shared_device_handler()
+		dispatcher = None
+		if self.batchClaim:
+			dispatcher = JobDispatcher(self.backend)
+			dispatcher.start()
+
+		mux = None
 		while not self.stopped():
-			devices = iDevice.devices()
+			if not mux:
+				mux = self._device_listener()
+
 			currDeviceUDIDs = []
+			if mux:
+				try:
+					# returns as soon as a device is attached or detached
+					mux.process(self.DEVICE_EVENT_TIMEOUT)
+					currDeviceUDIDs = list(dev.serial for dev in mux.devices)
+				except (MuxError, socket.error) as e:
+					logger.error('usbmux listener failed: %s' % e)
+					mux = None
+					continue
+			else:
+				currDeviceUDIDs = iDevice.list_device_ids()
+
+			for udid in stoppingLoops.keys():
+				if not stoppingLoops[udid].is_alive():
+					stoppingLoops.pop(udid)
+					logger.info('Device loop finished: %s', udid)
+
 			# search for new devices
-			for device in devices:
-				currDeviceUDIDs.append(device.udid)
-				if device.udid not in deviceLoops:
-					dLoop = DeviceLoop(device, self.backend)
+			for udid in currDeviceUDIDs:
+				if udid in stoppingLoops:
+					# a second loop would share the device and its status spool
+					continue
+				if udid not in deviceLoops:
+					device = iDevice(udid)
+					dLoop = self.deviceLoopClass(device, self.backend, dispatcher=dispatcher, pipeline=self.pipeline)
+					if dispatcher:
+						dispatcher.add_loop(dLoop)
 					dLoop.start()
 					deviceLoops[device.udid] = dLoop
 					logger.info('Started device loop for %s', device.udid)
@@ -128,13 +582,24 @@ class Worker(Process):
 							logger.info('... loop has not yet stopped. Terminating the loop now.  (%s)', udid)
 							dLoop.terminate()
 					deviceLoops.pop(udid)
-					logger.info('Device loop finished: %s', udid)
-			time.sleep(5)
+					if dispatcher:
+						dispatcher.remove_loop(udid)
+					if dLoop.is_alive():
+						logger.warning('Device loop of %s is still running, the device is not used until it has finished', udid)
+						stoppingLoops[udid] = dLoop
+					else:
+						logger.info('Device loop finished: %s', udid)
+			if not mux:
+				time.sleep(self.DEVICE_POLL_INTERVAL)
 
 		logger.info('runloop is shutting down. Stoping all client processes gracefully')
-		for udid, process in deviceLoops:
+		if dispatcher:
+			dispatcher.stop()
+		for udid, process in deviceLoops.iteritems():
 			logger.info('joining device loop for device %s', udid)
 			process.join()
+		deviceHandler.stop()
+		deviceHandler.join(deviceconnection._JOIN_TIMEOUT)
 		logger.info('Worker has finished working...')
 
 
@@ -147,6 +612,12 @@ def main():
 	parser.add_argument('-b','--backend', required=True, help='the backend url.')
 	parser.add_argument('-d','--debug', action='store_true', help='enable debug output.')
 	parser.add_argument('--debug-all', action='store_true', help='enable debug output (even for third-party code).')
+	parser.add_argument('--pool-size', type=int, metavar='n', help='max. number of keep-alive connections to the backend per process (defaults to %d).' % Backend.POOL_SIZE)
+	parser.add_argument('--no-long-poll', dest='long_poll', action='store_false', help='poll the backend for jobs instead of using long-poll requests.')
+	parser.add_argument('--batch-claim', action='store_true', help='claim jobs for all idle devices in a single backend request.')
+	parser.add_argument('--pipeline', action='store_true', help='claim and download the next job of a device while the current one is executed.')
+	parser.add_argument('--runtime', choices=sorted(Worker.RUNTIMES.keys()), default='processes', help='run the device loops as processes or as threads of a single worker process (defaults to processes).')
+	parser.add_argument('--timeout', type=float, metavar='seconds', help='backend connect and read timeout (defaults to %s).' % str(Backend.TIMEOUT))
 
 	args = parser.parse_args()
 	
@@ -159,7 +630,7 @@ def main():
 	logger.debug(args)
 	
 
-	worker = Worker(args.backend)
+	worker = Worker(args.backend, poolSize=args.pool_size, timeout=args.timeout, longPoll=args.long_poll, batchClaim=args.batch_claim, pipeline=args.pipeline, runtime=args.runtime)
 	worker.start()
 	worker.join()
 